@@ -0,0 +1,19 @@
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode='w'):
+    """打开 path.tmp 供写入，正常结束后重命名为 path
+
+    读取方只会看到旧文件或完整的新文件，中断时不会留下写了一半的内容；出错时删除临时文件。
+    mode 为 'w'（UTF-8文本）或 'wb'。
+    """
+    temp_path = path + '.tmp'
+    try:
+        with open(temp_path, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -0,0 +1,264 @@
+"""提取热点路径的基准测试：速度（行/秒）、峰值RSS和Python内存分配峰值
+
+每个 (提取器, 行数) 组合在独立子进程中运行，峰值RSS互不影响。合成数据由
+generate_csv.py 生成并缓存在 benchmarks/data/ 中。
+
+用法:
+    python benchmarks/bench_extract.py                                   # 默认 10k、100k 行
+    python benchmarks/bench_extract.py --sizes 10k,100k,1m,10m --ratio-443 0.3 --delimiter ';'
+    python benchmarks/bench_extract.py --save benchmarks/baseline.json   # 保存为基线
+    python benchmarks/bench_extract.py --compare benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+DATA_DIR = os.path.join(BENCH_DIR, 'data')
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from generate_csv import DEFAULT_REGIONS, generate_csv  # noqa: E402
+
+EXTRACTORS = ['extract_443_ips_from_csv', 'scan_csv_file_pandas', 'extract_443_ips_advanced',
+              'legacy_extract_443_ips_advanced', 'merge_csv_files']
+# 对比的参考实现：extract_443_ips_advanced 与改为mmap单一模式之前的逐行实现
+REFERENCES = {'extract_443_ips_advanced': 'legacy_extract_443_ips_advanced'}
+SIZE_SUFFIXES = {'k': 1000, 'm': 1000000}
+REGRESSION_THRESHOLD = 0.2  # 默认比基线慢20%以上视为回退
+
+
+def parse_size(text):
+    """解析 10k、1m、250000 等行数写法"""
+    text = text.strip().lower()
+    if text[-1:] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
+
+
+def _module_version(name):
+    """可选依赖的版本号，未安装时为None（IPSet在有numpy时走向量化路径，影响结果）"""
+    try:
+        return __import__(name).__version__
+    except ImportError:
+        return None
+
+
+def dataset_path(rows, ratio_443, regions, delimiter):
+    """相同参数的数据集只生成一次"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tag = f"{rows}-{ratio_443}-{regions.replace(':', '').replace(',', '_')}-{ord(delimiter)}"
+    path = os.path.join(DATA_DIR, f"synthetic-{tag}.csv")
+    if not os.path.exists(path):
+        print(f"生成数据集: {os.path.basename(path)}", file=sys.stderr)
+        generate_csv(path, rows, ratio_443, regions, delimiter)
+    return path
+
+
+def legacy_extract_443_ips_advanced(csv_path):
+    """改写前的 extract_443_ips_advanced：整个文件读入内存，逐行用正则判断是否包含443
+
+    只作为速度和内存的参考。它会漏掉测速值中含有 1443、8443 等字样的443行，
+    结果数量可能少于新实现。
+    """
+    from ip_set import IPSet, ip_to_int
+
+    ip_addresses = set()
+    with open(csv_path, 'r', encoding='utf-8', errors='ignore') as file:
+        content = file.read()
+        for match in re.findall(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}:443\b', content):
+            ip = match.split(':')[0]
+            if ip_to_int(ip) is not None:
+                ip_addresses.add(ip)
+        for line in content.split('\n'):
+            if re.search(r'\b443\b', line) and not re.search(r'\b(?:8443|3443|2443|1443)\b', line):
+                for ip in re.findall(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b', line):
+                    if ip_to_int(ip) is not None:
+                        ip_addresses.add(ip)
+    return IPSet.from_strings(ip_addresses).to_strings()
+
+
+def run_extractor(name, csv_path):
+    """执行一次提取，返回结果数量"""
+    import telegram_downloader as td
+
+    downloader = td.TelegramDownloader(None, None, None, None)
+    if name == 'extract_443_ips_from_csv':
+        return len(downloader.extract_443_ips_from_csv(csv_path))
+    if name == 'scan_csv_file_pandas':
+        return len(td.scan_csv_file_pandas(csv_path).ips_443)
+    if name == 'extract_443_ips_advanced':
+        return len(downloader.extract_443_ips_advanced(csv_path))
+    if name == 'legacy_extract_443_ips_advanced':
+        return len(legacy_extract_443_ips_advanced(csv_path))
+    if name == 'merge_csv_files':
+        # 与一份副本合并：一半的行是重复行，覆盖去重路径
+        work_dir = os.path.join(DATA_DIR, f"merge-{os.getpid()}")
+        os.makedirs(work_dir, exist_ok=True)
+        try:
+            copy_path = os.path.join(work_dir, 'copy.csv')
+            shutil.copyfile(csv_path, copy_path)
+            merged_path = downloader.merge_csv_files([copy_path, csv_path], output_filename='merged.csv')
+            with open(merged_path, 'rb') as f:
+                return sum(1 for _ in f) - 1
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    raise ValueError(f"未知的提取器: {name}")
+
+
+def child_main(name, csv_path, rows, repeat, measure_alloc):
+    """子进程：计时运行repeat次取最快一次，再在tracemalloc下运行一次统计分配峰值"""
+    import logging
+    logging.disable(logging.INFO)
+
+    seconds = None
+    for _ in range(max(repeat, 1)):
+        start = time.perf_counter()
+        result_count = run_extractor(name, csv_path)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+    # Linux上ru_maxrss单位为KB，macOS上为字节
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024
+
+    alloc_peak_mb = None
+    if measure_alloc:
+        tracemalloc.start()
+        run_extractor(name, csv_path)
+        alloc_peak_mb = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        tracemalloc.stop()
+
+    print(json.dumps({
+        'extractor': name,
+        'rows': rows,
+        'seconds': round(seconds, 4),
+        'rows_per_sec': round(rows / seconds) if seconds else None,
+        'peak_rss_mb': round(peak_rss_mb, 1),
+        'alloc_peak_mb': round(alloc_peak_mb, 1) if alloc_peak_mb is not None else None,
+        'result_count': result_count,
+    }))
+
+
+def run_case(name, csv_path, rows, repeat, measure_alloc):
+    """在子进程中运行一个组合，返回结果字典；依赖缺失等错误时返回None"""
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, csv_path, str(rows), '--repeat', str(repeat)]
+    if not measure_alloc:
+        command.append('--no-alloc')
+    completed = subprocess.run(command, capture_output=True, text=True, cwd=ROOT_DIR)
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else '未知错误'
+        print(f"跳过 {name} ({rows} 行): {error}", file=sys.stderr)
+        return None
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def print_speedups(results):
+    """打印各提取器相对参考实现的加速比"""
+    by_key = {(item['extractor'], item['rows']): item for item in results}
+    lines = []
+    for item in results:
+        reference = by_key.get((REFERENCES.get(item['extractor']), item['rows']))
+        if reference and reference['seconds'] and item['seconds']:
+            lines.append(f"{item['extractor']:<32} {item['rows']:>9} 行  比 {reference['extractor']} 快 "
+                         f"{reference['seconds'] / item['seconds']:.1f} 倍，峰值RSS {reference['peak_rss_mb']:.1f} -> "
+                         f"{item['peak_rss_mb']:.1f} MB")
+    if lines:
+        print("\n相对参考实现:")
+        print("\n".join(lines))
+
+
+def compare(results, meta, baseline_path, threshold=REGRESSION_THRESHOLD):
+    """与基线对比，返回回退的组合数"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline_report = json.load(f)
+    baseline = {(item['extractor'], item['rows']): item for item in baseline_report['results']}
+    regressions = 0
+    print(f"\n与基线对比: {baseline_path}")
+    for key in ('python', 'platform', 'numpy', 'ratio_443', 'regions', 'delimiter'):
+        if baseline_report['meta'].get(key) != meta.get(key):
+            print(f"注意: 基线的 {key} 为 {baseline_report['meta'].get(key)}，本次为 {meta.get(key)}，结果可能不可比")
+    for item in results:
+        base = baseline.get((item['extractor'], item['rows']))
+        if not base or not base.get('rows_per_sec'):
+            continue
+        ratio = item['rows_per_sec'] / base['rows_per_sec']
+        flag = ''
+        if ratio < 1 - threshold:
+            flag = '  <-- 回退'
+            regressions += 1
+        print(f"{item['extractor']:<32} {item['rows']:>9} 行  速度为基线的 {ratio:.2f} 倍{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='提取热点路径基准测试')
+    parser.add_argument('--sizes', default='10k,100k', help='行数列表，如 10k,100k,1m,10m')
+    parser.add_argument('--extractors', default=','.join(EXTRACTORS), help='要测试的提取器，逗号分隔')
+    parser.add_argument('--ratio-443', type=float, default=0.5, help='端口为443的行所占比例')
+    parser.add_argument('--regions', default=DEFAULT_REGIONS, help='数据中心及权重，如 HKG:3,SIN:2')
+    parser.add_argument('--delimiter', default=',', help='分隔符，如 , ; 或 \\t')
+    parser.add_argument('--repeat', type=int, default=3, help='每个组合计时运行的次数，取最快一次')
+    parser.add_argument('--no-alloc', action='store_true', help='不统计内存分配（大文件时可节省一半时间）')
+    parser.add_argument('--save', metavar='PATH', help='把结果保存为JSON（可作为基线）')
+    parser.add_argument('--compare', metavar='PATH', help='与基线JSON对比，有回退时返回码为1')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD, help='速度低于基线多少比例视为回退')
+    parser.add_argument('--child', nargs=3, metavar=('EXTRACTOR', 'CSV', 'ROWS'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        name, csv_path, rows = args.child
+        child_main(name, csv_path, int(rows), args.repeat, not args.no_alloc)
+        return 0
+
+    delimiter = '\t' if args.delimiter in ('\\t', 'tab') else args.delimiter
+    results = []
+    print(f"{'提取器':<30} {'行数':>9} {'秒':>8} {'行/秒':>10} {'峰值RSS(MB)':>12} {'分配峰值(MB)':>13}")
+    for rows in [parse_size(size) for size in args.sizes.split(',')]:
+        csv_path = dataset_path(rows, args.ratio_443, args.regions, delimiter)
+        for name in args.extractors.split(','):
+            item = run_case(name.strip(), csv_path, rows, args.repeat, not args.no_alloc)
+            if item is None:
+                continue
+            results.append(item)
+            alloc = f"{item['alloc_peak_mb']:.1f}" if item['alloc_peak_mb'] is not None else '-'
+            print(f"{item['extractor']:<32} {rows:>9} {item['seconds']:>8.3f} {item['rows_per_sec']:>10} "
+                  f"{item['peak_rss_mb']:>12.1f} {alloc:>13}")
+
+    print_speedups(results)
+
+    report = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': _module_version('numpy'),
+            'pandas': _module_version('pandas'),
+            'cpu_count': os.cpu_count(),
+            'ratio_443': args.ratio_443,
+            'regions': args.regions,
+            'delimiter': delimiter,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.save}")
+    if args.compare:
+        return 1 if compare(results, report['meta'], args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""生成与频道CSV表头一致的合成测试文件，供基准测试使用
+
+用法:
+    python benchmarks/generate_csv.py out.csv --rows 100000 --ratio-443 0.5 --regions HKG:3,SIN:2,FRA:1 --delimiter ,
+"""
+import argparse
+import csv
+import os
+import random
+
+HEADER = ['IP地址', '端口', 'TLS', '数据中心', '源IP位置', '地区', '城市', '地区(中文)', '国家', '城市(中文)', '国旗', '网络延迟', '下载速度']
+
+# 数据中心 -> (源IP位置, 地区, 城市, 地区(中文), 国家, 城市(中文), 国旗)
+COLO_INFO = {
+    'HKG': ('HK', 'Asia Pacific', 'Hong Kong', '亚洲', '香港', '香港', '🇭🇰'),
+    'SIN': ('SG', 'Asia Pacific', 'Singapore', '亚洲', '新加坡', '新加坡', '🇸🇬'),
+    'NRT': ('JP', 'Asia Pacific', 'Tokyo', '亚洲', '日本', '东京', '🇯🇵'),
+    'ICN': ('KR', 'Asia Pacific', 'Seoul', '亚洲', '韩国', '首尔', '🇰🇷'),
+    'TPE': ('TW', 'Asia Pacific', 'Taipei', '亚洲', '台湾', '台北', '🇹🇼'),
+    'LAX': ('US', 'North America', 'Los Angeles', '北美洲', '美国', '洛杉矶', '🇺🇸'),
+    'FRA': ('DE', 'Europe', 'Frankfurt', '欧洲', '德国', '法兰克福', '🇩🇪'),
+}
+DEFAULT_REGIONS = 'HKG:3,SIN:2,NRT:1,ICN:1,TPE:1,LAX:1,FRA:1'
+OTHER_PORTS = ['8443', '2053', '2083', '2087', '2096', '80', '8080']
+
+
+def parse_regions(text):
+    """解析 "HKG:3,SIN:2" 形式的数据中心权重"""
+    regions = {}
+    for item in text.split(','):
+        colo, _, weight = item.strip().partition(':')
+        colo = colo.upper()
+        if colo not in COLO_INFO:
+            raise ValueError(f"未知的数据中心: {colo}（可选: {', '.join(COLO_INFO)}）")
+        regions[colo] = float(weight or 1)
+    return regions
+
+
+def generate_csv(path, rows, ratio_443=0.5, regions=DEFAULT_REGIONS, delimiter=',', seed=0):
+    """生成rows行数据（不含表头）的CSV文件，返回文件路径"""
+    rng = random.Random(seed)
+    weights = parse_regions(regions) if isinstance(regions, str) else dict(regions)
+    colos = list(weights)
+    colo_weights = [weights[colo] for colo in colos]
+    chunk = 10000
+
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(HEADER)
+        written = 0
+        while written < rows:
+            count = min(chunk, rows - written)
+            picked = rng.choices(colos, colo_weights, k=count)
+            batch = []
+            for colo in picked:
+                ip = f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{rng.randint(0, 255)}.{rng.randint(1, 254)}"
+                port = '443' if rng.random() < ratio_443 else rng.choice(OTHER_PORTS)
+                batch.append([ip, port, 'true', colo, *COLO_INFO[colo],
+                              f"{rng.randint(5, 400)} ms", f"{rng.randint(0, 30000)} kB/s"])
+            writer.writerows(batch)
+            written += count
+    os.replace(temp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成测速CSV文件')
+    parser.add_argument('output', help='输出文件路径')
+    parser.add_argument('--rows', type=int, default=100000, help='数据行数（不含表头）')
+    parser.add_argument('--ratio-443', type=float, default=0.5, help='端口为443的行所占比例')
+    parser.add_argument('--regions', default=DEFAULT_REGIONS, help='数据中心及权重，如 HKG:3,SIN:2')
+    parser.add_argument('--delimiter', default=',', help='分隔符，如 , ; 或 \\t')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子，相同参数生成相同文件')
+    args = parser.parse_args()
+    delimiter = '\t' if args.delimiter in ('\\t', 'tab') else args.delimiter
+    generate_csv(args.output, args.rows, args.ratio_443, args.regions, delimiter, args.seed)
+    print(f"已生成 {args.rows} 行: {args.output}")
+
+
+if __name__ == '__main__':
+    main()
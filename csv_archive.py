@@ -0,0 +1,108 @@
+import gzip
+import io
+import os
+import shutil
+
+from atomic_file import atomic_write
+
+# zstandard 可选：安装后可使用zstd格式归档，读取时也需要它
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+FORMAT_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+SUFFIX_FORMATS = {suffix: name for name, suffix in FORMAT_SUFFIXES.items()}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+CHUNK_SIZE = 1024 * 1024
+
+
+def compression_of(path):
+    """按扩展名判断压缩格式：'gzip'、'zstd'，未压缩时为None"""
+    return SUFFIX_FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def strip_archive_suffix(name):
+    """去掉压缩扩展名，如 a.csv.gz -> a.csv"""
+    return os.path.splitext(name)[0] if compression_of(name) else name
+
+
+def is_csv_name(name):
+    """CSV文件或其压缩归档"""
+    return strip_archive_suffix(name).lower().endswith('.csv')
+
+
+def find_csv_file(folder, filename):
+    """目录中的原始文件或其归档（a.csv、a.csv.gz、a.csv.zst），都不存在时返回None"""
+    for suffix in ('', *FORMAT_SUFFIXES.values()):
+        path = os.path.join(folder, filename + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def open_binary(path):
+    """以二进制流打开，压缩文件边读边解压"""
+    compression = compression_of(path)
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'zstd':
+        if zstandard is None:
+            raise ImportError(f"读取 {os.path.basename(path)} 需要安装zstandard")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
+
+
+def open_text(path, encoding='utf-8', errors='ignore'):
+    """以文本流打开，未压缩的文件直接open；压缩文件只能顺序读取，不支持回退"""
+    if compression_of(path) is None:
+        return open(path, 'r', encoding=encoding, errors=errors)
+    return io.TextIOWrapper(open_binary(path), encoding=encoding, errors=errors)
+
+
+def read_sample(path, size=1024):
+    """读取开头的一段文本（用于识别分隔符），压缩文件只解压这一小段"""
+    with open_text(path) as f:
+        return f.read(size)
+
+
+def iter_line_chunks(path, chunk_size=CHUNK_SIZE):
+    """按块产出解压后的字节，每块都在换行处结束（最后一块除外），正则不会跨块截断一行"""
+    with open_binary(path) as f:
+        remainder = b''
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            cut = chunk.rfind(b'\n') + 1
+            if cut == 0:
+                remainder = chunk
+                continue
+            remainder = chunk[cut:]
+            yield chunk[:cut]
+        if remainder:
+            yield remainder
+
+
+def compress_file(path, archive_format='gzip'):
+    """把文件压缩为 path.gz / path.zst 并删除原文件，保留修改时间，返回归档路径
+
+    gzip头中不写文件名和时间，内容相同的文件压缩结果也相同。归档是原子写出的。
+    """
+    if archive_format not in FORMAT_SUFFIXES:
+        raise ValueError(f"未知的归档格式: {archive_format}")
+    if archive_format == 'zstd' and zstandard is None:
+        raise ImportError("zstd归档需要安装zstandard")
+    archive_path = path + FORMAT_SUFFIXES[archive_format]
+    stat = os.stat(path)
+    with open(path, 'rb') as source, atomic_write(archive_path, 'wb') as target:
+        if archive_format == 'gzip':
+            with gzip.GzipFile(filename='', mode='wb', fileobj=target, compresslevel=GZIP_LEVEL, mtime=0) as compressed:
+                shutil.copyfileobj(source, compressed, CHUNK_SIZE)
+        else:
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(source, target)
+    os.utime(archive_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.remove(path)
+    return archive_path
@@ -0,0 +1,383 @@
+"""IP历史观测库
+
+observations.bin 是只追加的观测日志，每条记录定长（日期、IP、端口、数据中心、延迟、速度），
+可以直接内存映射读取。ip_stats.<代数>.bin 保存每个 (IP, 端口) 的累计指标，每次只用新观测增量更新：
+出现天数、最近64天的出现位图、按天指数衰减的平均速度和延迟、首次/最后出现日期。
+meta.json 记录数据中心编号、已导入的文件、日志的提交位置和当前累计指标文件的代数。
+每次提交先写出新一代累计指标文件，再原子替换 meta.json，替换完成才算提交。
+
+用法:
+    python history_store.py history --colo HKG --days 30 --limit 20
+"""
+import argparse
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import date
+
+# NumPy 可选：可用时直接把内存映射的日志视为结构化数组
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from atomic_file import atomic_write
+from ip_set import int_to_ip, ip_to_int
+
+LOG_FILENAME = 'observations.bin'
+STATS_FILENAME = 'ip_stats.{generation}.bin'
+META_FILENAME = 'meta.json'
+LOG_MAGIC = b'TDOL'
+STATS_MAGIC = b'TDST'
+FORMAT_VERSION = 1
+_HEADER = struct.Struct('<4sHH')  # 魔数, 版本, 每条记录字节数
+# 日期(date.toordinal()), IP, 端口, 数据中心编号, 延迟(ms), 速度(kB/s)；缺失的测量值为NaN
+OBSERVATION = struct.Struct('<IIHHff')
+# IP, 端口, 数据中心编号, 首次出现, 最后出现, 出现天数, 观测次数, 最近64天位图, 衰减基准日,
+# 速度加权和, 速度权重, 延迟加权和, 延迟权重
+_STATS_RECORD = struct.Struct('<IHHIIIIQIdddd')
+WINDOW_BITS = 64
+DEFAULT_DECAY = 0.9  # 每过一天旧观测的权重乘以该系数（半衰期约6.6天）
+NO_COLO = 0xFFFF
+
+if np is not None:
+    OBSERVATION_DTYPE = np.dtype([
+        ('day', '<u4'), ('ip', '<u4'), ('port', '<u2'), ('colo', '<u2'), ('latency', '<f4'), ('speed', '<f4'),
+    ])
+
+
+class IPStats:
+    """单个 (IP, 端口) 的累计指标"""
+
+    __slots__ = ('ip', 'port', 'colo', 'first_seen', 'last_seen', 'days_seen', 'observations',
+                 'day_mask', 'decay_day', 'speed_sum', 'speed_weight', 'latency_sum', 'latency_weight')
+
+    def __init__(self, ip, port, colo=NO_COLO, day=0):
+        self.ip = ip
+        self.port = port
+        self.colo = colo
+        self.first_seen = day
+        self.last_seen = day
+        self.days_seen = 0
+        self.observations = 0
+        self.day_mask = 0  # 第i位表示 last_seen 之前第i天出现过
+        self.decay_day = day
+        self.speed_sum = self.speed_weight = 0.0
+        self.latency_sum = self.latency_weight = 0.0
+
+    def observe(self, day, colo, latency, speed, decay=DEFAULT_DECAY):
+        """加入一条观测；日期可以乱序（补录旧数据），同一天的多条观测只计一天"""
+        self.observations += 1
+        if colo != NO_COLO:
+            self.colo = colo
+        if not self.days_seen:
+            self.first_seen = self.last_seen = self.decay_day = day
+            self.day_mask = 1
+            self.days_seen = 1
+        elif day > self.last_seen:
+            shift = day - self.last_seen
+            self.day_mask = ((self.day_mask << shift) | 1) & ((1 << WINDOW_BITS) - 1) if shift < WINDOW_BITS else 1
+            self.last_seen = day
+            self.days_seen += 1
+        else:
+            offset = self.last_seen - day
+            if offset >= WINDOW_BITS:
+                self.days_seen += 1  # 超出位图范围的补录无法判断是否重复，按新的一天计
+            elif not self.day_mask >> offset & 1:
+                self.day_mask |= 1 << offset
+                self.days_seen += 1
+            self.first_seen = min(self.first_seen, day)
+
+        # 指数衰减平均：把累计值衰减到较新的日期，再按观测的相对新旧加权
+        if day > self.decay_day:
+            factor = decay ** (day - self.decay_day)
+            self.speed_sum *= factor
+            self.speed_weight *= factor
+            self.latency_sum *= factor
+            self.latency_weight *= factor
+            self.decay_day = day
+        weight = decay ** (self.decay_day - day)
+        if not math.isnan(speed):
+            self.speed_sum += speed * weight
+            self.speed_weight += weight
+        if not math.isnan(latency):
+            self.latency_sum += latency * weight
+            self.latency_weight += weight
+
+    def days_in_window(self, today, days):
+        """最近days天（含today，最多64天）中出现的天数"""
+        shift = today - self.last_seen
+        if shift < 0:
+            shift = 0
+        if shift >= days:
+            return 0
+        return bin(self.day_mask & ((1 << min(days - shift, WINDOW_BITS)) - 1)).count('1')
+
+    @property
+    def avg_speed(self):
+        return self.speed_sum / self.speed_weight if self.speed_weight else None
+
+    @property
+    def avg_latency(self):
+        return self.latency_sum / self.latency_weight if self.latency_weight else None
+
+    def pack(self):
+        return _STATS_RECORD.pack(self.ip, self.port, self.colo, self.first_seen, self.last_seen, self.days_seen,
+                                  self.observations, self.day_mask, self.decay_day,
+                                  self.speed_sum, self.speed_weight, self.latency_sum, self.latency_weight)
+
+    @classmethod
+    def unpack(cls, fields):
+        stats = cls.__new__(cls)
+        (stats.ip, stats.port, stats.colo, stats.first_seen, stats.last_seen, stats.days_seen, stats.observations,
+         stats.day_mask, stats.decay_day, stats.speed_sum, stats.speed_weight, stats.latency_sum, stats.latency_weight) = fields
+        return stats
+
+
+class HistoryStore:
+    """历史观测库（目录）
+
+    ingest() 追加一个文件的观测并增量更新累计指标，commit() 写出累计指标和元数据。
+    日志按提交位置截断，中断的导入不会留下重复记录。
+    """
+
+    def __init__(self, folder, decay=DEFAULT_DECAY):
+        self.folder = folder
+        self.decay = decay
+        self.log_path = os.path.join(folder, LOG_FILENAME)
+        self.meta_path = os.path.join(folder, META_FILENAME)
+        os.makedirs(folder, exist_ok=True)
+        self.meta = {'colos': [], 'ingested': {}, 'committed_records': 0, 'last_day': 0, 'generation': 0}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                self.meta.update(json.load(f))
+        self._colo_ids = {colo: index for index, colo in enumerate(self.meta['colos'])}
+        self.stats = self._load_stats()
+        self._remove_stale_stats()
+        self._by_colo = None
+        self._rankings = {}  # (数据中心编号, 端口, 天数, 基准日) -> 排好序的记录，导入新观测时清空
+        self._open_log()
+
+    def _open_log(self):
+        """打开日志用于追加；截掉上次未提交的部分"""
+        committed_size = _HEADER.size + self.meta['committed_records'] * OBSERVATION.size
+        if not os.path.exists(self.log_path):
+            with open(self.log_path, 'wb') as f:
+                f.write(_HEADER.pack(LOG_MAGIC, FORMAT_VERSION, OBSERVATION.size))
+        elif os.path.getsize(self.log_path) != committed_size:
+            with open(self.log_path, 'r+b') as f:
+                f.truncate(committed_size)
+        self._pending_records = 0
+
+    @property
+    def stats_path(self):
+        """已提交的累计指标文件（meta.json 中记录的代数）"""
+        return self._stats_path(self.meta['generation'])
+
+    def _stats_path(self, generation):
+        return os.path.join(self.folder, STATS_FILENAME.format(generation=generation))
+
+    def _load_stats(self):
+        stats = {}
+        if not self.meta['generation']:
+            return stats
+        with open(self.stats_path, 'rb') as f:
+            data = f.read()
+        magic, version, record_size = _HEADER.unpack_from(data)
+        if magic != STATS_MAGIC or version != FORMAT_VERSION or record_size != _STATS_RECORD.size:
+            raise ValueError(f"不支持的累计指标文件: {self.stats_path}")
+        for fields in _STATS_RECORD.iter_unpack(memoryview(data)[_HEADER.size:]):
+            record = IPStats.unpack(fields)
+            stats[(record.ip, record.port)] = record
+        return stats
+
+    def colo_id(self, colo):
+        """数据中心代码 -> 编号，新代码追加到字典末尾"""
+        if not colo:
+            return NO_COLO
+        colo = colo.upper()
+        if colo not in self._colo_ids:
+            self._colo_ids[colo] = len(self.meta['colos'])
+            self.meta['colos'].append(colo)
+        return self._colo_ids[colo]
+
+    def colo_name(self, colo_id):
+        return self.meta['colos'][colo_id] if colo_id != NO_COLO else None
+
+    def is_ingested(self, key):
+        return key in self.meta['ingested']
+
+    def ingest(self, key, day, observations):
+        """导入一个来源（如一个CSV文件）在day这天的观测，同一key只导入一次；返回导入的条数
+
+        observations 为 (ip整数, 端口, 数据中心代码, 延迟ms或None, 速度kB/s或None)。
+        """
+        if self.is_ingested(key):
+            return 0
+        # 先读完所有观测再更新累计指标，读取中途出错时不会留下只导入了一部分的指标
+        rows = [
+            (ip, port, colo, math.nan if latency is None else float(latency), math.nan if speed is None else float(speed))
+            for ip, port, colo, latency, speed in observations
+        ]
+        packed = []
+        for ip, port, colo, latency, speed in rows:
+            colo_id = self.colo_id(colo)
+            packed.append(OBSERVATION.pack(day, ip, port, colo_id, latency, speed))
+            record = self.stats.get((ip, port))
+            if record is None:
+                record = self.stats[(ip, port)] = IPStats(ip, port, colo_id, day)
+            record.observe(day, colo_id, latency, speed, self.decay)
+        with open(self.log_path, 'ab') as f:
+            f.write(b''.join(packed))
+        self._pending_records += len(packed)
+        self.meta['ingested'][key] = {'day': day, 'records': len(packed)}
+        self.meta['last_day'] = max(self.meta['last_day'], day)
+        self._by_colo = None
+        self._rankings = {}
+        return len(packed)
+
+    def commit(self):
+        """写出新一代累计指标文件，再原子替换元数据；替换完成后日志中的新记录才算提交
+
+        累计指标、已导入的文件和日志提交位置只随 meta.json 的替换一起生效，
+        在任何一步中断时下次打开看到的都是上一次提交的一致状态。
+        """
+        generation = self.meta['generation'] + 1
+        stats_path = self._stats_path(generation)
+        with atomic_write(stats_path, 'wb') as f:
+            f.write(_HEADER.pack(STATS_MAGIC, FORMAT_VERSION, _STATS_RECORD.size))
+            f.write(b''.join(record.pack() for record in self.stats.values()))
+        meta = dict(self.meta, generation=generation,
+                    committed_records=self.meta['committed_records'] + self._pending_records)
+        with atomic_write(self.meta_path) as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2, sort_keys=True)
+        self.meta = meta
+        self._pending_records = 0
+        self._remove_stale_stats()
+
+    def _remove_stale_stats(self):
+        """删除不是当前代数的累计指标文件（上次提交前后中断留下的）"""
+        current = self.stats_path if self.meta['generation'] else None
+        for path in glob.glob(os.path.join(glob.escape(self.folder), 'ip_stats.*.bin*')):
+            if path != current:
+                os.remove(path)
+
+    def record_count(self):
+        return self.meta['committed_records'] + self._pending_records
+
+    def read_observations(self, since_day=0):
+        """内存映射读取日志；有numpy时返回结构化数组，否则返回元组列表"""
+        with open(self.log_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size <= _HEADER.size:
+                return np.empty(0, dtype=OBSERVATION_DTYPE) if np is not None else []
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                end = _HEADER.size + self.record_count() * OBSERVATION.size
+                if np is not None:
+                    records = np.frombuffer(mapped, dtype=OBSERVATION_DTYPE, offset=_HEADER.size,
+                                            count=self.record_count()).copy()
+                    return records[records['day'] >= since_day] if since_day else records
+                return [fields for fields in OBSERVATION.iter_unpack(mapped[_HEADER.size:end]) if fields[0] >= since_day]
+
+    def today(self):
+        """查询的基准日：最新导入的日期"""
+        return self.meta['last_day'] or date.today().toordinal()
+
+    def stability_score(self, record, days, today=None):
+        """排序键：窗口内出现天数越多越好，其次平均速度高、延迟低"""
+        today = self.today() if today is None else today
+        speed = record.avg_speed
+        latency = record.avg_latency
+        return (record.days_in_window(today, days),
+                speed if speed is not None else -1.0,
+                -latency if latency is not None else -math.inf)
+
+    def top_ips(self, colo=None, port=443, days=30, limit=20, min_days=1, today=None):
+        """窗口内最稳定的IP，返回字典列表（ip、colo、窗口内天数、累计天数、平均速度/延迟、最后出现日期）"""
+        today = self.today() if today is None else today
+        colo_id = None
+        if colo:
+            colo_id = self._colo_ids.get(colo.upper())
+            if colo_id is None:
+                return []
+        # 同一窗口的排序结果缓存起来，重复查询只需取前limit个
+        cache_key = (colo_id, port, days, today)
+        scored = self._rankings.get(cache_key)
+        if scored is None:
+            candidates = self._colo_index().get(colo_id, []) if colo_id is not None else self.stats.values()
+            scored = [
+                (self.stability_score(record, days, today), record) for record in candidates
+                if record.port == port and today - record.last_seen < days
+            ]
+            scored.sort(key=lambda item: (item[0], -item[1].ip), reverse=True)
+            self._rankings[cache_key] = scored
+        results = []
+        for score, record in scored:
+            if len(results) >= limit or score[0] < min_days:
+                break
+            results.append(self._describe(record, score[0]))
+        return results
+
+    def order_by_stability(self, ip_values, port=443, days=30):
+        """按稳定性从高到低重排IP（整数），没有历史记录的IP排在最后；排序是稳定的"""
+        today = self.today()
+        missing = (-1, -1.0, -math.inf)
+
+        def key(ip):
+            record = self.stats.get((ip, port))
+            return self.stability_score(record, days, today) if record is not None else missing
+
+        return sorted(ip_values, key=key, reverse=True)
+
+    def _colo_index(self):
+        if self._by_colo is None:
+            self._by_colo = {}
+            for record in self.stats.values():
+                self._by_colo.setdefault(record.colo, []).append(record)
+        return self._by_colo
+
+    def _describe(self, record, days_in_window):
+        return {
+            'ip': int_to_ip(record.ip),
+            'port': record.port,
+            'colo': self.colo_name(record.colo),
+            'days_in_window': days_in_window,
+            'days_seen': record.days_seen,
+            'avg_speed_kbps': round(record.avg_speed, 1) if record.avg_speed is not None else None,
+            'avg_latency_ms': round(record.avg_latency, 1) if record.avg_latency is not None else None,
+            'first_seen': date.fromordinal(record.first_seen).isoformat(),
+            'last_seen': date.fromordinal(record.last_seen).isoformat(),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='查询IP历史观测库')
+    parser.add_argument('folder', help='历史观测库目录（HISTORY_DIR）')
+    parser.add_argument('--colo', help='数据中心，如 HKG')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--days', type=int, default=30, help='统计窗口天数（最多64）')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--ip', help='查看单个IP的累计指标')
+    args = parser.parse_args()
+
+    store = HistoryStore(args.folder)
+    start = time.perf_counter()
+    if args.ip:
+        record = store.stats.get((ip_to_int(args.ip), args.port))
+        results = [store._describe(record, record.days_in_window(store.today(), args.days))] if record else []
+    else:
+        results = store.top_ips(args.colo, args.port, args.days, args.limit)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    for item in results:
+        print(json.dumps(item, ensure_ascii=False))
+    print(f"{len(results)} 条结果，{len(store.stats)} 个 (IP, 端口)，{store.record_count()} 条观测，查询耗时 {elapsed_ms:.1f} ms",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
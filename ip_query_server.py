@@ -0,0 +1,369 @@
+"""IP查询服务
+
+加载 telegram_downloader.py 写出的结果快照（RESULTS_FILE / --results），在内存中按
+(数据中心, 端口)、(区域, 端口) 建立按延迟排好序的索引，通过HTTP提供查询：
+
+    GET /ips?colo=HKG&port=443&max_latency=80&limit=20      每行一个IP
+    GET /ips?region=HK&limit=20&format=json                 JSON，含延迟、速度等测量值
+    GET /status                                             快照时间、记录数
+
+响应带ETag，客户端带 If-None-Match 重复请求时内容未变化返回304。快照文件被新一轮运行
+替换后自动重新加载。只依赖标准库。
+
+用法:
+    python ip_query_server.py ip_results.json --host 127.0.0.1 --port 8080
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+from bisect import bisect_right
+from urllib.parse import parse_qsl, urlsplit
+
+from ip_set import ip_to_int
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_RELOAD_INTERVAL = 1.0  # 检查快照文件是否更新的间隔（秒）
+MAX_HEADER_BYTES = 16 * 1024
+MAX_CACHED_RESPONSES = 4096
+KEEPALIVE_TIMEOUT = 30.0
+
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 431: 'Request Header Fields Too Large', 503: 'Service Unavailable'}
+
+
+class QueryError(ValueError):
+    """查询参数无效，返回400"""
+
+
+def effective_latency(record):
+    """排序和 max_latency 过滤用的延迟：有TLS探测结果时取探测值，否则取CSV中的延迟"""
+    if record.get('probe_ms') is not None:
+        return record['probe_ms']
+    return record.get('latency_ms')
+
+
+class ResultIndex:
+    """结果快照的内存索引
+
+    每个索引列表按 (延迟, -速度, IP) 排好序，并保存对应的延迟数组，
+    max_latency 用二分查找截断，limit 直接切片。
+    """
+
+    def __init__(self, snapshot, source_path=None):
+        self.generated_at = snapshot.get('generated_at')
+        self.source_path = source_path
+        self.loaded_at = time.time()
+        records = snapshot.get('records', [])
+
+        def sort_key(record):
+            latency = effective_latency(record)
+            speed = record.get('speed_kbps')
+            return (latency is None, latency if latency is not None else 0.0,
+                    -(speed if speed is not None else 0.0), ip_to_int(record['ip']) or 0)
+
+        self.records = sorted(records, key=sort_key)
+        lists = {}
+        for record in self.records:
+            port = record['port']
+            lists.setdefault(('all', None, port), []).append(record)
+            if record.get('colo'):
+                lists.setdefault(('colo', record['colo'], port), []).append(record)
+            for region in record.get('regions') or ():
+                lists.setdefault(('region', region, port), []).append(record)
+        # 延迟为空的记录排在最后，二分查找时视为无穷大
+        self._lists = {
+            key: (items, [math.inf if effective_latency(item) is None else effective_latency(item) for item in items])
+            for key, items in lists.items()
+        }
+        self.colos = sorted({key[1] for key in lists if key[0] == 'colo'})
+        self.regions = sorted({key[1] for key in lists if key[0] == 'region'})
+        self.ports = sorted({key[2] for key in lists})
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get('version') != 1:
+            raise ValueError(f"不支持的结果快照版本: {snapshot.get('version')}")
+        return cls(snapshot, path)
+
+    def __len__(self):
+        return len(self.records)
+
+    def query(self, colo=None, region=None, port=443, max_latency=None, limit=0):
+        """按条件返回记录列表（延迟从低到高）；colo 和 region 同时给出时取交集"""
+        if colo:
+            key = ('colo', colo.upper(), port)
+        elif region:
+            key = ('region', region.upper(), port)
+        else:
+            key = ('all', None, port)
+        items, latencies = self._lists.get(key, ([], []))
+        end = len(items) if max_latency is None else bisect_right(latencies, max_latency)
+        if colo and region:
+            region = region.upper()
+            matched = (item for item in items[:end] if region in (item.get('regions') or ()))
+            return [item for _, item in zip(range(limit), matched)] if limit else list(matched)
+        if limit:
+            end = min(end, limit)
+        return items[:end]
+
+    def status(self):
+        return {
+            'source': self.source_path,
+            'generated_at': self.generated_at,
+            'loaded_at': self.loaded_at,
+            'records': len(self.records),
+            'ports': self.ports,
+            'colos': self.colos,
+            'regions': self.regions,
+        }
+
+
+def _int_param(params, name, default=None, minimum=0):
+    value = params.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise QueryError(f"{name} 必须是整数: {value}")
+    if number < minimum:
+        raise QueryError(f"{name} 不能小于 {minimum}: {value}")
+    return number
+
+
+def _float_param(params, name):
+    value = params.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise QueryError(f"{name} 必须是数字: {value}")
+    if math.isnan(number):
+        raise QueryError(f"{name} 必须是数字: {value}")
+    return number
+
+
+def make_etag(body):
+    return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match 可以是 *、逗号分隔的多个ETag，弱比较（忽略 W/ 前缀）"""
+    if if_none_match.strip() == '*':
+        return True
+    return any(tag.strip().removeprefix('W/') == etag for tag in if_none_match.split(','))
+
+
+class QueryServer:
+    """基于 asyncio.start_server 的精简HTTP/1.1服务，支持keep-alive
+
+    同一份快照下相同查询的响应体和ETag会缓存起来，重新加载快照时清空。
+    """
+
+    def __init__(self, path, reload_interval=DEFAULT_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.index = None
+        self._signature = None
+        self._responses = {}
+        self._server = None
+        self._watcher = None
+
+    def _file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    async def reload_if_changed(self):
+        """快照文件变化时重新加载；加载失败时继续使用旧索引。返回是否重新加载"""
+        signature = self._file_signature()
+        if signature is None or signature == self._signature:
+            return False
+        try:
+            index = await asyncio.to_thread(ResultIndex.load, self.path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"加载结果快照失败，继续使用旧数据: {e}")
+            self._signature = signature
+            return False
+        self.index = index
+        self._signature = signature
+        self._responses = {}
+        logger.info(f"已加载结果快照 {self.path}: {len(index)} 条记录")
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.reload_interval)
+            await self.reload_if_changed()
+
+    async def start(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        """加载快照并开始监听；port为0时由系统分配，返回实际端口"""
+        await self.reload_if_changed()
+        if self.index is None:
+            logger.warning(f"结果快照 {self.path} 尚不存在或无法加载，加载成功前查询返回503")
+        self._server = await asyncio.start_server(self._handle_connection, host, port, limit=MAX_HEADER_BYTES)
+        self._watcher = asyncio.create_task(self._watch())
+        bound_port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"IP查询服务已启动: http://{host}:{bound_port}/ips")
+        return bound_port
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except asyncio.LimitOverrunError:
+                    writer.write(self._build_response(431, b'', 'text/plain; charset=utf-8', None, False))
+                    break
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                parts = lines[0].split(' ')
+                if len(parts) != 3:
+                    writer.write(self._build_response(400, b'', 'text/plain; charset=utf-8', None, False))
+                    break
+                method, target, version = parts
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(':')
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                # 查询只用GET；带请求体的请求读掉请求体以保持连接可复用
+                length = headers.get('content-length')
+                if length:
+                    if not length.isdigit():
+                        writer.write(self._build_response(400, b'', 'text/plain; charset=utf-8', None, False))
+                        break
+                    await reader.readexactly(int(length))
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+                writer.write(self.respond(method, target, headers.get('if-none-match'), keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def respond(self, method, target, if_none_match=None, keep_alive=True):
+        """处理一个请求，返回完整的响应字节"""
+        if method not in ('GET', 'HEAD'):
+            return self._build_response(405, b'', 'text/plain; charset=utf-8', None, keep_alive)
+        cached = self._responses.get(target)
+        if cached is None:
+            status, body, content_type = self._render(target)
+            cached = (status, body, content_type, make_etag(body) if status == 200 else None)
+            if status == 200:
+                if len(self._responses) >= MAX_CACHED_RESPONSES:
+                    self._responses.clear()
+                self._responses[target] = cached
+        status, body, content_type, etag = cached
+        if etag is not None and if_none_match and etag_matches(if_none_match, etag):
+            return self._build_response(304, b'', None, etag, keep_alive)
+        return self._build_response(status, body, content_type, etag, keep_alive, head_only=method == 'HEAD')
+
+    def _render(self, target):
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        if url.path == '/status':
+            status = self.index.status() if self.index is not None else {'source': self.path, 'records': 0}
+            return 200, json.dumps(status, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8'
+        if url.path != '/ips':
+            return 404, 'not found\n'.encode('utf-8'), 'text/plain; charset=utf-8'
+        if self.index is None:
+            return 503, '结果快照尚未加载\n'.encode('utf-8'), 'text/plain; charset=utf-8'
+        try:
+            output_format = params.get('format', 'text')
+            if output_format not in ('text', 'json'):
+                raise QueryError(f"format 只能是 text 或 json: {output_format}")
+            records = self.index.query(
+                colo=params.get('colo'),
+                region=params.get('region'),
+                port=_int_param(params, 'port', 443, minimum=1),
+                max_latency=_float_param(params, 'max_latency'),
+                limit=_int_param(params, 'limit', 0),
+            )
+        except QueryError as e:
+            return 400, f"{e}\n".encode('utf-8'), 'text/plain; charset=utf-8'
+        if output_format == 'json':
+            return 200, json.dumps(records, ensure_ascii=False).encode('utf-8'), 'application/json; charset=utf-8'
+        return 200, ''.join(f"{record['ip']}\n" for record in records).encode('utf-8'), 'text/plain; charset=utf-8'
+
+    @staticmethod
+    def _build_response(status, body, content_type, etag, keep_alive, head_only=False):
+        lines = [f"HTTP/1.1 {status} {REASONS[status]}"]
+        if status != 304:
+            lines.append(f"Content-Length: {len(body)}")
+        if content_type:
+            lines.append(f"Content-Type: {content_type}")
+        if etag:
+            lines.append(f"ETag: {etag}")
+            lines.append("Cache-Control: no-cache")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        return head if head_only or status == 304 else head + body
+
+
+async def run_server(path, host, port, reload_interval):
+    server = QueryServer(path, reload_interval)
+    await server.start(host, port)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='IP查询服务：从结果快照中按数据中心、区域、端口、延迟查询IP')
+    parser.add_argument('path', nargs='?', default=os.getenv('RESULTS_FILE', 'ip_results.json'),
+                        help='结果快照路径（默认取RESULTS_FILE环境变量，否则为ip_results.json）')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--reload-interval', type=float, default=DEFAULT_RELOAD_INTERVAL,
+                        help='检查快照文件是否更新的间隔秒数')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(run_server(args.path, args.host, args.port, args.reload_interval))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,431 @@
+import re
+import socket
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+
+# NumPy 可选：可用时批量转换和集合运算走向量化路径
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 严格的点分十进制IPv4（不接受前导零以外的简写形式，如 "1.2.3" 或 "0x1.2.3.4"）
+IPV4_PATTERN = re.compile(r'(?:(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])\.){3}(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])')
+# 八位组带前导零的写法（如 "010.001.002.003"），按十进制理解后规范化，见normalize_ip
+_ZERO_PADDED_PATTERN = re.compile(r'([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})')
+
+_ARRAY_TYPE = 'I'  # 32位无符号整数
+
+
+def normalize_ip(ip):
+    """把八位组带前导零的地址规范化（"010.001.002.003" -> "10.1.2.3"，按十进制而不是八进制理解），
+    本来就是规范写法的原样返回，不合法时返回None"""
+    if IPV4_PATTERN.fullmatch(ip):
+        return ip
+    match = _ZERO_PADDED_PATTERN.fullmatch(ip)
+    if not match:
+        return None
+    octets = [int(octet) for octet in match.groups()]
+    if max(octets) > 255:
+        return None
+    return '.'.join(map(str, octets))
+
+
+def ip_to_int(ip):
+    """把IPv4字符串转换为32位整数（前导零按十进制理解），格式不合法时返回None"""
+    if not isinstance(ip, str):
+        return None
+    ip = normalize_ip(ip)
+    if ip is None:
+        return None
+    return int.from_bytes(socket.inet_aton(ip), 'big')
+
+
+def int_to_ip(value):
+    """把32位整数转换为IPv4字符串"""
+    return socket.inet_ntoa(int(value).to_bytes(4, 'big'))
+
+
+def parse_cidr(text):
+    """把 "1.2.3.0/24" 或单个地址 "1.2.3.4" 解析为 (起始整数, 结束整数)，格式不合法时返回None
+
+    主机位不为0的前缀（如 1.2.3.4/24）按所在网段处理。
+    """
+    address, _, prefix = text.strip().partition('/')
+    start = ip_to_int(address)
+    if start is None:
+        return None
+    if not prefix:
+        return start, start
+    if not prefix.isdigit() or int(prefix) > 32:
+        return None
+    size = 1 << (32 - int(prefix))
+    start &= ~(size - 1) & 0xFFFFFFFF
+    return start, start + size - 1
+
+
+def range_to_cidrs(start, end):
+    """把连续区间 [start, end] 拆成最少的对齐CIDR块，返回 [(网络地址整数, 前缀长度)]"""
+    cidrs = []
+    while start <= end:
+        # 块大小受起始地址的对齐和剩余长度共同限制
+        size = start & -start if start else 1 << 32
+        while size > end - start + 1:
+            size >>= 1
+        cidrs.append((start, 33 - size.bit_length()))
+        start += size
+    return cidrs
+
+
+def parse_ips(ips):
+    """批量校验并转换IPv4字符串，返回 (整数array, 无效字符串列表)；带前导零的地址规范化后保留"""
+    valid = []
+    invalid = []
+    fullmatch = IPV4_PATTERN.fullmatch
+    for ip in ips:
+        if fullmatch(ip):
+            valid.append(ip)
+            continue
+        normalized = normalize_ip(ip)
+        if normalized is None:
+            invalid.append(ip)
+        else:
+            valid.append(normalized)
+    packed = b''.join(map(socket.inet_aton, valid))
+    values = array(_ARRAY_TYPE, packed)
+    if sys.byteorder == 'little':
+        values.byteswap()  # inet_aton为网络字节序，小端机器需翻转
+    return values, invalid
+
+
+class IPSet:
+    """不可变的IPv4集合，内部为排序去重后的uint32数组
+
+    每个地址占4字节，按数值排序迭代（2.x 排在 103.x 之前），
+    并支持 | & - 集合运算。元素可以是整数或点分十进制字符串。
+    """
+
+    __slots__ = ('_values',)
+
+    def __init__(self, ips=()):
+        if isinstance(ips, IPSet):
+            self._values = ips._values
+            return
+        ints = []
+        strings = []
+        for ip in ips:
+            (strings if isinstance(ip, str) else ints).append(ip)
+        values = array(_ARRAY_TYPE, ints)
+        if strings:
+            parsed, _ = parse_ips(strings)
+            values.extend(parsed)
+        self._values = _sorted_unique(values)
+
+    @classmethod
+    def from_strings(cls, ips):
+        """从字符串批量构建，忽略不合法的地址"""
+        parsed, _ = parse_ips(ips)
+        return cls._from_sorted(_sorted_unique(parsed))
+
+    @classmethod
+    def union_all(cls, ip_sets):
+        """一次合并多个集合，比逐个 | 更省内存和时间"""
+        values = array(_ARRAY_TYPE)
+        for ip_set in ip_sets:
+            values.extend(IPSet(ip_set)._values)
+        return cls._from_sorted(_sorted_unique(values))
+
+    @classmethod
+    def _from_sorted(cls, values):
+        ip_set = cls.__new__(cls)
+        ip_set._values = values
+        return ip_set
+
+    def __len__(self):
+        return len(self._values)
+
+    def __bool__(self):
+        return len(self._values) > 0
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __contains__(self, ip):
+        value = ip_to_int(ip) if isinstance(ip, str) else ip
+        if value is None:
+            return False
+        index = bisect_left(self._values, value)
+        return index < len(self._values) and self._values[index] == value
+
+    def __eq__(self, other):
+        if not isinstance(other, IPSet):
+            return NotImplemented
+        return self._values == other._values
+
+    def __repr__(self):
+        return f"IPSet({len(self)} 个地址)"
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def union(self, other):
+        return IPSet.union_all([self, other])
+
+    def intersection(self, other):
+        other = IPSet(other)
+        if np is not None:
+            return IPSet._from_sorted(_to_array(np.intersect1d(_as_numpy(self._values), _as_numpy(other._values), assume_unique=True)))
+        other_values = set(other._values)
+        return IPSet._from_sorted(array(_ARRAY_TYPE, (value for value in self._values if value in other_values)))
+
+    def difference(self, other):
+        other = IPSet(other)
+        if np is not None:
+            return IPSet._from_sorted(_to_array(np.setdiff1d(_as_numpy(self._values), _as_numpy(other._values), assume_unique=True)))
+        other_values = set(other._values)
+        return IPSet._from_sorted(array(_ARRAY_TYPE, (value for value in self._values if value not in other_values)))
+
+    def to_strings(self):
+        """按数值顺序返回字符串列表"""
+        return [int_to_ip(value) for value in self._values]
+
+    def ranges(self):
+        """按顺序返回连续地址段 [(起始整数, 结束整数)]"""
+        values = self._values
+        if not len(values):
+            return []
+        if np is not None:
+            array_values = _as_numpy(values).astype(np.int64)
+            breaks = np.flatnonzero(np.diff(array_values) != 1)
+            starts = np.concatenate(([0], breaks + 1))
+            ends = np.concatenate((breaks, [len(values) - 1]))
+            return list(zip(array_values[starts].tolist(), array_values[ends].tolist()))
+        result = []
+        start = previous = values[0]
+        for value in values[1:]:
+            if value != previous + 1:
+                result.append((start, previous))
+                start = value
+            previous = value
+        result.append((start, previous))
+        return result
+
+    def to_cidrs(self):
+        """聚合为覆盖且只覆盖集合中地址的最少CIDR前缀，按地址顺序返回 "a.b.c.d/n" 列表"""
+        return [
+            f"{int_to_ip(network)}/{prefix}"
+            for start, end in self.ranges()
+            for network, prefix in range_to_cidrs(start, end)
+        ]
+
+    def to_bytes(self):
+        """序列化为小端uint32字节串，每个地址4字节"""
+        values = self._values
+        if sys.byteorder != 'little':
+            values = array(_ARRAY_TYPE, values)
+            values.byteswap()
+        return values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """从to_bytes的结果还原，数据本身已排序去重"""
+        values = array(_ARRAY_TYPE)
+        values.frombytes(data)
+        if sys.byteorder != 'little':
+            values.byteswap()
+        return cls._from_sorted(values)
+
+
+class PortBitmap:
+    """每个IP一个端口位图：排序去重的IP数组，加上等长的uint32位图数组
+
+    第i位对应ports[i]，最多32个端口。同一个IP在多个端口出现时只占一个位置，
+    按端口取出IP列表时只需一次掩码运算。
+    """
+
+    __slots__ = ('ports', 'ips', '_bits')
+
+    MAX_PORTS = 32
+
+    def __init__(self, ports, ips=None, bits=None):
+        self.ports = tuple(int(port) for port in ports)
+        if len(self.ports) > self.MAX_PORTS:
+            raise ValueError(f"端口位图最多支持 {self.MAX_PORTS} 个端口")
+        self.ips = ips if ips is not None else IPSet()
+        self._bits = bits if bits is not None else array(_ARRAY_TYPE)
+
+    @classmethod
+    def from_port_sets(cls, ports, port_sets):
+        """由 {端口: IPSet} 构建；ports决定位的顺序，不在ports中的端口忽略"""
+        ports = tuple(int(port) for port in ports)
+        sets = [IPSet(port_sets.get(port, ())) for port in ports]
+        ips = IPSet.union_all(sets)
+        if np is not None:
+            all_values = _as_numpy(ips._values)
+            bits = np.zeros(len(all_values), dtype=np.uint32)
+            for bit, ip_set in enumerate(sets):
+                if ip_set:
+                    bits[np.searchsorted(all_values, _as_numpy(ip_set._values))] |= np.uint32(1 << bit)
+            return cls(ports, ips, _to_array(bits))
+        positions = {value: position for position, value in enumerate(ips._values)}
+        bits = array(_ARRAY_TYPE, bytes(4 * len(ips)))
+        for bit, ip_set in enumerate(sets):
+            for value in ip_set._values:
+                bits[positions[value]] |= 1 << bit
+        return cls(ports, ips, bits)
+
+    @classmethod
+    def union_all(cls, bitmaps):
+        """合并多个端口相同的位图，同一IP的位按位或"""
+        bitmaps = list(bitmaps)
+        if not bitmaps:
+            raise ValueError("至少需要一个端口位图")
+        ports = bitmaps[0].ports
+        if any(bitmap.ports != ports for bitmap in bitmaps):
+            raise ValueError("端口位图的端口不一致，无法合并")
+        if np is not None:
+            values = np.concatenate([_as_numpy(bitmap.ips._values) for bitmap in bitmaps])
+            bits = np.concatenate([_as_numpy(bitmap._bits) for bitmap in bitmaps])
+            unique_values, inverse = np.unique(values, return_inverse=True)
+            merged = np.zeros(len(unique_values), dtype=np.uint32)
+            np.bitwise_or.at(merged, inverse, bits)
+            return cls(ports, IPSet._from_sorted(_to_array(unique_values)), _to_array(merged))
+        combined = {}
+        for bitmap in bitmaps:
+            for value, bit in zip(bitmap.ips._values, bitmap._bits):
+                combined[value] = combined.get(value, 0) | bit
+        values = sorted(combined)
+        return cls(ports, IPSet._from_sorted(array(_ARRAY_TYPE, values)), array(_ARRAY_TYPE, (combined[value] for value in values)))
+
+    def __len__(self):
+        return len(self.ips)
+
+    def __repr__(self):
+        return f"PortBitmap({len(self)} 个地址, 端口 {','.join(map(str, self.ports))})"
+
+    def ports_of(self, ip):
+        """某个IP出现过的端口列表"""
+        value = ip_to_int(ip) if isinstance(ip, str) else ip
+        if value is None:
+            return []
+        values = self.ips._values
+        index = bisect_left(values, value)
+        if index == len(values) or values[index] != value:
+            return []
+        return [port for bit, port in enumerate(self.ports) if self._bits[index] >> bit & 1]
+
+    def ips_with(self, port):
+        """在指定端口上出现过的IP"""
+        mask = 1 << self.ports.index(int(port))
+        if np is not None:
+            values = _as_numpy(self.ips._values)
+            return IPSet._from_sorted(_to_array(values[(_as_numpy(self._bits) & np.uint32(mask)) != 0]))
+        return IPSet._from_sorted(array(_ARRAY_TYPE, (value for value, bits in zip(self.ips._values, self._bits) if bits & mask)))
+
+    def bits_to_bytes(self):
+        """位图数组序列化为小端uint32字节串（IP部分用 ips.to_bytes()）"""
+        bits = self._bits
+        if sys.byteorder != 'little':
+            bits = array(_ARRAY_TYPE, bits)
+            bits.byteswap()
+        return bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, ports, ip_bytes, bit_bytes):
+        bits = array(_ARRAY_TYPE)
+        bits.frombytes(bit_bytes)
+        if sys.byteorder != 'little':
+            bits.byteswap()
+        return cls(ports, IPSet.from_bytes(ip_bytes), bits)
+
+
+class PrefixIndex:
+    """由大量CIDR前缀组成的区间索引，用于白名单/黑名单过滤
+
+    前缀合并为互不重叠的有序区间（起点、终点两个uint32数组），单个地址的判断是一次
+    二分查找，O(log n)；对整个IPSet过滤时有numpy则一次向量化searchsorted。
+    """
+
+    __slots__ = ('_starts', '_ends')
+
+    def __init__(self, prefixes=()):
+        ranges = []
+        for prefix in prefixes:
+            parsed = parse_cidr(prefix) if isinstance(prefix, str) else prefix
+            if parsed is not None:
+                ranges.append(parsed)
+        ranges.sort()
+        starts = array(_ARRAY_TYPE)
+        ends = array(_ARRAY_TYPE)
+        for start, end in ranges:
+            # 与上一区间重叠或相邻时合并
+            if ends and start <= ends[-1] + 1:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        self._starts = starts
+        self._ends = ends
+
+    @classmethod
+    def from_file(cls, path):
+        """读取每行一个前缀或地址的文本文件，忽略空行、#注释和不合法的行"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls(line.split('#', 1)[0].strip() for line in f if line.split('#', 1)[0].strip())
+
+    def __len__(self):
+        """合并后的区间数"""
+        return len(self._starts)
+
+    def __bool__(self):
+        return len(self._starts) > 0
+
+    def __repr__(self):
+        return f"PrefixIndex({len(self)} 个区间)"
+
+    def __contains__(self, ip):
+        value = ip_to_int(ip) if isinstance(ip, str) else ip
+        if value is None:
+            return False
+        index = bisect_right(self._starts, value) - 1
+        return index >= 0 and value <= self._ends[index]
+
+    def address_count(self):
+        """覆盖的地址总数"""
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    def select(self, ip_set, inside=True):
+        """返回ip_set中落在索引内（inside为False时为不在索引内）的地址组成的IPSet"""
+        ip_set = IPSet(ip_set)
+        if not len(self._starts) or not ip_set:
+            return ip_set if not inside else IPSet()
+        if np is not None:
+            values = _as_numpy(ip_set._values)
+            indexes = np.searchsorted(_as_numpy(self._starts), values, side='right') - 1
+            mask = (indexes >= 0) & (values <= _as_numpy(self._ends)[np.maximum(indexes, 0)])
+            if not inside:
+                mask = ~mask
+            return IPSet._from_sorted(_to_array(values[mask]))
+        return IPSet._from_sorted(array(_ARRAY_TYPE, (value for value in ip_set._values if (value in self) == inside)))
+
+
+def _as_numpy(values):
+    return np.frombuffer(values, dtype=np.uint32) if len(values) else np.empty(0, dtype=np.uint32)
+
+
+def _to_array(values):
+    return array(_ARRAY_TYPE, values.astype(np.uint32).tobytes())
+
+
+def _sorted_unique(values):
+    """对uint32数组排序去重"""
+    if np is not None and len(values):
+        return _to_array(np.unique(_as_numpy(values)))
+    return array(_ARRAY_TYPE, sorted(set(values)))
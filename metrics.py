@@ -0,0 +1,125 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from atomic_file import atomic_write
+
+METRIC_PREFIX = 'tgdl'  # Prometheus指标名前缀
+
+
+class RunMetrics:
+    """一次运行的阶段耗时、计数器和数值指标
+
+    stage() 记录每个阶段（可带file等标签）的耗时；add() 累加计数器；
+    set() 记录数值（如各输出文件的IP数）。结果可写成JSON或Prometheus textfile。
+    可在多个线程中使用。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """清空已记录的指标，开始新的一轮统计"""
+        with self._lock:
+            self.started_at = time.time()
+            self._start = time.perf_counter()
+            self.stages = []
+            self.counters = {}
+            self.gauges = {}
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """计时上下文：with metrics.stage('download', file=filename): ..."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start, **labels)
+
+    def record_stage(self, name, seconds, **labels):
+        """记录已在别处测得的阶段耗时（例如子进程中的解析耗时）"""
+        with self._lock:
+            self.stages.append({'stage': name, 'seconds': seconds, 'labels': labels})
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def stage_totals(self):
+        """各阶段的总耗时和次数：{阶段: (秒, 次数)}"""
+        totals = {}
+        for item in self.stages:
+            seconds, count = totals.get(item['stage'], (0.0, 0))
+            totals[item['stage']] = (seconds + item['seconds'], count + 1)
+        return totals
+
+    def to_dict(self):
+        with self._lock:
+            stages = list(self.stages)
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        return {
+            'started_at': self.started_at,
+            'elapsed_seconds': time.perf_counter() - self._start,
+            'stage_totals': {name: {'seconds': seconds, 'count': count} for name, (seconds, count) in self.stage_totals().items()},
+            'stages': stages,
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in counters.items()],
+            'gauges': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in gauges.items()],
+        }
+
+    def to_prometheus(self):
+        """Prometheus textfile格式（node_exporter textfile collector可直接读取）"""
+        data = self.to_dict()
+        lines = []
+
+        def emit(name, metric_type, samples):
+            lines.append(f"# TYPE {METRIC_PREFIX}_{name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{METRIC_PREFIX}_{name}{_format_labels(labels)} {value}")
+
+        emit('run_started_timestamp_seconds', 'gauge', [({}, data['started_at'])])
+        emit('run_duration_seconds', 'gauge', [({}, data['elapsed_seconds'])])
+        emit('stage_duration_seconds_sum', 'gauge', [({'stage': name}, item['seconds']) for name, item in data['stage_totals'].items()])
+        emit('stage_duration_seconds_count', 'gauge', [({'stage': name}, item['count']) for name, item in data['stage_totals'].items()])
+        # 同一阶段和标签重复记录时（如重试的下载）只保留最后一次，textfile中不能有重复的序列
+        last_stages = {}
+        for item in data['stages']:
+            labels = {'stage': item['stage'], **item['labels']}
+            last_stages[tuple(sorted(labels.items()))] = (labels, item['seconds'])
+        emit('stage_last_duration_seconds', 'gauge', list(last_stages.values()))
+        for name in sorted({item['name'] for item in data['counters']}):
+            emit(f"{_metric_name(name)}_total", 'counter', [(item['labels'], item['value']) for item in data['counters'] if item['name'] == name])
+        for name in sorted({item['name'] for item in data['gauges']}):
+            emit(_metric_name(name), 'gauge', [(item['labels'], item['value']) for item in data['gauges'] if item['name'] == name])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """按扩展名原子写出报告：.prom为Prometheus textfile，其他为JSON"""
+        if path.endswith('.prom'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+        with atomic_write(path) as f:
+            f.write(content)
+
+
+def _metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in sorted(labels.items()):
+        text = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{_metric_name(key)}="{text}"')
+    return '{' + ','.join(parts) + '}'
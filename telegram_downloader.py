@@ -1,23 +1,77 @@
+import time
+_MODULE_START = time.perf_counter()  # 用于统计启动耗时，必须在其他导入之前
+
 import os
 import re
 import asyncio
-from telethon import TelegramClient
 import logging
 import csv
 import sys
+import json
+import argparse
+import hashlib
 from datetime import datetime, timedelta, timezone
-import pandas as pd
 import tempfile
+import heapq
+import itertools
+import pickle
+import struct
+import mmap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from atomic_file import atomic_write
+from csv_archive import compress_file, compression_of, find_csv_file, is_csv_name, iter_line_chunks, open_text, read_sample, strip_archive_suffix
+from ip_set import IPSet, PortBitmap, PrefixIndex, int_to_ip, ip_to_int
+from history_store import HistoryStore
+from metrics import RunMetrics
+from tls_probe import order_by_latency, probe_ips
 
 # 配置信息 - 从环境变量获取
 API_ID = os.getenv('TELEGRAM_API_ID')
 API_HASH = os.getenv('TELEGRAM_API_HASH')
 PHONE_NUMBER = os.getenv('TELEGRAM_PHONE')
 CHANNEL_USERNAME = os.getenv('TELEGRAM_CHANNEL')
+CHANNEL_USERNAMES = [name.strip() for name in (CHANNEL_USERNAME or '').split(',') if name.strip()]  # 可用逗号分隔多个频道
+LOCAL_SOURCE_DIRS = [path.strip() for path in os.getenv('LOCAL_SOURCE_DIRS', '').split(',') if path.strip()]  # 额外的本地CSV目录
 DOWNLOAD_FOLDER = 'telegram_downloads'
 IP_FILE = 'ip.txt'
 HK_IP_FILE = 'hkip.txt'
 SG_IP_FILE = 'sgip.txt'  # 新增SG IP文件
+DOWNLOAD_CONCURRENCY = int(os.getenv('DOWNLOAD_CONCURRENCY', '4'))  # 同时下载的文件数
+CHANNEL_STATE_FILENAME = '.channel_state.json'  # 频道游标状态文件，保存在下载目录中
+FULL_RESCAN = os.getenv('FULL_RESCAN', '').lower() in ('1', 'true', 'yes')  # 忽略游标，重新扫描历史消息
+RECENT_DAYS = 3  # 提取最近几天发布的文件
+DOWNLOAD_MANIFEST_FILENAME = '.download_manifest.json'  # 下载缓存清单，保存在下载目录中
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', str(os.cpu_count() or 1)))  # 并行解析CSV的进程数，1为串行
+EXTRACT_BACKEND = os.getenv('EXTRACT_BACKEND', 'csv')  # 提取后端: csv 或 pandas
+VERIFY_CACHED_HASH = os.getenv('VERIFY_CACHED_HASH', '').lower() in ('1', 'true', 'yes')  # 复用缓存文件前校验SHA256
+SCAN_CACHE_DIRNAME = '.scan_cache'  # 每个CSV的提取结果缓存，保存在CSV所在目录中
+SCAN_CACHE = os.getenv('SCAN_CACHE', '1').lower() not in ('0', 'false', 'no')  # 复用未变化文件的提取结果
+PIPELINE = os.getenv('PIPELINE', '').lower() in ('1', 'true', 'yes')  # 边下载边解析
+STARTUP_WARN_SECONDS = float(os.getenv('STARTUP_WARN_SECONDS', '1.0'))  # 启动耗时超过该值时输出警告
+PROBE = os.getenv('PROBE', '').lower() in ('1', 'true', 'yes')  # 发布前重新探测TLS握手
+PROBE_CONCURRENCY = int(os.getenv('PROBE_CONCURRENCY', '500'))  # 同时进行的探测连接数上限
+PROBE_TIMEOUT = float(os.getenv('PROBE_TIMEOUT', '3'))  # 每次连接+握手的超时（秒）
+PROBE_ATTEMPTS = int(os.getenv('PROBE_ATTEMPTS', '2'))  # 每个IP的最多尝试次数
+PROBE_PORT = int(os.getenv('PROBE_PORT', '443'))
+PROBE_SERVER_NAME = os.getenv('PROBE_SERVER_NAME', 'speed.cloudflare.com')  # 握手时的SNI
+PROBE_MODE = os.getenv('PROBE_MODE', 'drop')  # drop: 去掉不可达的IP；demote: 保留但排在区域文件末尾
+WATCH = os.getenv('WATCH', '').lower() in ('1', 'true', 'yes')  # 处理完后保持连接，监听新文件
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE', '30'))  # 监听模式下最后一个文件到达后等待多少秒再处理
+ALLOWLIST_FILE = os.getenv('ALLOWLIST_FILE')  # 白名单前缀文件：只保留落在其中的IP
+DENYLIST_FILE = os.getenv('DENYLIST_FILE')  # 黑名单前缀文件：去掉落在其中的IP（如已知被封锁的ASN网段）
+CIDR_OUTPUT = os.getenv('CIDR_OUTPUT', '').lower() in ('1', 'true', 'yes')  # 额外输出聚合为CIDR前缀的列表
+# 扫描时记录的端口，443总是第一个（ip.txt和区域文件只取443端口）；多于一个端口时另外输出 ip-<端口>.txt
+SCAN_PORTS = tuple(dict.fromkeys([443] + [int(port) for port in os.getenv('SCAN_PORTS', '443').split(',') if port.strip()]))
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '0'))  # 发布超过N天的CSV压缩归档，0为不归档（默认）
+ARCHIVE_FORMAT = os.getenv('ARCHIVE_FORMAT', 'gzip')  # 归档格式: gzip 或 zstd（需要zstandard）
+ARCHIVE_DELETE_AFTER_DAYS = int(os.getenv('ARCHIVE_DELETE_AFTER_DAYS', '0'))  # 超过N天的文件删除，0为永久保留
+HISTORY_DIR = os.getenv('HISTORY_DIR')  # IP历史观测库目录，未设置时不记录历史
+HISTORY_WINDOW_DAYS = int(os.getenv('HISTORY_WINDOW_DAYS', '30'))  # 稳定性按最近多少天的出现天数计算（最多64）
+HISTORY_PREFER_STABLE = os.getenv('HISTORY_PREFER_STABLE', '1').lower() not in ('0', 'false', 'no')  # 区域文件中稳定的IP排在前面
+METRICS_FILE = os.getenv('METRICS_FILE')  # 运行指标报告路径，.prom为Prometheus textfile，否则为JSON
+RESULTS_FILE = os.getenv('RESULTS_FILE')  # 提取结果快照（JSON），供 ip_query_server.py 查询，未设置时不写出
 
 # 设置日志 - 只输出到控制台，不保存文件
 logging.basicConfig(
@@ -27,42 +81,1182 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 本次运行的阶段耗时和计数器
+METRICS = RunMetrics()
+
+# 各区域在索引中对应的键：数据中心(IATA)、源IP位置、国家（均为精确匹配）
+REGION_DEFAULTS = {
+    'HK': {'colos': ['HKG'], 'countries': ['香港']},
+    'SG': {'colos': ['SIN'], 'countries': ['新加坡']},
+    'JP': {'colos': ['NRT', 'KIX', 'FUK', 'OKA'], 'countries': ['日本']},
+    'KR': {'colos': ['ICN'], 'countries': ['韩国']},
+    'TW': {'colos': ['TPE', 'KHH'], 'countries': ['台湾']},
+    'TH': {'colos': ['BKK', 'CNX', 'URT'], 'countries': ['泰国']},
+}
+# 需要输出IP文件的区域，例如 "HK,SG,JP,KR,TW"，输出为 <区域小写>ip.txt
+IP_REGIONS = [code.strip().upper() for code in os.getenv('IP_REGIONS', 'HK,SG').split(',') if code.strip()]
+PREFERRED_FILE_PATTERN = re.compile(r'^Iata([A-Za-z]{2})\.csv-.*-IP\.csv$')  # 区域优选文件，如 IataHK.csv-20251016-IP.csv
+INDEX_FIELDS = ('colo', 'location', 'country')  # 索引键的种类：数据中心、源IP位置、国家
+
+
+def build_region_rules(codes):
+    """根据区域代码生成区域配置；未内置的区域按源IP位置匹配"""
+    rules = {}
+    for code in codes:
+        rule = dict(REGION_DEFAULTS.get(code, {'locations': [code]}))
+        rule['output'] = {'HK': HK_IP_FILE, 'SG': SG_IP_FILE}.get(code, f'{code.lower()}ip.txt')
+        rules[code] = rule
+    return rules
+
+
+def region_index_keys(rule):
+    """区域配置对应的索引键列表，如 [('colo', 'HKG'), ('country', '香港')]"""
+    keys = [('colo', colo.upper()) for colo in rule.get('colos', [])]
+    keys += [('location', location.upper()) for location in rule.get('locations', [])]
+    keys += [('country', country.upper()) for country in rule.get('countries', [])]
+    return keys
+
+
+REGION_RULES = build_region_rules(IP_REGIONS)
+
+IP_PATTERN = re.compile(r'\b(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b')
+
+
+def ip_port_bytes_pattern(ports):
+    """字节级扫描的正则：IP后紧跟 ":端口" 或端口列（",443," / 行尾），字段可带引号；IP的合法性由IPSet再校验
+
+    第1组为IP，第2组或第3组为端口。端口直接写成字面量分支，只匹配关心的端口。
+    """
+    alternatives = b'|'.join(str(port).encode('ascii') for port in ports)
+    return re.compile(
+        rb'(?<![0-9.])([0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3})'
+        rb'(?::(' + alternatives + rb')(?![0-9])|"?,[ \t]*"?(' + alternatives + rb')"?(?=[,\r\n]|\Z))'
+    )
+
+
+IP_443_BYTES_PATTERN = ip_port_bytes_pattern([443])
+PORT_HEADERS = ['port', '端口', 'port_number', '端口号', 'dstport', 'portid']
+IP_HEADERS = ['ip', 'ip地址', 'ip_address', 'address', '地址', 'dstip', 'ipaddr']
+COLO_HEADERS = ['数据中心', 'colo', 'iata', 'datacenter', 'data_center']
+LOCATION_HEADERS = ['源ip位置', 'location', 'src_location', 'ip_location']
+COUNTRY_HEADERS = ['国家', 'country']
+LATENCY_HEADERS = ['网络延迟', '延迟', 'latency', 'delay']
+SPEED_HEADERS = ['下载速度', '速度', 'speed', 'download_speed']
+LATENCY_PATTERN = re.compile(r'([0-9]+(?:\.[0-9]+)?)\s*(ms|s)?', re.IGNORECASE)
+SPEED_PATTERN = re.compile(r'([0-9]+(?:\.[0-9]+)?)\s*([kmg]?)b', re.IGNORECASE)
+SPEED_UNITS = {'': 1 / 1024, 'k': 1, 'm': 1024, 'g': 1024 * 1024}
+RANK_TOP_N = int(os.getenv('RANK_TOP_N', '0'))  # 区域IP文件只保留评分最高的N个，0为不排序不截断
+RANK_SPEED_WEIGHT = float(os.getenv('RANK_SPEED_WEIGHT', '1'))  # 评分 = 速度(kB/s)*速度权重 - 延迟(ms)*延迟权重
+RANK_LATENCY_WEIGHT = float(os.getenv('RANK_LATENCY_WEIGHT', '10'))
+MERGE_CHUNK_ROWS = 100000  # 合并时每个排序分段在内存中保留的最大行数
+PARSE_POOL_MIN_BYTES = 8 * 1024 * 1024  # 待解析文件合计小于该大小时不启动进程池，启动子进程比解析本身还慢
+ADVANCED_SCAN_BATCH = 65536  # 高级解析每批转换为IP集合的匹配数
+
+
+def match_preferred_region(filename, region_rules=None):
+    """根据文件名（IataXX.csv-***-IP.csv）判断是否为已配置区域的优选文件，返回区域名或None"""
+    region_rules = REGION_RULES if region_rules is None else region_rules
+    match = PREFERRED_FILE_PATTERN.match(strip_archive_suffix(filename))
+    if match and match.group(1).upper() in region_rules:
+        return match.group(1).upper()
+    return None
+
+
+def write_json_atomic(path, data):
+    """原子写出缩进、按键排序的JSON（状态文件、下载清单）"""
+    with atomic_write(path) as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def file_sha256(file_path):
+    """计算文件的SHA256"""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def iter_443_ips(csv_file_path):
+    """内存映射文件并在字节上逐个产出443端口IP（bytes），不解码、不整体读入内存"""
+    for ip, _ in iter_port_ips(csv_file_path, pattern=IP_443_BYTES_PATTERN):
+        yield ip
+
+
+def iter_port_ips(csv_file_path, ports=None, pattern=None):
+    """iter_443_ips的多端口版本，逐个产出 (IP, 端口) 两个bytes
+
+    压缩归档无法内存映射，改为流式解压，按整行切块匹配。
+    """
+    pattern = pattern or ip_port_bytes_pattern(ports or SCAN_PORTS)
+    if compression_of(csv_file_path):
+        for chunk in iter_line_chunks(csv_file_path):
+            for match in pattern.finditer(chunk):
+                yield match.group(1), match.group(2) or match.group(3)
+        return
+    with open(csv_file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for match in pattern.finditer(mapped):
+                yield match.group(1), match.group(2) or match.group(3)
+
+
+def parse_latency_ms(text):
+    """解析 "60 ms" 形式的延迟，返回毫秒数；无法解析时返回None"""
+    match = LATENCY_PATTERN.search(text or '')
+    if not match:
+        return None
+    value = float(match.group(1))
+    return value * 1000 if (match.group(2) or '').lower() == 's' else value
+
+
+def parse_speed_kbps(text):
+    """解析 "11877 kB/s" 形式的下载速度，返回kB/s；无法解析时返回None"""
+    match = SPEED_PATTERN.search(text or '')
+    if not match:
+        return None
+    return float(match.group(1)) * SPEED_UNITS[match.group(2).lower()]
+
+
+def score_measurement(latency_ms, speed_kbps):
+    """按配置的权重计算评分，速度越高、延迟越低分数越高；缺少测量值时返回None"""
+    if latency_ms is None or speed_kbps is None:
+        return None
+    return speed_kbps * RANK_SPEED_WEIGHT - latency_ms * RANK_LATENCY_WEIGHT
+
+
+class TopN:
+    """按评分保留前N个IP的有界小顶堆，同一IP只保留最高分
+
+    IP以整数保存；评分相同时数值较小的IP优先，因此结果与插入顺序无关。
+    """
+
+    def __init__(self, size):
+        self.size = size
+        # 堆元素为 (评分, -ip)，堆顶是当前最差的一项
+        self._heap = []
+        self._scores = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, ip, score):
+        old_score = self._scores.get(ip)
+        if old_score is not None:
+            if score > old_score:
+                # 堆很小（几十个），直接原地更新后重新建堆
+                self._heap[self._heap.index((old_score, -ip))] = (score, -ip)
+                heapq.heapify(self._heap)
+                self._scores[ip] = score
+            return
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, (score, -ip))
+            self._scores[ip] = score
+        elif (score, -ip) > self._heap[0]:
+            _, removed = heapq.heapreplace(self._heap, (score, -ip))
+            del self._scores[-removed]
+            self._scores[ip] = score
+
+    def update(self, other):
+        """合并另一个TopN（例如其他文件的结果）"""
+        for ip, score in other._scores.items():
+            self.push(ip, score)
+
+    def ranked(self):
+        """按评分从高到低返回 [(ip整数, score), ...]"""
+        return [(-neg_ip, score) for score, neg_ip in sorted(self._heap, key=lambda item: (-item[0], -item[1]))]
+
+
+def merge_rankings(rankings, size):
+    """把多个TopN合并为一个"""
+    merged = TopN(size)
+    for ranking in rankings:
+        merged.update(ranking)
+    return merged
+
+
+def file_date_key(file_path):
+    """文件的新旧顺序：优先取文件名中的日期（如 -20251016-），否则取修改时间"""
+    match = re.search(r'(20[0-9]{6})', os.path.basename(file_path))
+    if match:
+        return match.group(1)
+    return datetime.fromtimestamp(os.path.getmtime(file_path)).strftime('%Y%m%d')
+
+
+def detect_delimiter(sample):
+    """根据文件开头的样本检测分隔符"""
+    delimiter = ','
+    if ';' in sample and ',' not in sample:
+        delimiter = ';'
+    elif '\t' in sample:
+        delimiter = '\t'
+    return delimiter
+
+
+def _find_column(headers, exact_names, keywords=None):
+    """先按精确列名查找，再按关键字模糊查找，找不到返回None"""
+    for i, header in enumerate(headers):
+        if header in exact_names:
+            return i
+    for i, header in enumerate(headers):
+        if any(keyword in header for keyword in (keywords or [])):
+            return i
+    return None
+
+
+class SchemaError(ValueError):
+    """无法从表头中确定必需的列"""
+
+
+class CsvSchema:
+    """按表头解析出的列索引，同一表头的文件共享同一个实例"""
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.port_index = _find_column(headers, PORT_HEADERS, ['port'])
+        self.ip_index = _find_column(headers, IP_HEADERS, ['ip'])
+        self.colo_index = _find_column(headers, COLO_HEADERS, ['colo', '数据中心'])
+        self.location_index = _find_column(headers, LOCATION_HEADERS)
+        self.country_index = _find_column(headers, COUNTRY_HEADERS)
+        self.latency_index = _find_column(headers, LATENCY_HEADERS, ['latency', '延迟'])
+        self.speed_index = _find_column(headers, SPEED_HEADERS, ['speed', '速度'])
+
+        missing = []
+        if self.port_index is None:
+            missing.append('端口')
+        if self.ip_index is None:
+            missing.append('IP')
+        if missing:
+            raise SchemaError(f"表头中未找到{'/'.join(missing)}列: {','.join(headers)}")
+
+        # 行的长度必须覆盖端口列和IP列
+        self.min_row_length = max(self.port_index, self.ip_index) + 1
+        # 参与索引的列：(索引种类, 列序号)
+        self.index_columns = [
+            (field, index) for field, index in zip(INDEX_FIELDS, (self.colo_index, self.location_index, self.country_index))
+            if index is not None
+        ]
+
+
+# 表头签名 -> CsvSchema（或解析失败时的SchemaError），跨文件复用
+_SCHEMA_CACHE = {}
+
+
+def normalize_headers(row):
+    """表头统一小写、去空白和UTF-8 BOM"""
+    return [header.strip().lstrip('\ufeff').strip().lower() for header in row]
+
+
+def resolve_schema(header_row):
+    """把表头行解析为CsvSchema，相同表头只解析一次；无法解析时抛出SchemaError"""
+    # 签名用元组而不是拼接的字符串，带引号的列名中可能含有分隔符
+    signature = tuple(normalize_headers(header_row))
+    schema = _SCHEMA_CACHE.get(signature)
+    if schema is None:
+        try:
+            schema = CsvSchema(list(signature))
+            logger.info(f"解析表头: {','.join(signature)} -> 端口列{schema.port_index + 1}，IP列{schema.ip_index + 1}")
+        except SchemaError as e:
+            schema = e
+        _SCHEMA_CACHE[signature] = schema
+    if isinstance(schema, SchemaError):
+        raise schema
+    return schema
+
+
+class FileScanResult:
+    """单个CSV文件一次扫描的结果"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.rows_processed = 0
+        self.rows_with_443 = 0
+        self.ips_443 = IPSet()
+        # 倒排索引：(索引种类, 值) -> 443端口IP，如 ('colo', 'HKG')、('country', '香港')
+        self.index = {}
+        # top_n>0时的评分排名：本文件所有443端口行，以及索引中的每个键
+        self.ranking_all = None
+        self.index_rankings = {}
+        # 表头无法解析时记录错误信息
+        self.schema_error = None
+        # 读取或解析中途出错时记录错误信息，这样的结果可能不完整，不写入缓存
+        self.scan_error = None
+        # 本次解析耗时（秒），来自缓存的结果为None
+        self.parse_seconds = None
+        # SCAN_PORTS中各端口出现过的IP（PortBitmap），表头无法解析时为None
+        self.port_bitmap = None
+
+    def lookup(self, keys):
+        """合并多个索引键对应的IP"""
+        return IPSet.union_all(self.index[key] for key in keys if key in self.index)
+
+
+def scan_csv_file(csv_file_path, top_n=0, ports=None):
+    """流式读取一次CSV文件，提取443端口IP并建立数据中心/源IP位置/国家倒排索引
+
+    top_n>0时同时按延迟和速度评分，为整个文件和每个索引键保留前top_n个IP。
+    同一遍扫描中记录ports（默认SCAN_PORTS）中每个端口出现过的IP，结果为端口位图。
+    表头每个文件只解析一次，行处理只做按索引取值和精确键查找。
+    """
+    ports = SCAN_PORTS if ports is None else ports
+    result = FileScanResult(csv_file_path)
+    if top_n:
+        result.ranking_all = TopN(top_n)
+    # 扫描时先收集字符串去重，文件结束后批量转换为IPSet
+    ips_443 = set()
+    index_strings = {}
+    other_port_strings = {str(port): set() for port in ports if port != 443}
+
+    try:
+        # 压缩归档只能顺序读取，分隔符从单独读取的开头一段识别
+        delimiter = detect_delimiter(read_sample(csv_file_path))
+        with open_text(csv_file_path) as file:
+            reader = csv.reader(file, delimiter=delimiter)
+            header_row = next(reader, None)
+            if not header_row:
+                return result
+            result.rows_processed += 1
+
+            try:
+                schema = resolve_schema(header_row)
+            except SchemaError as e:
+                result.schema_error = str(e)
+                logger.error(f"无法解析文件表头，跳过 {os.path.basename(csv_file_path)}: {e}")
+                return result
+
+            port_index = schema.port_index
+            ip_index = schema.ip_index
+            index_columns = schema.index_columns
+            min_row_length = schema.min_row_length
+            search_ip = IP_PATTERN.search
+            rank = bool(top_n) and schema.latency_index is not None and schema.speed_index is not None
+
+            for row in reader:
+                if not row:
+                    continue
+
+                result.rows_processed += 1
+
+                if len(row) < min_row_length:
+                    continue
+                port_value = row[port_index].strip()
+                if port_value != '443':
+                    if port_value in other_port_strings:
+                        ip_match = search_ip(row[ip_index])
+                        if ip_match:
+                            other_port_strings[port_value].add(ip_match.group())
+                    continue
+                result.rows_with_443 += 1
+
+                ip_match = search_ip(row[ip_index])
+                if not ip_match:
+                    continue
+                ip = ip_match.group()
+                ips_443.add(ip)
+
+                score = None
+                if rank and max(schema.latency_index, schema.speed_index) < len(row):
+                    score = score_measurement(parse_latency_ms(row[schema.latency_index]),
+                                              parse_speed_kbps(row[schema.speed_index]))
+                ip_value = ip_to_int(ip) if score is not None else None
+                if ip_value is not None:
+                    result.ranking_all.push(ip_value, score)
+
+                # 同一行写入所有索引键
+                for field, column in index_columns:
+                    if column >= len(row):
+                        continue
+                    value = row[column].strip().upper()
+                    if not value:
+                        continue
+                    key = (field, value)
+                    if key not in index_strings:
+                        index_strings[key] = set()
+                    index_strings[key].add(ip)
+                    if ip_value is not None:
+                        if key not in result.index_rankings:
+                            result.index_rankings[key] = TopN(top_n)
+                        result.index_rankings[key].push(ip_value, score)
+
+        logger.info(f"处理了 {result.rows_processed} 行数据，找到 {result.rows_with_443} 行443端口")
+
+    except Exception as e:
+        logger.error(f"读取CSV文件时出错: {e}")
+        result.scan_error = str(e)
+
+    result.ips_443 = IPSet.from_strings(ips_443)
+    result.index = {key: IPSet.from_strings(ips) for key, ips in index_strings.items()}
+    if result.schema_error is None:
+        port_sets = {int(port): IPSet.from_strings(ips) for port, ips in other_port_strings.items()}
+        port_sets[443] = result.ips_443
+        result.port_bitmap = PortBitmap.from_port_sets(ports, port_sets)
+    return result
+
+
+def _read_header(csv_file_path):
+    """读取文件的分隔符和表头行"""
+    delimiter = detect_delimiter(read_sample(csv_file_path))
+    with open_text(csv_file_path) as file:
+        return delimiter, next(csv.reader(file, delimiter=delimiter), None)
+
+
+def scan_csv_file_pandas(csv_file_path, top_n=0, ports=None):
+    """scan_csv_file的列式版本：一次读入所需列，端口过滤、IP校验、建立索引和评分均为向量化操作
+
+    对格式正常的文件，结果与scan_csv_file完全一致。有pyarrow时使用pyarrow引擎。
+    """
+    import pandas as pd  # 只有选择pandas后端时才导入
+
+    ports = SCAN_PORTS if ports is None else ports
+    result = FileScanResult(csv_file_path)
+    if top_n:
+        result.ranking_all = TopN(top_n)
+
+    try:
+        delimiter, header_row = _read_header(csv_file_path)
+        if not header_row:
+            return result
+        result.rows_processed = 1
+        try:
+            schema = resolve_schema(header_row)
+        except SchemaError as e:
+            result.schema_error = str(e)
+            logger.error(f"无法解析文件表头，跳过 {os.path.basename(csv_file_path)}: {e}")
+            return result
+
+        rank = bool(top_n) and schema.latency_index is not None and schema.speed_index is not None
+        indexes = {schema.port_index, schema.ip_index}
+        indexes.update(column for _, column in schema.index_columns)
+        if rank:
+            indexes.update([schema.latency_index, schema.speed_index])
+        # 按列名读取（pyarrow引擎不接受列序号），表头中的BOM由读取器自行去掉
+        usecols = [header_row[index].lstrip('\ufeff') for index in sorted(indexes)]
+        frame = _read_csv_columns(csv_file_path, delimiter, usecols)
+        names = dict(zip(sorted(indexes), usecols))
+        result.rows_processed = len(frame) + 1
+
+        port_values = frame[names[schema.port_index]].str.strip()
+        selected = frame[port_values == '443']
+        result.rows_with_443 = len(selected)
+
+        ips = selected[names[schema.ip_index]].str.extract(f'(?P<ip>{IP_PATTERN.pattern})', expand=False)
+        valid = ips.notna()
+        result.ips_443 = IPSet.from_strings(ips[valid].unique().tolist())
+
+        # 其他端口：同一次读入的数据按端口分组
+        port_sets = {443: result.ips_443}
+        other_ports = [str(port) for port in ports if port != 443]
+        if other_ports:
+            in_other_ports = port_values.isin(other_ports)
+            other = pd.DataFrame({
+                'port': port_values[in_other_ports],
+                'ip': frame.loc[in_other_ports, names[schema.ip_index]].str.extract(f'(?P<ip>{IP_PATTERN.pattern})', expand=False),
+            }).dropna()
+            for port, group in other.groupby('port', sort=False):
+                port_sets[int(port)] = IPSet.from_strings(group['ip'].unique().tolist())
+        result.port_bitmap = PortBitmap.from_port_sets(ports, port_sets)
+
+        keyed = pd.DataFrame({'ip': ips})
+        for field, column in schema.index_columns:
+            keyed[field] = selected[names[column]].str.strip().str.upper()
+            values = keyed.loc[valid & keyed[field].notna() & (keyed[field] != ''), [field, 'ip']]
+            for value, group in values.groupby(field, sort=False):
+                result.index[(field, value)] = IPSet.from_strings(group['ip'].unique().tolist())
+
+        if rank:
+            keyed['score'] = _score_columns(selected[names[schema.latency_index]], selected[names[schema.speed_index]])
+            scored = keyed[valid & keyed['score'].notna()].copy()
+            # 评分相同时数值较小的IP优先，与TopN一致
+            scored['ip_value'] = [ip_to_int(ip) for ip in scored['ip'].tolist()]
+            scored = scored[scored['ip_value'].notna()].sort_values(['score', 'ip_value'], ascending=[False, True])
+
+            _fill_ranking(result.ranking_all, scored, top_n)
+            for field, _ in schema.index_columns:
+                values = scored[scored[field].notna() & (scored[field] != '')]
+                for value, group in values.groupby(field, sort=False):
+                    result.index_rankings[(field, value)] = _fill_ranking(TopN(top_n), group, top_n)
+
+        logger.info(f"处理了 {result.rows_processed} 行数据，找到 {result.rows_with_443} 行443端口")
+
+    except Exception as e:
+        logger.error(f"读取CSV文件时出错: {e}")
+        result.scan_error = str(e)
+
+    return result
+
+
+def _score_columns(latency_column, speed_column):
+    """向量化解析延迟、速度列并计算评分，无法解析的行为NaN"""
+    latency = latency_column.str.extract(r'(?P<value>[0-9]+(?:\.[0-9]+)?)\s*(?P<unit>(?i:ms|s))?')
+    latency_ms = latency['value'].astype(float)
+    latency_ms = latency_ms.where(latency['unit'].fillna('').str.lower() != 's', latency_ms * 1000)
+    speed = speed_column.str.extract(r'(?P<value>[0-9]+(?:\.[0-9]+)?)\s*(?P<unit>(?i:[kmg]?))(?i:b)')
+    speed_kbps = speed['value'].astype(float) * speed['unit'].str.lower().map(SPEED_UNITS).astype(float)
+    return (speed_kbps * RANK_SPEED_WEIGHT - latency_ms * RANK_LATENCY_WEIGHT).astype(float)
+
+
+def _fill_ranking(ranking, scored, top_n):
+    """scored已按评分降序排好，每个IP取第一次出现（最高分）的前top_n个"""
+    best = scored.drop_duplicates('ip_value').head(top_n)
+    for ip_value, score in zip(best['ip_value'].tolist(), best['score'].tolist()):
+        ranking.push(int(ip_value), score)
+    return ranking
+
+
+def _read_csv_columns(csv_file_path, delimiter, usecols):
+    """以字符串类型读取指定列
+
+    有pyarrow时用pyarrow引擎读成Arrow字符串列，后续的 .str 操作在Arrow中批量执行。
+    """
+    import pandas as pd
+
+    options = dict(sep=delimiter, header=0, usecols=usecols, keep_default_na=False, encoding='utf-8')
+    try:
+        import pyarrow
+    except ImportError:
+        pyarrow = None
+    if pyarrow is not None:
+        try:
+            return pd.read_csv(csv_file_path, engine='pyarrow', dtype=pd.ArrowDtype(pyarrow.string()), **options)
+        except Exception as e:
+            logger.info(f"pyarrow引擎读取失败，改用默认引擎: {e}")
+    return pd.read_csv(csv_file_path, dtype=str, encoding_errors='ignore', on_bad_lines='skip', **options)
+
+
+SCAN_BACKENDS = {
+    'csv': scan_csv_file,
+    'pandas': scan_csv_file_pandas,
+}
+
+
+# 缓存文件格式：头部 (魔数, 版本, 元数据长度) + JSON元数据 + 各IP集合的小端uint32数组
+# 提取逻辑（列识别、IP校验、索引、评分）变化时递增版本号，旧缓存自动失效
+SCAN_CACHE_MAGIC = b'TDSC'
+SCAN_CACHE_VERSION = 5
+_SCAN_CACHE_HEADER = struct.Struct('<4sHI')
+
+
+def scan_cache_path(csv_file_path):
+    """CSV文件对应的提取结果缓存路径"""
+    return os.path.join(os.path.dirname(csv_file_path), SCAN_CACHE_DIRNAME, os.path.basename(csv_file_path) + '.bin')
+
+
+def _scan_cache_params(top_n, backend=None):
+    """影响提取结果的参数，变化时缓存失效；不同后端的结果分开缓存，便于按参数切换后端对比"""
+    return {'backend': backend or EXTRACT_BACKEND, 'top_n': top_n, 'speed_weight': RANK_SPEED_WEIGHT, 'latency_weight': RANK_LATENCY_WEIGHT, 'ports': list(SCAN_PORTS)}
+
+
+def _encode_scan_result(result, stat, sha256, top_n, backend=None):
+    """把FileScanResult编码为缓存文件内容"""
+    index_keys = sorted(result.index)
+    blobs = [result.ips_443.to_bytes()] + [result.index[key].to_bytes() for key in index_keys]
+    if result.port_bitmap is not None:
+        blobs += [result.port_bitmap.ips.to_bytes(), result.port_bitmap.bits_to_bytes()]
+    rankings = {}
+    if result.ranking_all is not None:
+        rankings['all'] = result.ranking_all.ranked()
+        for (field, value), ranking in result.index_rankings.items():
+            rankings[f'{field}:{value}'] = ranking.ranked()
+    meta = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'params': _scan_cache_params(top_n, backend),
+        'rows_processed': result.rows_processed,
+        'rows_with_443': result.rows_with_443,
+        'schema_error': result.schema_error,
+        'index': [[field, value] for field, value in index_keys],
+        'port_bitmap': list(result.port_bitmap.ports) if result.port_bitmap is not None else None,
+        'lengths': [len(blob) for blob in blobs],
+        'rankings': rankings,
+    }
+    meta_bytes = json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return _SCAN_CACHE_HEADER.pack(SCAN_CACHE_MAGIC, SCAN_CACHE_VERSION, len(meta_bytes)) + meta_bytes + b''.join(blobs)
+
+
+def _decode_scan_result(csv_file_path, meta, payload, top_n):
+    """从缓存元数据和IP数组还原FileScanResult"""
+    result = FileScanResult(csv_file_path)
+    result.rows_processed = meta['rows_processed']
+    result.rows_with_443 = meta['rows_with_443']
+    result.schema_error = meta['schema_error']
+
+    blobs = []
+    offset = 0
+    for length in meta['lengths']:
+        blobs.append(payload[offset:offset + length])
+        offset += length
+    result.ips_443 = IPSet.from_bytes(blobs[0])
+    result.index = {(field, value): IPSet.from_bytes(blob) for (field, value), blob in zip(meta['index'], blobs[1:])}
+    if meta['port_bitmap'] is not None:
+        result.port_bitmap = PortBitmap.from_bytes(meta['port_bitmap'], blobs[-2], blobs[-1])
+
+    rankings = meta['rankings']
+    if 'all' in rankings:
+        for name, ranked in rankings.items():
+            ranking = TopN(top_n)
+            for ip, score in ranked:
+                ranking.push(ip, score)
+            if name == 'all':
+                result.ranking_all = ranking
+            else:
+                result.index_rankings[tuple(name.split(':', 1))] = ranking
+    return result
+
+
+def load_scan_cache(csv_file_path, top_n, backend=None):
+    """读取未变化文件的缓存结果，缓存不存在、版本不符或文件已变化时返回None
+
+    文件是否变化由大小和SHA256决定；修改时间一致时跳过SHA256计算。修改时间变化
+    （如重新检出或重新下载了相同内容）时只比较SHA256，不改写缓存文件。
+    """
+    cache_path = scan_cache_path(csv_file_path)
+    try:
+        stat = os.stat(csv_file_path)
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    try:
+        magic, version, meta_length = _SCAN_CACHE_HEADER.unpack_from(data)
+        if magic != SCAN_CACHE_MAGIC or version != SCAN_CACHE_VERSION:
+            return None
+        meta_end = _SCAN_CACHE_HEADER.size + meta_length
+        meta = json.loads(data[_SCAN_CACHE_HEADER.size:meta_end].decode('utf-8'))
+        if meta['params'] != _scan_cache_params(top_n, backend) or meta['size'] != stat.st_size:
+            return None
+        if meta['mtime_ns'] != stat.st_mtime_ns and file_sha256(csv_file_path) != meta['sha256']:
+            return None
+        return _decode_scan_result(csv_file_path, meta, data[meta_end:], top_n)
+    except Exception as e:
+        logger.warning(f"提取结果缓存无效，重新解析 {os.path.basename(csv_file_path)}: {e}")
+        return None
+
+
+def save_scan_cache(csv_file_path, result, top_n, sha256=None, backend=None):
+    """把单个文件的提取结果原子写入缓存；解析出错的结果不缓存"""
+    if result.scan_error is not None:
+        logger.warning(f"解析 {os.path.basename(csv_file_path)} 时出错，不缓存提取结果: {result.scan_error}")
+        return
+    cache_path = scan_cache_path(csv_file_path)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        stat = os.stat(csv_file_path)
+        data = _encode_scan_result(result, stat, sha256 or file_sha256(csv_file_path), top_n, backend)
+        with atomic_write(cache_path, 'wb') as f:
+            f.write(data)
+    except Exception as e:
+        logger.warning(f"写入提取结果缓存失败 {os.path.basename(csv_file_path)}: {e}")
+
+
+def _scan_task(task):
+    """进程池中执行的单文件扫描，task为 (backend, file_path, top_n)"""
+    backend, file_path, top_n = task
+    start = time.perf_counter()
+    result = SCAN_BACKENDS[backend](file_path, top_n)
+    result.parse_seconds = time.perf_counter() - start
+    return result
+
+
+def record_scan_metrics(file_path, result):
+    """把单个文件的解析耗时和行数计入METRICS（解析可能发生在子进程中，因此在主进程中汇总）"""
+    filename = os.path.basename(file_path)
+    if result.parse_seconds is None:
+        METRICS.add('scan_cache_hits')
+        return
+    METRICS.add('scan_cache_misses')
+    METRICS.record_stage('parse', result.parse_seconds, file=filename)
+    METRICS.add('rows_parsed', result.rows_processed)
+    METRICS.add('bytes_parsed', os.path.getsize(file_path) if os.path.exists(file_path) else 0)
+
+
+def _scan_task_cached(task):
+    """执行器中完成单个文件的缓存读取、解析和缓存写入，task为 (backend, file_path, top_n, use_cache)"""
+    backend, file_path, top_n, use_cache = task
+    result = load_scan_cache(file_path, top_n, backend) if use_cache else None
+    if result is not None:
+        logger.info(f"使用缓存的提取结果: {os.path.basename(file_path)}")
+        return result
+    result = _scan_task((backend, file_path, top_n))
+    if use_cache:
+        save_scan_cache(file_path, result, top_n, backend=backend)
+    return result
+
+
+def parse_worker_config():
+    """子进程解析时用到的配置，spawn启动的子进程重新导入本模块，运行时修改过的值需要传过去"""
+    return {'SCAN_PORTS': SCAN_PORTS, 'RANK_SPEED_WEIGHT': RANK_SPEED_WEIGHT, 'RANK_LATENCY_WEIGHT': RANK_LATENCY_WEIGHT}
+
+
+def _init_parse_worker(config):
+    """进程池子进程的初始化：使用主进程的解析配置"""
+    globals().update(config)
+
+
+def make_parse_pool(workers):
+    """解析用的进程池
+
+    子进程用spawn启动：调用方可能在工作线程中，进程里还有telethon和事件循环的线程，
+    从这样的进程fork可能继承被其他线程持有的锁而死锁。
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=_init_parse_worker, initargs=(parse_worker_config(),))
+
+
+def total_file_size(file_paths):
+    """文件合计大小，无法读取的文件按0计（解析时再报告错误）"""
+    total = 0
+    for file_path in file_paths:
+        try:
+            total += os.path.getsize(file_path)
+        except OSError:
+            pass
+    return total
+
+
+def scan_files(csv_files, region_rules=None, backend=None, workers=None, top_n=None, use_cache=None):
+    """扫描所有文件，返回与csv_files顺序一致的 (file_path, 优选区域, FileScanResult) 列表
+
+    启用缓存时，未变化的文件直接使用上次的提取结果，只解析新文件或已变化的文件。
+    workers大于1、待解析文件不止一个且合计不小于PARSE_POOL_MIN_BYTES时使用进程池并行解析，
+    否则在当前进程中逐个解析。
+    """
+    region_rules = REGION_RULES if region_rules is None else region_rules
+    backend = backend or EXTRACT_BACKEND
+    workers = PARSE_WORKERS if workers is None else workers
+    top_n = RANK_TOP_N if top_n is None else top_n
+    use_cache = SCAN_CACHE if use_cache is None else use_cache
+
+    tasks = []
+    regions = []
+    cached = {}
+    for file_path in csv_files:
+        filename = os.path.basename(file_path)
+        region = match_preferred_region(filename, region_rules)
+        regions.append(region)
+        result = load_scan_cache(file_path, top_n, backend) if use_cache else None
+        if result is not None:
+            cached[file_path] = result
+            logger.info(f"使用缓存的提取结果: {filename}")
+            continue
+        logger.info(f"扫描文件: {filename}" + (f" ({region}优选文件)" if region else ""))
+        tasks.append((backend, file_path, top_n))
+
+    if cached:
+        logger.info(f"{len(cached)} 个文件未变化，跳过解析，需要解析 {len(tasks)} 个文件")
+
+    workers = min(workers, len(tasks))
+    if workers > 1 and total_file_size(file_path for _, file_path, _ in tasks) < PARSE_POOL_MIN_BYTES:
+        logger.info(f"待解析的 {len(tasks)} 个文件较小，不启动进程池")
+        workers = 1
+    if workers > 1:
+        logger.info(f"使用 {workers} 个进程并行解析 {len(tasks)} 个文件")
+        try:
+            with make_parse_pool(workers) as executor:
+                # map按提交顺序返回结果，合并顺序与串行一致
+                results = list(executor.map(_scan_task, tasks))
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning(f"进程池不可用，改为串行解析: {e}")
+            results = [_scan_task(task) for task in tasks]
+    else:
+        results = [_scan_task(task) for task in tasks]
+
+    for (_, file_path, _), result in zip(tasks, results):
+        if use_cache:
+            save_scan_cache(file_path, result, top_n, backend=backend)
+        cached[file_path] = result
+    for file_path in csv_files:
+        record_scan_metrics(file_path, cached[file_path])
+    return [(file_path, region, cached[file_path]) for file_path, region in zip(csv_files, regions)]
+
+
+def merge_scan_results(scanned, region_rules=None, top_n=None):
+    """合并scan_files的结果，填充 all 和各区域的IP集合
+
+    区域IP优先取该区域优选文件中的443端口IP；没有优选文件时，
+    在其他文件的倒排索引中查找该区域的数据中心/源IP位置/国家键。区域排名的来源与之相同。
+    返回 (buckets, preferred_files, rankings)：buckets 以 'all' 和区域名为键，SCAN_PORTS多于一个端口时
+    另有 'port:端口' 键；
+    top_n>0时rankings以 'all'、区域名和 '索引种类:值'（如 'colo:HKG'）为键，值为TopN，否则为空。
+    """
+    region_rules = REGION_RULES if region_rules is None else region_rules
+    top_n = RANK_TOP_N if top_n is None else top_n
+    region_keys = {region: region_index_keys(rule) for region, rule in region_rules.items()}
+    all_ips = []
+    preferred_ips = {region: [] for region in region_rules}
+    fallback_ips = {region: [] for region in region_rules}
+    preferred_files = {region: [] for region in region_rules}
+    preferred_rankings = {region: [] for region in region_rules}
+    fallback_rankings = {region: [] for region in region_rules}
+    all_rankings = []
+    index_rankings = {}
+    port_bitmaps = []
+
+    for file_path, region, result in scanned:
+        all_ips.append(result.ips_443)
+        if result.port_bitmap is not None:
+            port_bitmaps.append(result.port_bitmap)
+
+        if region in region_rules:
+            preferred_files[region].append(file_path)
+            preferred_ips[region].append(result.ips_443)
+        else:
+            for name, keys in region_keys.items():
+                fallback_ips[name].append(result.lookup(keys))
+
+        if top_n and result.ranking_all is not None:
+            all_rankings.append(result.ranking_all)
+            if region in region_rules:
+                preferred_rankings[region].append(result.ranking_all)
+            else:
+                for name, keys in region_keys.items():
+                    fallback_rankings[name].extend(result.index_rankings[key] for key in keys if key in result.index_rankings)
+            for key, ranking in result.index_rankings.items():
+                index_rankings.setdefault(key, []).append(ranking)
+
+    rankings = {}
+    if top_n:
+        rankings['all'] = merge_rankings(all_rankings, top_n)
+        for region in region_rules:
+            sources = preferred_rankings[region] if preferred_files[region] else fallback_rankings[region]
+            rankings[region] = merge_rankings(sources, top_n)
+        for (field, value), sources in index_rankings.items():
+            rankings[f'{field}:{value}'] = merge_rankings(sources, top_n)
+
+    # 各文件的结果一次性合并为IPSet
+    buckets = {'all': IPSet.union_all(all_ips)}
+    for region in region_rules:
+        if preferred_files[region]:
+            buckets[region] = IPSet.union_all(preferred_ips[region])
+            logger.info(f"从{region}优选文件提取到 {len(buckets[region])} 个443端口IP")
+        else:
+            buckets[region] = IPSet.union_all(fallback_ips[region])
+            logger.info(f"未找到{region}优选文件，按区域索引提取到 {len(buckets[region])} 个{region}区域443端口IP")
+
+    # 扫描了多个端口时，每个端口一个集合，键为 'port:端口'
+    if port_bitmaps and len(port_bitmaps[0].ports) > 1:
+        merged_ports = PortBitmap.union_all(port_bitmaps)
+        for port in merged_ports.ports:
+            buckets[f'port:{port}'] = merged_ports.ips_with(port)
+        logger.info("各端口IP数: " + ', '.join(f"{port}={len(buckets[f'port:{port}'])}" for port in merged_ports.ports))
+
+    return buckets, preferred_files, rankings
+
+
+def extract_buckets_from_files(csv_files, region_rules=None, backend=None, workers=None, top_n=None, use_cache=None):
+    """对每个文件只扫描一次，同时填充 all 和各区域的IP集合，返回 (buckets, preferred_files, rankings)"""
+    scanned = scan_files(csv_files, region_rules, backend, workers, top_n, use_cache)
+    with METRICS.stage('merge'):
+        return merge_scan_results(scanned, region_rules, top_n)
+
+
+def _write_run(records, run_dir, sort_key):
+    """把一段记录排序后写入临时文件，返回文件路径"""
+    records.sort(key=sort_key)
+    run_path = os.path.join(run_dir, f"run-{len(os.listdir(run_dir))}.pickle")
+    with open(run_path, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return run_path
+
+
+def _read_run(run_path):
+    """逐条读取临时分段文件"""
+    with open(run_path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _external_sort(records, run_dir, sort_key, chunk_rows):
+    """外部排序：每chunk_rows条写一个有序分段，再k路归并；内存只保留一个分段"""
+    run_paths = []
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= chunk_rows:
+            run_paths.append(_write_run(buffer, run_dir, sort_key))
+            buffer = []
+    if buffer:
+        run_paths.append(_write_run(buffer, run_dir, sort_key))
+    return heapq.merge(*(_read_run(path) for path in run_paths), key=sort_key)
+
+
+class MergeHeader:
+    """合并输出的表头：所有输入文件表头的并集
+
+    各文件的列先按用途（IP、端口、数据中心、延迟等，由CsvSchema识别）对齐，再按规范化后的列名对齐，
+    都对不上的列追加到输出表头末尾。列数或列顺序不同的文件合并后每个值仍在同名列下。
+    """
+
+    ROLE_ATTRIBUTES = ('ip_index', 'port_index', 'colo_index', 'location_index', 'country_index', 'latency_index', 'speed_index')
+
+    def __init__(self):
+        self.names = []
+        self.delimiter = None
+        self._by_name = {}
+        self._by_role = {}
+
+    def add(self, header_row, schema, delimiter):
+        """加入一个文件的表头，返回该文件每一列在输出表头中的位置"""
+        if self.delimiter is None:
+            self.delimiter = delimiter
+        roles = {getattr(schema, attr): attr for attr in self.ROLE_ATTRIBUTES if getattr(schema, attr) is not None}
+        positions = []
+        for column, (name, normalized) in enumerate(zip(header_row, normalize_headers(header_row))):
+            role = roles.get(column)
+            position = self._by_role.get(role)
+            if position is None:
+                position = self._by_name.get(normalized)
+            if position is None:
+                position = len(self.names)
+                self.names.append(name.strip().lstrip('\ufeff').strip())
+                self._by_name[normalized] = position
+            if role is not None:
+                self._by_role.setdefault(role, position)
+            positions.append(position)
+        return positions
+
+    def project(self, row, positions):
+        """把一行按positions放到输出表头的对应列，缺少的列为空；超出表头的多余值丢弃"""
+        projected = [''] * len(self.names)
+        for position, value in zip(positions, row):
+            projected[position] = value
+        return projected
+
+
+def _merge_records(csv_files, keep, merge_header, file_positions):
+    """逐文件流式读取，产生 (ip, 端口, 优先级, 速度, 延迟, 原始行, 文件序号) 记录；优先级越小越好
+
+    每个文件的表头加入merge_header，该文件各列在输出中的位置记入 file_positions[文件序号]。
+    """
+    file_ranks = {path: rank for rank, path in enumerate(sorted(csv_files, key=lambda p: (file_date_key(p), p)))}
+
+    for file_id, file_path in enumerate(csv_files):
+        try:
+            delimiter = detect_delimiter(read_sample(file_path))
+            with open_text(file_path) as infile:
+                reader = csv.reader(infile, delimiter=delimiter)
+                header_row = next(reader, None)
+                if not header_row:
+                    continue
+                schema = resolve_schema(header_row)
+                file_positions[file_id] = merge_header.add(header_row, schema, delimiter)
+
+                for row in reader:
+                    if len(row) < schema.min_row_length:
+                        continue
+                    ip = ip_to_int(row[schema.ip_index].strip())
+                    port = row[schema.port_index].strip()
+                    if ip is None or not port.isdigit():
+                        continue
+                    speed = latency = None
+                    if schema.speed_index is not None and schema.speed_index < len(row):
+                        speed = parse_speed_kbps(row[schema.speed_index])
+                    if schema.latency_index is not None and schema.latency_index < len(row):
+                        latency = parse_latency_ms(row[schema.latency_index])
+                    speed = -1.0 if speed is None else speed
+                    latency = float('inf') if latency is None else latency
+                    # 测量值越好优先级越小：速度高优先，其次延迟低
+                    if keep == 'newest':
+                        priority = (-file_ranks[file_path], -speed, latency)
+                    else:
+                        priority = (-speed, latency, -file_ranks[file_path])
+                    yield ip, int(port), priority, speed, latency, row, file_id
+        except Exception as e:
+            logger.error(f"处理文件 {file_path} 时出错: {e}")
+            continue
+
+
+def iter_file_observations(csv_file_path, ports=None):
+    """逐行产出文件中SCAN_PORTS端口的观测 (ip整数, 端口, 数据中心, 延迟ms, 速度kB/s)，供历史观测库导入"""
+    ports = set(SCAN_PORTS if ports is None else ports)
+    delimiter = detect_delimiter(read_sample(csv_file_path))
+    with open_text(csv_file_path) as infile:
+        reader = csv.reader(infile, delimiter=delimiter)
+        header_row = next(reader, None)
+        if not header_row:
+            return
+        schema = resolve_schema(header_row)
+        colo_index = schema.colo_index
+        for row in reader:
+            if len(row) < schema.min_row_length:
+                continue
+            port = row[schema.port_index].strip()
+            if not port.isdigit() or int(port) not in ports:
+                continue
+            ip_match = IP_PATTERN.search(row[schema.ip_index])
+            ip = ip_to_int(ip_match.group()) if ip_match else None
+            if ip is None:
+                continue
+            colo = row[colo_index].strip() if colo_index is not None and colo_index < len(row) else ''
+            latency = parse_latency_ms(row[schema.latency_index]) if schema.latency_index is not None and schema.latency_index < len(row) else None
+            speed = parse_speed_kbps(row[schema.speed_index]) if schema.speed_index is not None and schema.speed_index < len(row) else None
+            yield ip, int(port), colo, latency, speed
+
+
+def record_history(csv_files, history_dir):
+    """把尚未导入的文件追加到历史观测库，增量更新每个IP的累计指标，返回HistoryStore
+
+    每个文件只导入一次（按所在目录和去掉压缩扩展名的文件名识别），观测日期取文件名中的日期。
+    """
+    store = HistoryStore(history_dir)
+    imported = 0
+    with METRICS.stage('history'):
+        for file_path in csv_files:
+            name = strip_archive_suffix(os.path.basename(file_path))
+            key = f"{os.path.basename(os.path.dirname(os.path.abspath(file_path)))}/{name}"
+            if store.is_ingested(key):
+                continue
+            try:
+                day = datetime.strptime(file_date_key(file_path), '%Y%m%d').date().toordinal()
+                imported += store.ingest(key, day, iter_file_observations(file_path))
+            except ValueError as e:
+                # 表头无法解析（SchemaError）或文件名中的日期不合法
+                logger.warning(f"历史观测跳过 {name}: {e}")
+        store.commit()
+    METRICS.add('history_observations', imported)
+    logger.info(f"历史观测库新增 {imported} 条观测，共 {store.record_count()} 条，{len(store.stats)} 个 (IP, 端口)")
+    return store
+
+
+def merge_csv_streaming(csv_files, merged_file_path, keep='best', sort_by=None, chunk_rows=None):
+    """流式合并多个CSV，按 (IP地址, 端口) 去重
+
+    keep='best' 保留速度最快/延迟最低的一行，keep='newest' 保留最新文件中的一行。
+    sort_by为None时按IP和端口排序输出，'speed' 按下载速度降序，'latency' 按网络延迟升序。
+    读取、去重和排序都以外部排序分段进行，内存占用只与chunk_rows有关。
+    输出表头为所有输入表头的并集（见MergeHeader），每行按所在文件的表头放到对应列。
+    返回写入的行数（含表头）。
+    """
+    chunk_rows = chunk_rows or MERGE_CHUNK_ROWS
+    merge_header = MergeHeader()
+    file_positions = {}
+
+    def deduplicate(sorted_records):
+        # 同一 (IP, 端口) 的记录在有序流中相邻，每组只保留优先级最小的一条
+        for _, group in itertools.groupby(sorted_records, key=lambda record: (record[0], record[1])):
+            yield min(group, key=lambda record: record[2])
+
+    with tempfile.TemporaryDirectory(prefix='merge-') as run_dir:
+        key_order = lambda record: (record[0], record[1])
+        # 第一次外部排序在返回前读完所有文件，此后输出表头已经完整
+        deduplicated = deduplicate(_external_sort(_merge_records(csv_files, keep, merge_header, file_positions),
+                                                  run_dir, key_order, chunk_rows))
+
+        if sort_by == 'speed':
+            output_records = _external_sort(deduplicated, run_dir, lambda record: (-record[3], record[0], record[1]), chunk_rows)
+        elif sort_by == 'latency':
+            output_records = _external_sort(deduplicated, run_dir, lambda record: (record[4], record[0], record[1]), chunk_rows)
+        else:
+            output_records = deduplicated
+
+        line_count = 0
+        with open(merged_file_path, 'w', encoding='utf-8', newline='') as outfile:
+            if merge_header.names:
+                writer = csv.writer(outfile, delimiter=merge_header.delimiter)
+                writer.writerow(merge_header.names)
+                line_count += 1
+                for record in output_records:
+                    writer.writerow(merge_header.project(record[5], file_positions[record[6]]))
+                    line_count += 1
+
+    return line_count
+
+
+def csv_document_name(message):
+    """消息附带CSV文档时返回文件名，否则返回None"""
+    if not (message.media and hasattr(message.media, 'document')):
+        return None
+    for attr in message.media.document.attributes:
+        if hasattr(attr, 'file_name'):
+            filename = attr.file_name
+            return filename if filename and filename.lower().endswith('.csv') else None
+    return None
+
+
+def write_lines_if_changed(output_file, lines):
+    """内容与现有文件相同时不重写，返回是否写入；写入是原子的"""
+    content = ''.join(line + '\n' for line in lines)
+    try:
+        with open(output_file, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except OSError:
+        pass
+    with atomic_write(output_file) as f:
+        f.write(content)
+    return True
+
+
 class TelegramDownloader:
-    def __init__(self, api_id, api_hash, phone_number, channel_username):
+    def __init__(self, api_id, api_hash, phone_number, channel_username,
+                 client=None, max_concurrent_downloads=None):
         # 使用临时目录存储session文件，避免Git提交问题
         temp_dir = tempfile.gettempdir()
         self.session_file = os.path.join(temp_dir, 'telegram_session')
-        self.client = TelegramClient(self.session_file, api_id, api_hash)
+        self.api_id = api_id
+        self.api_hash = api_hash
+        # 允许传入现成的客户端（例如测试用的假客户端）；否则在首次使用时才创建
+        self._client = client
         self.phone_number = phone_number
         self.channel_username = channel_username
+        self.max_concurrent_downloads = max(1, max_concurrent_downloads or DOWNLOAD_CONCURRENCY)
+        self._download_semaphore = None
+    
+    def download_semaphore(self):
+        """所有频道共享的下载并发限制；每个事件循环创建一次"""
+        loop = asyncio.get_running_loop()
+        if self._download_semaphore is None or self._download_semaphore[0] is not loop:
+            self._download_semaphore = (loop, asyncio.Semaphore(self.max_concurrent_downloads))
+        return self._download_semaphore[1]
+    
+    @property
+    def client(self):
+        """Telegram客户端，首次访问时才导入telethon，离线处理本地文件时不会触发"""
+        if self._client is None:
+            from telethon import TelegramClient
+            self._client = TelegramClient(self.session_file, self.api_id, self.api_hash)
+        return self._client
         
     async def start(self):
         """启动客户端 - 非交互式版本"""
         try:
             # 尝试直接启动，如果session有效则无需验证
-            await self.client.start(phone=self.phone_number)
+            with METRICS.stage('connect'):
+                await self.client.start(phone=self.phone_number)
             logger.info("客户端启动成功")
             return True
         except Exception as e:
             logger.error(f"启动失败: {e}")
             return False
         
-    async def download_todays_csv_files(self, download_folder):
-        """下载频道中今日发布的所有CSV文件"""
+    async def download_todays_csv_files(self, download_folder, file_queue=None, channel_username=None):
+        """下载频道中今日发布的所有CSV文件（channel_username默认为创建时指定的频道）
+
+        给出file_queue（asyncio.Queue）时，每个文件一就绪就放入队列，供流水线模式边下载边解析。
+        """
+        channel_username = channel_username or self.channel_username
+        
         # 确保下载文件夹存在
         os.makedirs(download_folder, exist_ok=True)
         
         # 获取频道实体
         try:
-            logger.info(f"正在连接频道: {self.channel_username}")
-            channel = await self.client.get_entity(self.channel_username)
+            logger.info(f"正在连接频道: {channel_username}")
+            with METRICS.stage('resolve_channel', channel=channel_username):
+                channel = await self.client.get_entity(channel_username)
             logger.info(f"成功连接到频道: {channel.title}")
         except Exception as e:
             logger.error(f"连接频道失败: {e}")
             # 尝试使用不同的方式连接
             try:
-                channel = await self.client.get_entity(self.channel_username)
-                logger.info(f"第二次尝试成功连接到频道")
+                channel = await self.client.get_entity(channel_username)
+                logger.info("第二次尝试成功连接到频道")
             except Exception as e2:
                 logger.error(f"第二次连接也失败: {e2}")
                 return []
@@ -75,79 +1269,393 @@ class TelegramDownloader:
         logger.info(f"正在查找今天 ({utc_now.date()}) UTC时间发布的CSV文件...")
         logger.info(f"时间范围: {today_start} 到 {today_end}")
         
-        downloaded_files = []
-        csv_count = 0
+        # 读取频道游标：只获取上次处理过的最大消息ID之后的新消息
+        state_path = os.path.join(download_folder, CHANNEL_STATE_FILENAME)
+        state = self.load_channel_state(state_path)
+        channel_state = state['channels'].get(channel_username)
+        three_days_ago = utc_now - timedelta(days=RECENT_DAYS)
+        
+        # 游标之前下载的文件不会再出现在增量消息中，复用前先对照下载清单校验；
+        # 不一致的文件从游标中去掉并把游标归零，本次重新扫描并下载
+        if channel_state and not FULL_RESCAN:
+            damaged = await asyncio.to_thread(self.drop_damaged_files, download_folder, channel_state, three_days_ago)
+            if damaged:
+                logger.warning(f"本地文件与下载清单不一致或已丢失，重新扫描频道: {', '.join(damaged)}")
+        
+        # 不限制条数，由telethon分页获取，直到游标处或遇到最近RECENT_DAYS天之前的消息为止；
+        # 固定条数时新消息一多，较早的新消息不会被取到，游标却会越过它们
+        iter_kwargs = {'limit': None}
+        if channel_state and not FULL_RESCAN:
+            iter_kwargs['min_id'] = channel_state['max_id']
+            logger.info(f"增量获取消息ID大于 {channel_state['max_id']} 的新消息")
+        else:
+            channel_state = {'max_id': 0, 'files': {}}
+            logger.info(f"未找到有效的频道游标，扫描最近{RECENT_DAYS}天的消息")
+        
+        candidates = []
+        max_seen_id = channel_state['max_id']
+        scan_start = time.perf_counter()
         
         try:
-            # 增加消息获取数量
-            async for message in self.client.iter_messages(channel, limit=200):
-                if message.media and hasattr(message.media, 'document'):
-                    document = message.media.document
-                    filename = None
-                    
-                    # 获取文件名
-                    for attr in document.attributes:
-                        if hasattr(attr, 'file_name'):
-                            filename = attr.file_name
-                            break
-                    
-                    # 检查是否为.csv文件
-                    if filename and filename.lower().endswith('.csv'):
-                        # 检查消息日期（转换为UTC时间进行比较）
-                        message_date = message.date
-                        
-                        # 放宽时间限制，获取最近3天的文件
-                        three_days_ago = utc_now - timedelta(days=3)
-                        if message_date >= three_days_ago:
-                            logger.info(f"找到CSV文件 [{message_date}]: {filename}")
-                            csv_count += 1
-                            
-                            file_path = os.path.join(download_folder, filename)
-                            
-                            # 如果文件已存在，跳过下载
-                            if os.path.exists(file_path):
-                                logger.info(f"文件已存在，跳过下载: {filename}")
-                                downloaded_files.append(file_path)
-                                continue
-                            
-                            # 下载文件（添加重试机制）
-                            try:
-                                await self.download_with_retry(message, file_path)
-                                logger.info(f"下载成功: {filename}")
-                                downloaded_files.append(file_path)
-                            except Exception as e:
-                                logger.error(f"下载失败 {filename}: {e}")
-                        else:
-                            logger.debug(f"跳过旧文件 [{message_date}]: {filename}")
-            
-            logger.info(f"总共找到 {csv_count} 个CSV文件（最近3天）")
-            
-            if downloaded_files:
-                logger.info(f"成功下载/找到 {len(downloaded_files)} 个CSV文件")
-            else:
-                logger.info("未找到任何CSV文件")
+            # 消息按从新到旧返回
+            scanned_messages = 0
+            async for message in self.client.iter_messages(channel, **iter_kwargs):
+                # 检查消息日期（转换为UTC时间进行比较）
+                message_date = message.date
                 
-            return downloaded_files
+                # 放宽时间限制，获取最近3天的文件；更早的消息不再处理，停止翻页
+                if message_date < three_days_ago:
+                    logger.debug(f"消息 {message.id} 发布于 [{message_date}]，早于最近{RECENT_DAYS}天，停止获取")
+                    break
+                scanned_messages += 1
+                max_seen_id = max(max_seen_id, message.id)
+                filename = csv_document_name(message)
+                if filename:
+                    logger.info(f"找到CSV文件 [{message_date}]: {filename}")
+                    candidates.append((message, filename))
+            
+            METRICS.record_stage('scan_messages', time.perf_counter() - scan_start, channel=channel_username)
+            METRICS.add('messages_found', len(candidates))
+            logger.info(f"扫描了 {scanned_messages} 条消息，总共找到 {len(candidates)} 个新CSV文件（最近{RECENT_DAYS}天）")
             
         except Exception as e:
             logger.error(f"获取消息时出错: {e}")
             return []
+        
+        # 之前运行中已下载、本次不再下载的文件可以立即开始解析
+        candidate_names = {filename for _, filename in candidates}
+        queued_files = set()
+        if file_queue is not None:
+            for filename, date_text in channel_state['files'].items():
+                file_path = find_csv_file(download_folder, filename)
+                if filename not in candidate_names and file_path and datetime.fromisoformat(date_text) >= three_days_ago:
+                    await file_queue.put(file_path)
+                    queued_files.add(file_path)
+        
+        downloaded_files = await self.download_messages(candidates, download_folder, file_queue)
+        
+        # 更新游标；下载失败的消息不越过，下次运行会重试
+        downloaded_names = {os.path.basename(file_path) for file_path in downloaded_files}
+        failed_ids = [message.id for message, filename in candidates if filename not in downloaded_names]
+        channel_state['max_id'] = min(failed_ids) - 1 if failed_ids else max_seen_id
+        for message, filename in candidates:
+            if filename in downloaded_names:
+                channel_state['files'].setdefault(filename, message.date.isoformat())
+        
+        # 之前运行中已下载、仍在时间范围内的文件也参与提取
+        for filename, date_text in sorted(channel_state['files'].items(), key=lambda item: item[1], reverse=True):
+            file_path = find_csv_file(download_folder, filename)
+            if filename in downloaded_names or not file_path:
+                continue
+            if datetime.fromisoformat(date_text) >= three_days_ago:
+                downloaded_files.append(file_path)
+                if file_queue is not None and file_path not in queued_files:
+                    await file_queue.put(file_path)
+        
+        channel_state['files'] = {
+            filename: date_text for filename, date_text in channel_state['files'].items()
+            if datetime.fromisoformat(date_text) >= three_days_ago
+        }
+        state['channels'][channel_username] = channel_state
+        self.save_channel_state(state_path, state)
+        
+        if downloaded_files:
+            logger.info(f"成功下载/找到 {len(downloaded_files)} 个CSV文件")
+        else:
+            logger.info("未找到任何CSV文件")
+            
+        return downloaded_files
     
-    async def download_with_retry(self, message, file_path, max_retries=3):
-        """带重试机制的文件下载"""
+    async def watch_sources(self, sources, on_change, debounce=None):
+        """监听模式：保持连接，各频道出现新的CSV文档时立即下载，并在安静debounce秒后调用on_change
+
+        on_change(csv_files) 是协程函数，参数为所有来源当前的文件（已去重）；
+        多个文件先后到达时只在最后一个到达debounce秒后处理一次。处理期间到达的文件会再触发一轮。
+        只监听TelegramSource，本地目录来源在每轮处理时重新列出。注册监听后先按频道游标补取一次，
+        上一轮获取之后、开始监听之前发布的文件不会漏掉。
+        """
+        from telethon import events
+        
+        debounce = WATCH_DEBOUNCE if debounce is None else debounce
+        loop = asyncio.get_running_loop()
+        download_lock = asyncio.Lock()
+        pending = {'dirty': False, 'last_event': 0.0, 'task': None}
+        
+        async def process_when_quiet():
+            while pending['dirty']:
+                wait_time = pending['last_event'] + debounce - loop.time()
+                if wait_time > 0:
+                    await asyncio.sleep(wait_time)
+                    continue
+                pending['dirty'] = False
+                try:
+                    files = deduplicate_files(itertools.chain.from_iterable(source.current_files() for source in sources))
+                    await on_change(files)
+                except Exception as e:
+                    logger.error(f"处理新文件时出错: {e}")
+        
+        def mark_changed():
+            pending['dirty'] = True
+            pending['last_event'] = loop.time()
+            if pending['task'] is None or pending['task'].done():
+                pending['task'] = asyncio.create_task(process_when_quiet())
+        
+        def make_handler(source):
+            state_path = os.path.join(source.download_folder, CHANNEL_STATE_FILENAME)
+            
+            async def on_new_message(event):
+                message = event.message
+                filename = csv_document_name(message)
+                if not filename:
+                    return
+                logger.info(f"收到新CSV文件 [{source.name}] [{message.date}]: {filename}")
+                # 串行下载，避免并发读写频道游标和下载清单
+                async with download_lock:
+                    downloaded = await self.download_messages([(message, filename)], source.download_folder)
+                    if not downloaded:
+                        return
+                    self.remember_downloaded_file(state_path, message, filename, source.channel_username)
+                mark_changed()
+            
+            return on_new_message
+        
+        channels = []
+        for source in sources:
+            if isinstance(source, TelegramSource):
+                os.makedirs(source.download_folder, exist_ok=True)
+                channel = await self.client.get_entity(source.channel_username)
+                self.client.add_event_handler(make_handler(source), events.NewMessage(chats=channel))
+                channels.append(source.name)
+        
+        # 补取：首轮获取、提取和发布期间频道里可能已有新文件，此时还没有注册监听
+        for source in sources:
+            if isinstance(source, TelegramSource):
+                try:
+                    async with download_lock:
+                        known = set(source.current_files())
+                        new_files = [path for path in await source.fetch() if path not in known]
+                except Exception as e:
+                    logger.error(f"补取新文件失败 [{source.name}]: {e}")
+                    continue
+                if new_files:
+                    logger.info(f"补取到 {len(new_files)} 个开始监听前发布的新文件 [{source.name}]")
+                    mark_changed()
+        logger.info(f"进入监听模式，等待频道新文件: {', '.join(channels)}（合并间隔 {debounce} 秒）")
+        await self.client.run_until_disconnected()
+    
+    def remember_downloaded_file(self, state_path, message, filename, channel_username=None):
+        """把监听模式中下载的文件记入频道游标状态"""
+        channel_username = channel_username or self.channel_username
+        state = self.load_channel_state(state_path)
+        channel_state = state['channels'].setdefault(channel_username, {'max_id': 0, 'files': {}})
+        channel_state['max_id'] = max(channel_state['max_id'], message.id)
+        channel_state['files'][filename] = message.date.isoformat()
+        self.save_channel_state(state_path, state)
+    
+    def recent_downloaded_files(self, download_folder, channel_username=None):
+        """频道游标中记录的、最近RECENT_DAYS天内发布且仍在本地的文件，按发布时间从新到旧
+
+        与下载清单不一致的文件不返回，并从游标中去掉（游标归零，下次运行重新扫描下载）。
+        """
+        channel_username = channel_username or self.channel_username
+        state_path = os.path.join(download_folder, CHANNEL_STATE_FILENAME)
+        state = self.load_channel_state(state_path)
+        channel_state = state['channels'].get(channel_username, {'max_id': 0, 'files': {}})
+        three_days_ago = datetime.now(timezone.utc) - timedelta(days=RECENT_DAYS)
+        damaged = self.drop_damaged_files(download_folder, channel_state, three_days_ago)
+        if damaged:
+            logger.warning(f"本地文件与下载清单不一致或已丢失，下次运行重新下载: {', '.join(damaged)}")
+            self.save_channel_state(state_path, state)
+        files = []
+        for filename, date_text in sorted(channel_state['files'].items(), key=lambda item: item[1], reverse=True):
+            file_path = find_csv_file(download_folder, filename)
+            if file_path and datetime.fromisoformat(date_text) >= three_days_ago:
+                files.append(file_path)
+        return files
+    
+    def drop_damaged_files(self, download_folder, channel_state, since):
+        """校验游标中记录的、since之后发布的文件与下载清单是否一致（大小，VERIFY_CACHED_HASH时还有SHA256）
+
+        不一致、已丢失或清单中没有记录的文件从channel_state中去掉，并把游标归零，
+        下次扫描会重新获取这些消息并重新下载。返回去掉的文件名。
+        """
+        manifest = self.load_download_manifest(os.path.join(download_folder, DOWNLOAD_MANIFEST_FILENAME))
+        damaged = [
+            filename for filename, date_text in channel_state['files'].items()
+            if datetime.fromisoformat(date_text) >= since
+            and not self.matches_manifest(find_csv_file(download_folder, filename), manifest.get(filename))
+        ]
+        for filename in damaged:
+            del channel_state['files'][filename]
+        if damaged:
+            channel_state['max_id'] = 0
+        return damaged
+    
+    def matches_manifest(self, file_path, entry):
+        """本地文件是否与下载清单中的记录一致"""
+        if file_path is None or entry is None:
+            return False
+        if compression_of(file_path) is not None:
+            # 归档后的文件已不是下载时的字节，无法对照清单（最近几天的文件不会被归档）
+            return True
+        if os.path.getsize(file_path) != entry['size']:
+            return False
+        if VERIFY_CACHED_HASH and entry.get('sha256'):
+            return file_sha256(file_path) == entry['sha256']
+        return True
+    
+    def load_channel_state(self, state_path):
+        """读取频道游标状态，文件缺失或损坏时返回空状态（触发全量扫描）"""
+        empty_state = {'version': 1, 'channels': {}}
+        if not os.path.exists(state_path):
+            return empty_state
+        try:
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            for channel_state in state['channels'].values():
+                int(channel_state['max_id'])
+                for date_text in channel_state['files'].values():
+                    datetime.fromisoformat(date_text)
+            return state
+        except Exception as e:
+            logger.warning(f"频道游标状态文件无效，将全量扫描: {e}")
+            return empty_state
+    
+    def save_channel_state(self, state_path, state):
+        """原子写入频道游标状态"""
+        try:
+            write_json_atomic(state_path, state)
+        except Exception as e:
+            logger.error(f"保存频道游标状态失败: {e}")
+    
+    async def download_messages(self, candidates, download_folder, file_queue=None):
+        """并发下载 (message, filename) 列表，同一下载器上的所有下载（包括多个频道）共享 max_concurrent_downloads 的并发上限
+
+        返回成功下载或已存在的文件路径，顺序与candidates一致。
+        给出file_queue时，每个文件完成后立即放入队列（队列满时等待，形成背压）。
+        """
+        semaphore = self.download_semaphore()
+        manifest_path = os.path.join(download_folder, DOWNLOAD_MANIFEST_FILENAME)
+        manifest = self.load_download_manifest(manifest_path)
+        
+        async def download_one(message, filename):
+            file_path = await fetch_one(message, filename)
+            if file_path and file_queue is not None:
+                await file_queue.put(file_path)
+            return file_path
+        
+        async def fetch_one(message, filename):
+            file_path = os.path.join(download_folder, filename)
+            document = message.media.document
+            
+            # 缓存文件与清单中的文档ID和大小一致时直接复用
+            if await self.is_cached_download(file_path, document, manifest.get(filename)):
+                logger.info(f"文件已缓存，跳过下载: {filename}")
+                METRICS.add('downloads', result='cached')
+                if filename not in manifest:
+                    manifest[filename] = {
+                        'document_id': document.id,
+                        'size': document.size,
+                        'sha256': await asyncio.to_thread(file_sha256, file_path),
+                    }
+                return file_path
+            
+            if os.path.exists(file_path):
+                logger.warning(f"缓存文件不完整或已变化，重新下载: {filename}")
+            
+            # 先下载到临时文件，校验大小后再原子替换（添加重试机制）
+            temp_path = file_path + '.part'
+            async with semaphore:
+                try:
+                    with METRICS.stage('download', file=filename):
+                        await self.download_with_retry(message, temp_path, expected_size=document.size)
+                    sha256 = await asyncio.to_thread(file_sha256, temp_path)
+                    os.replace(temp_path, file_path)
+                    manifest[filename] = {'document_id': document.id, 'size': document.size, 'sha256': sha256}
+                    METRICS.add('downloads', result='ok')
+                    METRICS.add('bytes_downloaded', document.size)
+                    logger.info(f"下载成功: {filename}")
+                    return file_path
+                except Exception as e:
+                    METRICS.add('downloads', result='failed')
+                    logger.error(f"下载失败 {filename}: {e}")
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    return None
+        
+        # 同名文件只下载一次（保留最新的消息），避免并发写同一个文件
+        unique_candidates = []
+        seen_filenames = set()
+        for message, filename in candidates:
+            if filename not in seen_filenames:
+                seen_filenames.add(filename)
+                unique_candidates.append((message, filename))
+        
+        logger.info(f"开始下载 {len(unique_candidates)} 个CSV文件（并发数 {self.max_concurrent_downloads}）")
+        results = await asyncio.gather(*(download_one(message, filename) for message, filename in unique_candidates))
+        
+        try:
+            write_json_atomic(manifest_path, manifest)
+        except Exception as e:
+            logger.error(f"保存下载缓存清单失败: {e}")
+        
+        return [file_path for file_path in results if file_path]
+    
+    def load_download_manifest(self, manifest_path):
+        """读取下载缓存清单：文件名 -> 文档ID、大小、SHA256；缺失或损坏时返回空清单"""
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            return {
+                filename: entry for filename, entry in manifest.items()
+                if isinstance(entry, dict) and {'document_id', 'size'} <= entry.keys()
+            }
+        except Exception as e:
+            logger.warning(f"下载缓存清单无效，将重新校验所有文件: {e}")
+            return {}
+    
+    async def is_cached_download(self, file_path, document, entry):
+        """判断本地文件是否为该文档的完整副本"""
+        if not os.path.exists(file_path):
+            return False
+        actual_size = os.path.getsize(file_path)
+        if entry is None:
+            # 清单出现之前下载的文件：大小与文档一致才认可
+            return actual_size == document.size
+        if entry['document_id'] != document.id or entry['size'] != document.size or actual_size != document.size:
+            return False
+        if VERIFY_CACHED_HASH and entry.get('sha256'):
+            return await asyncio.to_thread(file_sha256, file_path) == entry['sha256']
+        return True
+    
+    async def download_with_retry(self, message, file_path, max_retries=3, expected_size=None):
+        """带重试机制的文件下载，给出expected_size时校验下载后的文件大小"""
         for attempt in range(max_retries):
             try:
                 await self.client.download_media(message, file=file_path)
+                if expected_size is not None and os.path.getsize(file_path) != expected_size:
+                    raise IOError(f"文件大小不符: {os.path.getsize(file_path)} != {expected_size}")
                 return True
             except Exception as e:
                 if attempt == max_retries - 1:
                     raise e
+                METRICS.add('download_retries')
                 wait_time = 2 ** attempt  # 指数退避
+                # Telegram限流（FloodWaitError）时按服务器要求的秒数等待
+                if type(e).__name__ == 'FloodWaitError':
+                    METRICS.add('flood_waits')
+                    wait_time = max(wait_time, getattr(e, 'seconds', 0))
                 logger.warning(f"下载失败，{wait_time}秒后重试 (尝试 {attempt + 1}/{max_retries}): {e}")
                 await asyncio.sleep(wait_time)
     
-    def merge_csv_files(self, csv_files, output_filename='merged.csv'):
-        """合并多个CSV文件"""
+    def merge_csv_files(self, csv_files, output_filename='merged.csv', keep='best', sort_by=None):
+        """合并多个CSV文件，按 (IP地址, 端口) 去重
+
+        keep为 'best'（保留测速最好的一行）或 'newest'（保留最新文件中的一行），
+        sort_by为 None、'speed' 或 'latency'，见 merge_csv_streaming。
+        """
         if not csv_files:
             logger.info("没有CSV文件可合并")
             return None
@@ -160,52 +1668,13 @@ class TelegramDownloader:
         
         try:
             merged_file_path = os.path.join(os.path.dirname(csv_files[0]), output_filename)
-            
-            # 使用简单的合并方式，保留所有数据
-            with open(merged_file_path, 'w', encoding='utf-8', newline='') as outfile:
-                writer = None
-                header_written = False
-                
-                for i, file_path in enumerate(csv_files):
-                    try:
-                        logger.info(f"处理文件 {i+1}/{len(csv_files)}: {os.path.basename(file_path)}")
-                        
-                        with open(file_path, 'r', encoding='utf-8', errors='ignore') as infile:
-                            # 检测分隔符
-                            sample = infile.read(1024)
-                            infile.seek(0)
-                            
-                            delimiter = ','
-                            if ';' in sample and ',' not in sample:
-                                delimiter = ';'
-                            elif '\t' in sample:
-                                delimiter = '\t'
-                            
-                            reader = csv.reader(infile, delimiter=delimiter)
-                            
-                            for row_num, row in enumerate(reader):
-                                if not row:
-                                    continue
-                                
-                                # 写入表头（只写一次）
-                                if not header_written:
-                                    writer = csv.writer(outfile, delimiter=delimiter)
-                                    writer.writerow(row)
-                                    header_written = True
-                                elif row_num > 0:  # 跳过后续文件的表头
-                                    writer.writerow(row)
-                                        
-                    except Exception as e:
-                        logger.error(f"处理文件 {file_path} 时出错: {e}")
-                        continue
+            # 合并结果本身不作为输入，避免重复计数
+            input_files = [path for path in csv_files if os.path.abspath(path) != os.path.abspath(merged_file_path)]
+            with METRICS.stage('merge_csv'):
+                line_count = merge_csv_streaming(input_files, merged_file_path, keep=keep, sort_by=sort_by)
             
             logger.info(f"成功合并CSV文件: {merged_file_path}")
-            
-            # 显示合并后的文件信息
-            if os.path.exists(merged_file_path):
-                with open(merged_file_path, 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    logger.info(f"合并后的文件包含 {len(lines)} 行数据")
+            logger.info(f"合并后的文件包含 {line_count} 行数据")
             
             return merged_file_path
             
@@ -214,26 +1683,26 @@ class TelegramDownloader:
             return None
     
     def find_region_preferred_files(self, csv_files):
-        """查找优先处理的区域文件：IataHK.csv-***-IP.csv 和 IataSG.csv-***-IP.csv"""
-        hk_files = []
-        sg_files = []
+        """查找各区域的优选文件（IataXX.csv-***-IP.csv），返回 ({区域: 文件列表}, 其他文件列表)"""
+        preferred_files = {region: [] for region in REGION_RULES}
         other_files = []
         
         for file_path in csv_files:
             filename = os.path.basename(file_path)
-            # 匹配 IataHK.csv-***-IP.csv 格式
-            if re.match(r'^IataHK\.csv-.*-IP\.csv$', filename):
-                hk_files.append(file_path)
-                logger.info(f"找到HK优选文件: {filename}")
-            # 匹配 IataSG.csv-***-IP.csv 格式
-            elif re.match(r'^IataSG\.csv-.*-IP\.csv$', filename):
-                sg_files.append(file_path)
-                logger.info(f"找到SG优选文件: {filename}")
+            region = match_preferred_region(filename)
+            if region:
+                preferred_files[region].append(file_path)
+                logger.info(f"找到{region}优选文件: {filename}")
             else:
                 other_files.append(file_path)
         
-        logger.info(f"找到 {len(hk_files)} 个HK优选文件，{len(sg_files)} 个SG优选文件，{len(other_files)} 个其他文件")
-        return hk_files, sg_files, other_files
+        counts = '，'.join(f"{len(files)} 个{region}优选文件" for region, files in preferred_files.items())
+        logger.info(f"找到 {counts}，{len(other_files)} 个其他文件")
+        return preferred_files, other_files
+    
+    def extract_all_buckets(self, csv_files, region_rules=None, backend=None, workers=None, top_n=None, use_cache=None):
+        """单次扫描所有CSV文件，同时填充所有443端口IP、各区域IP和评分排名"""
+        return extract_buckets_from_files(csv_files, region_rules, backend, workers, top_n, use_cache)
     
     def extract_443_ips_from_csv(self, csv_file_path):
         """从CSV文件中提取端口列明确为443的IP地址"""
@@ -241,291 +1710,716 @@ class TelegramDownloader:
             logger.error(f"CSV文件不存在: {csv_file_path}")
             return []  # 返回空列表
         
-        ip_addresses = set()
-        rows_processed = 0
-        rows_with_443 = 0
-        
-        try:
-            with open(csv_file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                sample = file.read(1024)
-                file.seek(0)
-                
-                delimiter = ','
-                if ';' in sample and ',' not in sample:
-                    delimiter = ';'
-                elif '\t' in sample:
-                    delimiter = '\t'
-                
-                reader = csv.reader(file, delimiter=delimiter)
-                headers = None
-                
-                for row_num, row in enumerate(reader, 1):
-                    if not row:
-                        continue
-                    
-                    rows_processed += 1
-                    
-                    if row_num == 1:
-                        headers = [header.strip().lower() for header in row]
-                        logger.info(f"检测到表头: {headers}")
-                        continue
-                    
-                    # 查找端口列
-                    port_column_index = None
-                    for i, header in enumerate(headers):
-                        if header in ['port', '端口', 'port_number', '端口号', 'dstport', 'portid']:
-                            port_column_index = i
-                            break
-                    
-                    # 如果没找到端口列，尝试其他常见列名
-                    if port_column_index is None:
-                        for i, header in enumerate(headers):
-                            if 'port' in header:
-                                port_column_index = i
-                                break
-                    
-                    if port_column_index is None and len(row) > 1:
-                        port_column_index = len(row) - 1  # 假设最后一列
-                        logger.info(f"未找到明确的端口列，假设第{port_column_index + 1}列为端口列")
-                    
-                    # 检查是否为443端口
-                    is_443_port = False
-                    if port_column_index is not None and port_column_index < len(row):
-                        port_value = str(row[port_column_index]).strip()
-                        if port_value == '443':
-                            is_443_port = True
-                            rows_with_443 += 1
-                    
-                    if is_443_port:
-                        # 查找IP列
-                        ip_column_index = None
-                        for i, header in enumerate(headers):
-                            if header in ['ip', 'ip地址', 'ip_address', 'address', '地址', 'dstip', 'ipaddr']:
-                                ip_column_index = i
-                                break
-                        
-                        # 如果没找到IP列，尝试其他常见列名
-                        if ip_column_index is None:
-                            for i, header in enumerate(headers):
-                                if 'ip' in header:
-                                    ip_column_index = i
-                                    break
-                        
-                        if ip_column_index is None:
-                            ip_column_index = 0  # 假设第一列
-                            logger.info(f"未找到明确的IP列，假设第{ip_column_index + 1}列为IP列")
-                        
-                        if ip_column_index < len(row):
-                            ip_value = str(row[ip_column_index]).strip()
-                            # 使用更严格的IP匹配
-                            ip_match = re.search(r'\b(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b', ip_value)
-                            if ip_match:
-                                ip = ip_match.group()
-                                if self.is_valid_ip(ip):
-                                    ip_addresses.add(ip)
-                                    if len(ip_addresses) <= 5:  # 只显示前几个
-                                        logger.debug(f"找到443端口IP地址: {ip} (行 {row_num})")
-        
-            logger.info(f"处理了 {rows_processed} 行数据，找到 {rows_with_443} 行443端口")
-            logger.info(f"提取到 {len(ip_addresses)} 个唯一443端口IP")
-        
-        except Exception as e:
-            logger.error(f"读取CSV文件时出错: {e}")
-        
-        return list(ip_addresses)
+        result = scan_csv_file(csv_file_path)
+        logger.info(f"提取到 {len(result.ips_443)} 个唯一443端口IP")
+        return result.ips_443.to_strings()
     
     def extract_ips_from_preferred_files(self, preferred_files):
         """从优选文件中提取443端口IP"""
-        all_ips = set()
+        all_ips = []
         
         for file_path in preferred_files:
             logger.info(f"从优选文件提取IP: {os.path.basename(file_path)}")
             ips = self.extract_443_ips_from_csv(file_path)
-            all_ips.update(ips)
+            all_ips.append(IPSet.from_strings(ips))
             logger.info(f"从 {os.path.basename(file_path)} 提取到 {len(ips)} 个443端口IP")
         
-        return list(all_ips)
+        return IPSet.union_all(all_ips).to_strings()
     
     def extract_region_ips_from_other_files(self, csv_file_path, region_type):
-        """从其他文件中按区域规则提取区域IP（备用方法）"""
-        if not os.path.exists(csv_file_path):
-            return []
-        
-        region_ip_addresses = set()
-        rows_processed = 0
-        rows_with_region_443 = 0
-        
-        # 根据区域类型设置匹配规则
-        if region_type == 'HK':
-            region_patterns = ['HK', 'HONG KONG', '香港', 'HONGKONG', 'CN-HK', 'HK-']
-        elif region_type == 'SG':
-            region_patterns = ['SG', 'SINGAPORE', '新加坡', 'SINGAPURA', 'CN-SG', 'SG-']
-        else:
+        """从其他文件中按区域索引提取区域IP（备用方法）"""
+        if not os.path.exists(csv_file_path) or region_type not in REGION_RULES:
             return []
         
-        try:
-            with open(csv_file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                sample = file.read(1024)
-                file.seek(0)
-                
-                delimiter = ','
-                if ';' in sample and ',' not in sample:
-                    delimiter = ';'
-                elif '\t' in sample:
-                    delimiter = '\t'
-                
-                reader = csv.reader(file, delimiter=delimiter)
-                headers = None
-                
-                for row_num, row in enumerate(reader, 1):
-                    if not row:
-                        continue
-                    
-                    rows_processed += 1
-                    
-                    if row_num == 1:
-                        headers = [header.strip().lower() for header in row]
-                        logger.info(f"检测到表头(备用{region_type}提取): {headers}")
-                        continue
-                    
-                    # 查找端口列
-                    port_column_index = None
-                    for i, header in enumerate(headers):
-                        if header in ['port', '端口', 'port_number', '端口号', 'dstport', 'portid']:
-                            port_column_index = i
-                            break
-                    
-                    # 如果没找到端口列，尝试其他常见列名
-                    if port_column_index is None:
-                        for i, header in enumerate(headers):
-                            if 'port' in header:
-                                port_column_index = i
-                                break
-                    
-                    # 检查是否为443端口
-                    is_443_port = False
-                    if port_column_index is not None and port_column_index < len(row):
-                        port_value = str(row[port_column_index]).strip()
-                        if port_value == '443':
-                            is_443_port = True
-                    
-                    if is_443_port:
-                        # 查找区域列
-                        region_column_index = None
-                        for i, header in enumerate(headers):
-                            if header in ['region', '区域', 'country', '国家', 'location', '位置', 'geo', '地区']:
-                                region_column_index = i
-                                break
-                        
-                        # 如果没找到区域列，尝试其他常见列名
-                        if region_column_index is None:
-                            for i, header in enumerate(headers):
-                                if any(keyword in header for keyword in ['region', 'country', 'location', 'geo', '区域', '国家', '位置', '地区']):
-                                    region_column_index = i
-                                    break
-                        
-                        # 查找IP列
-                        ip_column_index = None
-                        for i, header in enumerate(headers):
-                            if header in ['ip', 'ip地址', 'ip_address', 'address', '地址', 'dstip', 'ipaddr']:
-                                ip_column_index = i
-                                break
-                        
-                        if ip_column_index is None:
-                            ip_column_index = 0
-                        
-                        # 检查是否为指定区域
-                        is_target_region = False
-                        if region_column_index is not None and region_column_index < len(row):
-                            region_value = str(row[region_column_index]).strip().upper()
-                            # 匹配区域标识
-                            for pattern in region_patterns:
-                                if pattern.upper() in region_value:
-                                    is_target_region = True
-                                    break
-                        
-                        if is_target_region and ip_column_index < len(row):
-                            ip_value = str(row[ip_column_index]).strip()
-                            ip_match = re.search(r'\b(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\b', ip_value)
-                            if ip_match:
-                                ip = ip_match.group()
-                                if self.is_valid_ip(ip):
-                                    region_ip_addresses.add(ip)
-                                    rows_with_region_443 += 1
-                                    if len(region_ip_addresses) <= 5:
-                                        logger.debug(f"找到{region_type}区域443端口IP地址: {ip} (行 {row_num})")
-        
-            logger.info(f"备用{region_type}提取处理了 {rows_processed} 行数据，找到 {rows_with_region_443} 行{region_type}区域443端口")
-        
-        except Exception as e:
-            logger.error(f"备用{region_type}提取读取CSV文件时出错: {e}")
-        
-        return list(region_ip_addresses)
+        result = scan_csv_file(csv_file_path)
+        return result.lookup(region_index_keys(REGION_RULES[region_type])).to_strings()
     
     def extract_443_ips_advanced(self, csv_file_path):
         """高级方法提取443端口IP（备用方法）"""
         if not os.path.exists(csv_file_path):
             return []
         
-        ip_addresses = set()
+        # 文件内容通过mmap按需读取，匹配结果分批转换为uint32集合，内存占用与文件大小无关
+        ip_sets = []
+        batch = []
         
         try:
-            with open(csv_file_path, 'r', encoding='utf-8', errors='ignore') as file:
-                content = file.read()
-                
-                # 匹配 IP:443 格式
-                ip_port_pattern1 = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}:443\b'
-                matches1 = re.findall(ip_port_pattern1, content)
-                for match in matches1:
-                    ip = match.split(':')[0]
-                    if self.is_valid_ip(ip):
-                        ip_addresses.add(ip)
-                        logger.debug(f"从IP:443格式找到: {ip}")
-                
-                # 在包含443的行中查找IP
-                lines = content.split('\n')
-                for line_num, line in enumerate(lines, 1):
-                    if re.search(r'\b443\b', line) and not re.search(r'\b(?:8443|3443|2443|1443)\b', line):
-                        ips_in_line = re.findall(r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b', line)
-                        for ip in ips_in_line:
-                            if self.is_valid_ip(ip):
-                                ip_addresses.add(ip)
-                                if len(ip_addresses) <= 5:
-                                    logger.debug(f"从行 {line_num} 找到443端口IP: {ip}")
-                        
+            for match in iter_443_ips(csv_file_path):
+                batch.append(match.decode('ascii'))
+                if len(batch) >= ADVANCED_SCAN_BATCH:
+                    ip_sets.append(IPSet.from_strings(batch))
+                    batch = []
         except Exception as e:
             logger.error(f"高级解析时出错: {e}")
         
-        logger.info(f"高级解析找到 {len(ip_addresses)} 个IP地址")
-        return list(ip_addresses)
+        ip_sets.append(IPSet.from_strings(batch))
+        ip_set = IPSet.union_all(ip_sets)
+        logger.info(f"高级解析找到 {len(ip_set)} 个IP地址")
+        return ip_set.to_strings()
+    
+    def extract_port_ips_advanced(self, csv_file_path, ports=None):
+        """高级方法一次扫描提取多个端口的IP，返回PortBitmap（ports默认SCAN_PORTS）"""
+        ports = tuple(ports or SCAN_PORTS)
+        batches = {port: [] for port in ports}
+        try:
+            for ip, port in iter_port_ips(csv_file_path, ports):
+                batches[int(port)].append(ip.decode('ascii'))
+        except Exception as e:
+            logger.error(f"高级解析时出错: {e}")
+        bitmap = PortBitmap.from_port_sets(ports, {port: IPSet.from_strings(ips) for port, ips in batches.items()})
+        logger.info(f"高级解析找到 {len(bitmap)} 个IP地址（端口 {','.join(map(str, ports))}）")
+        return bitmap
     
     def is_valid_ip(self, ip):
         """验证IP地址格式是否正确"""
+        return ip_to_int(ip) is not None
+    
+    def save_ips_to_file(self, ip_list, output_file):
+        """将IP地址列表保存到文件（按数值排序）"""
         try:
-            parts = ip.split('.')
-            if len(parts) != 4:
-                return False
-            return all(0 <= int(part) <= 255 for part in parts if part.isdigit())
-        except:
+            ip_set = ip_list if isinstance(ip_list, IPSet) else IPSet(ip_list)
+            with METRICS.stage('write', output=output_file):
+                changed = write_lines_if_changed(output_file, ip_set.to_strings())
+            if changed:
+                logger.info(f"成功保存 {len(ip_set)} 个IP地址到 {output_file}")
+            else:
+                logger.info(f"{output_file} 内容未变化，跳过写入")
+            return True
+        except Exception as e:
+            logger.error(f"保存IP地址到文件时出错: {e}")
             return False
     
-    def save_ips_to_file(self, ip_list, output_file):
-        """将IP地址列表保存到文件"""
+    def save_cidrs_to_file(self, ip_list, output_file):
+        """把IP聚合为最少的CIDR前缀后保存，每行一个"""
+        try:
+            ip_set = ip_list if isinstance(ip_list, IPSet) else IPSet(ip_list)
+            with METRICS.stage('write', output=output_file):
+                cidrs = ip_set.to_cidrs()
+                changed = write_lines_if_changed(output_file, cidrs)
+            if changed:
+                logger.info(f"成功保存 {len(ip_set)} 个IP聚合成的 {len(cidrs)} 个CIDR前缀到 {output_file}")
+            else:
+                logger.info(f"{output_file} 内容未变化，跳过写入")
+            return True
+        except Exception as e:
+            logger.error(f"保存CIDR文件失败: {e}")
+            return False
+    
+    def save_ranked_ips_to_file(self, ranking, output_file):
+        """按评分从高到低保存TopN中的IP地址"""
+        return self.save_ordered_ips_to_file([ip for ip, _ in ranking.ranked()], output_file)
+    
+    def save_ordered_ips_to_file(self, ip_values, output_file):
+        """按给定顺序保存IP地址（整数列表，如评分或实测延迟顺序）"""
         try:
-            with open(output_file, 'w', encoding='utf-8') as f:
-                for ip in sorted(ip_list):
-                    f.write(ip + '\n')
-            logger.info(f"成功保存 {len(ip_list)} 个IP地址到 {output_file}")
+            with METRICS.stage('write', output=output_file):
+                changed = write_lines_if_changed(output_file, [int_to_ip(ip) for ip in ip_values])
+            if changed:
+                logger.info(f"成功按顺序保存 {len(ip_values)} 个IP地址到 {output_file}")
+            else:
+                logger.info(f"{output_file} 内容未变化，跳过写入")
             return True
         except Exception as e:
             logger.error(f"保存IP地址到文件时出错: {e}")
             return False
     
     async def close(self):
-        """关闭客户端"""
-        await self.client.disconnect()
+        """关闭客户端（未创建过客户端时无需关闭）"""
+        if self._client is not None:
+            await self._client.disconnect()
+
+def list_local_csv_files(folder, include_subfolders=True):
+    """列出本地目录中的CSV文件及其压缩归档（不含合并输出merged.csv），按文件名排序
+
+    include_subfolders为True时同时列出下一级子目录（如多频道时各频道的下载目录
+    telegram_downloads/<频道名>/）中的文件，排在目录本身的文件之后；以点开头的目录（如 .scan_cache）不列出。
+    """
+    if not os.path.isdir(folder):
+        logger.error(f"本地目录不存在: {folder}")
+        return []
+
+    def csv_files_in(directory):
+        return [
+            os.path.join(directory, filename) for filename in sorted(os.listdir(directory))
+            if is_csv_name(filename) and strip_archive_suffix(filename) != 'merged.csv'
+            and os.path.isfile(os.path.join(directory, filename))
+        ]
+
+    files = csv_files_in(folder)
+    if not include_subfolders:
+        return files
+    for name in sorted(os.listdir(folder)):
+        subfolder = os.path.join(folder, name)
+        if not name.startswith('.') and os.path.isdir(subfolder):
+            files.extend(csv_files_in(subfolder))
+    return files
+
+
+def archive_old_downloads(folder, top_n=None, archive_after_days=None, archive_format=None, delete_after_days=None, backend=None):
+    """下载目录的保留策略：较旧的CSV压缩归档，可选地删除更旧的文件
+
+    文件的日期取文件名中的日期（否则为修改时间）。发布超过archive_after_days天的原始CSV
+    压缩为 .gz/.zst（至少保留最近RECENT_DAYS天为原始文件，不影响下载缓存），已有的提取结果缓存
+    （backend后端的结果）随之迁移，不需要重新解析；delete_after_days大于0时删除超过该天数的文件，
+    同样至少保留最近RECENT_DAYS天。返回 (归档数, 删除数)。
+    """
+    archive_after_days = ARCHIVE_AFTER_DAYS if archive_after_days is None else archive_after_days
+    archive_format = archive_format or ARCHIVE_FORMAT
+    delete_after_days = ARCHIVE_DELETE_AFTER_DAYS if delete_after_days is None else delete_after_days
+    top_n = RANK_TOP_N if top_n is None else top_n
+    if not os.path.isdir(folder) or not (archive_after_days or delete_after_days):
+        return 0, 0
+    
+    today = datetime.now(timezone.utc).date()
+    archived = deleted = 0
+    # 每个频道的下载目录各自处理一次，不进入子目录
+    for file_path in list_local_csv_files(folder, include_subfolders=False):
+        try:
+            age_days = (today - datetime.strptime(file_date_key(file_path), '%Y%m%d').date()).days
+        except ValueError:
+            # 文件名中的8位数字不是合法日期（如 20251399），无法判断新旧，保持原样
+            logger.warning(f"无法从文件名确定日期，不归档: {os.path.basename(file_path)}")
+            continue
+        try:
+            # 最近RECENT_DAYS天的文件仍在频道游标中，删除后会被当作丢失而反复重新下载
+            if delete_after_days and age_days > max(delete_after_days, RECENT_DAYS):
+                os.remove(file_path)
+                if os.path.exists(scan_cache_path(file_path)):
+                    os.remove(scan_cache_path(file_path))
+                deleted += 1
+                logger.info(f"删除超过 {max(delete_after_days, RECENT_DAYS)} 天的文件: {os.path.basename(file_path)}")
+            elif archive_after_days and compression_of(file_path) is None and age_days > max(archive_after_days, RECENT_DAYS):
+                cached = load_scan_cache(file_path, top_n, backend)
+                raw_size = os.path.getsize(file_path)
+                with METRICS.stage('archive', file=os.path.basename(file_path)):
+                    archive_path = compress_file(file_path, archive_format)
+                if cached is not None:
+                    save_scan_cache(archive_path, cached, top_n, backend=backend)
+                if os.path.exists(scan_cache_path(file_path)):
+                    os.remove(scan_cache_path(file_path))
+                archived += 1
+                METRICS.add('archive_bytes_saved', raw_size - os.path.getsize(archive_path))
+                logger.info(f"已归档: {os.path.basename(archive_path)}（{raw_size} -> {os.path.getsize(archive_path)} 字节）")
+        except Exception as e:
+            logger.error(f"归档 {os.path.basename(file_path)} 失败: {e}")
+    METRICS.add('archived_files', archived)
+    METRICS.add('deleted_files', deleted)
+    return archived, deleted
 
-async def main():
+
+def channel_download_folder(channel_username, index, base_folder=DOWNLOAD_FOLDER):
+    """第一个频道使用下载目录本身（与单频道时一致），其余频道各用一个以频道名命名的子目录"""
+    if index == 0:
+        return base_folder
+    return os.path.join(base_folder, re.sub(r'[^A-Za-z0-9_.-]', '_', channel_username.strip('@/').rsplit('/', 1)[-1]))
+
+
+def deduplicate_files(csv_files):
+    """去掉重复的路径和内容完全相同的文件（多个来源转发同一份CSV），保留第一次出现的
+
+    只对大小相同的文件计算SHA256。
+    """
+    unique_paths = {}
+    for path in csv_files:
+        unique_paths.setdefault(os.path.abspath(path), path)
+    paths_by_size = {}
+    for path in unique_paths.values():
+        paths_by_size.setdefault(os.path.getsize(path), []).append(path)
+    duplicates = set()
+    for same_size in paths_by_size.values():
+        if len(same_size) < 2:
+            continue
+        seen_hashes = {}
+        for path in same_size:
+            digest = file_sha256(path)
+            if digest in seen_hashes:
+                logger.info(f"跳过内容重复的文件: {path}（与 {seen_hashes[digest]} 相同）")
+                duplicates.add(path)
+            else:
+                seen_hashes[digest] = path
+    if duplicates:
+        METRICS.add('duplicate_files', len(duplicates))
+    return [path for path in unique_paths.values() if path not in duplicates]
+
+
+class CsvSource:
+    """CSV来源接口
+
+    fetch() 获取本次参与提取的本地CSV文件路径；给出file_queue（asyncio.Queue）时，
+    每个文件一就绪就放入队列，供流水线模式边获取边解析。current_files() 不访问网络，
+    返回来源当前已有的文件（监听模式每轮处理时使用）。
+    """
+    name = 'source'
+    
+    async def fetch(self, file_queue=None):
+        raise NotImplementedError
+    
+    def current_files(self):
+        raise NotImplementedError
+
+
+class TelegramSource(CsvSource):
+    """Telegram频道来源：最近RECENT_DAYS天发布的CSV，下载到download_folder"""
+    
+    def __init__(self, downloader, channel_username, download_folder=DOWNLOAD_FOLDER):
+        self.downloader = downloader
+        self.channel_username = channel_username
+        self.download_folder = download_folder
+        self.name = channel_username
+    
+    async def fetch(self, file_queue=None):
+        return await self.downloader.download_todays_csv_files(self.download_folder, file_queue, self.channel_username)
+    
+    def current_files(self):
+        return self.downloader.recent_downloaded_files(self.download_folder, self.channel_username)
+
+
+class LocalDirectorySource(CsvSource):
+    """本地目录来源：目录中现有的CSV文件，离线模式或手动放入的文件使用"""
+    
+    def __init__(self, folder):
+        self.folder = folder
+        self.name = folder
+    
+    async def fetch(self, file_queue=None):
+        csv_files = self.current_files()
+        if file_queue is not None:
+            for file_path in csv_files:
+                await file_queue.put(file_path)
+        return csv_files
+    
+    def current_files(self):
+        return list_local_csv_files(self.folder)
+
+
+async def fetch_sources(sources, file_queue=None):
+    """并发获取所有来源，合并为一个去重后的文件列表
+
+    某个来源失败时记录错误并跳过，不影响其他来源。同一下载器上的频道共享下载并发上限。
+    """
+    results = await asyncio.gather(*(source.fetch(file_queue) for source in sources), return_exceptions=True)
+    csv_files = []
+    for source, result in zip(sources, results):
+        if isinstance(result, BaseException):
+            logger.error(f"来源 {source.name} 获取失败: {result}")
+            METRICS.add('source_errors', source=source.name)
+            continue
+        METRICS.set('source_files', len(result), source=source.name)
+        logger.info(f"来源 {source.name}: {len(result)} 个CSV文件")
+        csv_files.extend(result)
+    return deduplicate_files(csv_files)
+
+
+async def fetch_and_extract(sources, region_rules=None, backend=None, workers=None, top_n=None, use_cache=None):
+    """流水线模式：并发获取所有来源，每个文件就绪后立即交给执行器解析，下载与解析重叠进行
+
+    各来源把文件路径放入同一个有界队列（满时等待，形成背压），workers个消费者取出后在
+    进程池中解析。与scan_files相同，已到达文件合计不到PARSE_POOL_MIN_BYTES时（以及workers为1时）
+    在线程中解析，不启动进程池。任一方出错时取消其余任务并抛出该异常。
+    返回 (csv_files, (buckets, preferred_files, rankings))。
+    """
+    region_rules = REGION_RULES if region_rules is None else region_rules
+    backend = backend or EXTRACT_BACKEND
+    workers = max(PARSE_WORKERS if workers is None else workers, 1)
+    top_n = RANK_TOP_N if top_n is None else top_n
+    use_cache = SCAN_CACHE if use_cache is None else use_cache
+    
+    loop = asyncio.get_running_loop()
+    file_queue = asyncio.Queue(maxsize=workers * 2)
+    results = {}
+    pool = {'executor': None, 'bytes': 0}
+    
+    def executor_for(file_path):
+        # 文件逐个到达，累计大小达到阈值后才启动进程池；None为事件循环默认的线程池
+        pool['bytes'] += total_file_size([file_path])
+        if pool['executor'] is None and workers > 1 and pool['bytes'] >= PARSE_POOL_MIN_BYTES:
+            logger.info(f"待解析文件已达 {pool['bytes']} 字节，使用 {workers} 个进程并行解析")
+            pool['executor'] = make_parse_pool(workers)
+        return pool['executor']
+    
+    async def consume():
+        while True:
+            file_path = await file_queue.get()
+            try:
+                if file_path is None:
+                    return
+                if file_path in results:
+                    continue
+                task = (backend, file_path, top_n, use_cache)
+                logger.info(f"开始解析: {os.path.basename(file_path)}")
+                try:
+                    results[file_path] = await loop.run_in_executor(executor_for(file_path), _scan_task_cached, task)
+                except (OSError, BrokenProcessPool) as e:
+                    logger.warning(f"进程池不可用，改为在线程中解析: {e}")
+                    results[file_path] = await asyncio.to_thread(_scan_task_cached, task)
+                record_scan_metrics(file_path, results[file_path])
+            finally:
+                file_queue.task_done()
+    
+    producer = asyncio.create_task(fetch_sources(sources, file_queue))
+    consumers = [asyncio.create_task(consume()) for _ in range(workers)]
+    
+    def stop_on_error(task):
+        # 消费者出错时不再继续下载，避免下载协程在满队列上一直等待
+        if not task.cancelled() and task.exception() is not None:
+            producer.cancel()
+    
+    for consumer in consumers:
+        consumer.add_done_callback(stop_on_error)
+    
+    try:
+        csv_files = await producer
+        for _ in consumers:
+            await file_queue.put(None)
+        await asyncio.gather(*consumers)
+    except BaseException:
+        for task in [producer, *consumers]:
+            task.cancel()
+        await asyncio.gather(producer, *consumers, return_exceptions=True)
+        for consumer in consumers:
+            if not consumer.cancelled() and consumer.exception() is not None:
+                raise consumer.exception()
+        raise
+    finally:
+        if pool['executor'] is not None:
+            pool['executor'].shutdown()
+    
+    # 正常情况下每个文件都已经过队列，这里只是兜底
+    for file_path in csv_files:
+        if file_path not in results:
+            results[file_path] = await asyncio.to_thread(_scan_task_cached, (backend, file_path, top_n, use_cache))
+            record_scan_metrics(file_path, results[file_path])
+    
+    scanned = [
+        (file_path, match_preferred_region(os.path.basename(file_path), region_rules), results[file_path])
+        for file_path in csv_files
+    ]
+    with METRICS.stage('merge'):
+        return csv_files, merge_scan_results(scanned, region_rules, top_n)
+
+
+def cidr_output_path(output_file):
+    """IP文件对应的CIDR文件名，如 hkip.txt -> hkip-cidr.txt"""
+    stem, ext = os.path.splitext(output_file)
+    return f"{stem}-cidr{ext}"
+
+
+def load_ip_filters(allowlist_file=None, denylist_file=None):
+    """读取白名单/黑名单前缀文件，返回 (allow, deny) 两个PrefixIndex，未配置的为None"""
+    indexes = []
+    for label, path in (('白名单', allowlist_file), ('黑名单', denylist_file)):
+        if not path:
+            indexes.append(None)
+            continue
+        with METRICS.stage('load_filter', list=label):
+            index = PrefixIndex.from_file(path)
+        logger.info(f"已加载{label} {path}: {len(index)} 个区间，共 {index.address_count()} 个地址")
+        indexes.append(index)
+    return tuple(indexes)
+
+
+def filter_buckets(buckets, allow=None, deny=None):
+    """对每个IP集合应用白名单和黑名单，返回新的 {名称: IPSet}"""
+    if allow is None and deny is None:
+        return buckets
+    filtered = {}
+    for name, ip_set in buckets.items():
+        kept = ip_set
+        if allow is not None:
+            kept = allow.select(kept, inside=True)
+        if deny is not None:
+            kept = deny.select(kept, inside=False)
+        if len(kept) != len(ip_set):
+            METRICS.add('filtered_ips', len(ip_set) - len(kept), bucket=name)
+            logger.info(f"{name}: 白名单/黑名单过滤掉 {len(ip_set) - len(kept)} 个IP")
+        filtered[name] = kept
+    return filtered
+
+
+def port_output_path(port):
+    """多端口输出的文件名，如 ip-8443.txt"""
+    stem, ext = os.path.splitext(IP_FILE)
+    return f"{stem}-{port}{ext}"
+
+
+async def probe_extracted_ips(ip_set):
+    """对提取到的IP重新做TLS握手探测，返回 {ip整数: 握手耗时毫秒或None}"""
+    ips = ip_set.to_strings()
+    logger.info(f"开始TLS探测 {len(ips)} 个IP（并发 {PROBE_CONCURRENCY}，超时 {PROBE_TIMEOUT} 秒，端口 {PROBE_PORT}）")
+    with METRICS.stage('probe'):
+        latencies = await probe_ips(ips, PROBE_PORT, PROBE_CONCURRENCY, PROBE_TIMEOUT, PROBE_ATTEMPTS, PROBE_SERVER_NAME)
+    reachable = sum(1 for latency in latencies.values() if latency is not None)
+    METRICS.add('probe_reachable', reachable)
+    METRICS.add('probe_unreachable', len(latencies) - reachable)
+    logger.info(f"TLS探测完成：{reachable} 个可达，{len(latencies) - reachable} 个不可达")
+    return {ip_to_int(ip): latency for ip, latency in latencies.items()}
+
+
+def build_results_snapshot(csv_files, published, region_outputs, latencies=None):
+    """汇总本次发布的IP及其测量值，供查询服务加载
+
+    published 为 {端口: IPSet}；每个 (IP, 端口) 取最新一天的观测，同一天取延迟最低的一条。
+    CSV中没有观测的已发布IP（如只出现在优选文件中）也会保留，测量值为空。
+    """
+    regions_of = {}
+    for region, ips in region_outputs.items():
+        for ip in ips:
+            regions_of.setdefault(ip, []).append(region)
+    best = {}
+    for file_path in sorted(csv_files, key=file_date_key):
+        day = file_date_key(file_path)
+        try:
+            for ip, port, colo, latency, speed in iter_file_observations(file_path, published):
+                if ip not in published[port]:
+                    continue
+                current = best.get((ip, port))
+                if current is not None and current[0] == day:
+                    if latency is None or (current[2] is not None and current[2] <= latency):
+                        continue
+                best[(ip, port)] = (day, colo or (current[1] if current else ''), latency, speed)
+        except SchemaError as e:
+            logger.warning(f"结果快照跳过 {os.path.basename(file_path)}: {e}")
+
+    records = []
+    for port, ips in sorted(published.items()):
+        for ip in ips:
+            day, colo, latency, speed = best.get((ip, port), (None, '', None, None))
+            records.append({
+                'ip': int_to_ip(ip),
+                'port': port,
+                'colo': colo.upper() or None,
+                'regions': regions_of.get(ip, []) if port == 443 else [],
+                'latency_ms': round(latency, 1) if latency is not None else None,
+                'speed_kbps': round(speed, 1) if speed is not None else None,
+                'probe_ms': round(latencies[ip], 1) if latencies and port == 443 and latencies.get(ip) is not None else None,
+                'last_seen': f"{day[:4]}-{day[4:6]}-{day[6:]}" if day else None,
+            })
+    return {'version': 1, 'generated_at': time.time(), 'probed': latencies is not None, 'records': records}
+
+
+def write_results_snapshot(path, snapshot):
+    """原子写出紧凑格式的结果快照，查询服务不会读到写了一半的文件"""
+    try:
+        with atomic_write(path) as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(',', ':'))
+        logger.info(f"结果快照已写入: {path}（{len(snapshot['records'])} 条）")
+    except Exception as e:
+        logger.error(f"写入结果快照失败: {e}")
+
+
+def write_metrics_report(path):
+    """在日志中输出各阶段耗时，并在给出path时写出指标报告"""
+    totals = METRICS.stage_totals()
+    parse_seconds, _ = totals.get('parse', (0.0, 0))
+    rows = sum(value for (name, _), value in METRICS.counters.items() if name == 'rows_parsed')
+    if parse_seconds:
+        METRICS.set('parse_rows_per_second', round(rows / parse_seconds))
+    for name, (seconds, count) in totals.items():
+        logger.info(f"阶段耗时 {name}: {seconds:.3f} 秒（{count} 次）")
+    if not path:
+        return
+    try:
+        METRICS.write(path)
+        logger.info(f"运行指标已写入: {path}")
+    except Exception as e:
+        logger.error(f"写入运行指标失败: {e}")
+
+
+def log_startup_time():
+    """记录从开始导入本模块到进入main的耗时，超过STARTUP_WARN_SECONDS时警告"""
+    elapsed = time.perf_counter() - _MODULE_START
+    METRICS.record_stage('startup', elapsed)
+    logger.info(f"启动耗时 {elapsed:.3f} 秒")
+    if elapsed > STARTUP_WARN_SECONDS:
+        logger.warning(f"启动耗时 {elapsed:.3f} 秒，超过 {STARTUP_WARN_SECONDS} 秒，请检查是否有模块在导入时加载了重依赖")
+    return elapsed
+
+
+def parse_args(argv=None):
+    """解析命令行参数，未指定时使用环境变量中的配置"""
+    parser = argparse.ArgumentParser(description='从Telegram频道下载CSV并提取443端口IP')
+    parser.add_argument('--backend', choices=sorted(SCAN_BACKENDS), default=EXTRACT_BACKEND,
+                        help='CSV提取后端（默认取EXTRACT_BACKEND环境变量，否则为csv）')
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS,
+                        help='并行解析CSV的进程数，1为串行（默认取PARSE_WORKERS环境变量，否则为CPU核数）')
+    parser.add_argument('--top-n', type=int, default=RANK_TOP_N,
+                        help='区域IP文件按延迟/速度评分只保留前N个，0为不排序不截断（默认取RANK_TOP_N环境变量）')
+    parser.add_argument('--no-cache', dest='use_cache', action='store_false', default=SCAN_CACHE,
+                        help='不使用提取结果缓存，重新解析所有文件（也可设置SCAN_CACHE=0）')
+    parser.add_argument('--pipeline', action='store_true', default=PIPELINE,
+                        help='边下载边解析，每个文件下载完成后立即提取（也可设置PIPELINE=1）')
+    parser.add_argument('--probe', action='store_true', default=PROBE,
+                        help='发布前对提取到的IP重新做TCP+TLS握手探测，去掉不可达的IP，区域文件按实测延迟排序（也可设置PROBE=1）')
+    parser.add_argument('--cidr', action='store_true', default=CIDR_OUTPUT,
+                        help='额外把每个IP文件聚合为最少的CIDR前缀，写到 *-cidr.txt（也可设置CIDR_OUTPUT=1）')
+    parser.add_argument('--watch', action='store_true', default=WATCH,
+                        help='处理完后保持连接，频道出现新CSV时立即下载并更新IP文件（也可设置WATCH=1）')
+    parser.add_argument('--metrics', default=METRICS_FILE, metavar='PATH',
+                        help='写出各阶段耗时和计数器，.prom后缀为Prometheus textfile格式，否则为JSON（也可设置METRICS_FILE）')
+    parser.add_argument('--results', default=RESULTS_FILE, metavar='PATH',
+                        help='写出提取结果快照（JSON），供 ip_query_server.py 查询（也可设置RESULTS_FILE）')
+    parser.add_argument('--offline', nargs='?', const=DOWNLOAD_FOLDER, default=None, metavar='DIR',
+                        help=f'离线模式：不连接Telegram，直接处理本地目录中的CSV，多个目录用逗号分隔（默认目录 {DOWNLOAD_FOLDER}）')
+    return parser.parse_args(argv)
+
+
+def published_note(extracted_count, published_count):
+    """结果汇总中写入文件的数量，与提取数量相同时为空"""
+    return '' if published_count == extracted_count else f"（写入 {published_count} 个）"
+
+
+async def report_results(downloader, csv_files, extracted, args, source_label):
+    """提取（若尚未提取）并写出IP文件，输出结果汇总"""
+    if csv_files:
+        logger.info(f"成功获取 {len(csv_files)} 个CSV文件")
+        
+        # 每个文件只扫描一次，同时得到所有443端口IP和各区域IP
+        if extracted is None:
+            # 解析在进程池/线程中进行，不阻塞事件循环
+            extracted = await asyncio.to_thread(
+                downloader.extract_all_buckets, csv_files, None, args.backend, args.workers, args.top_n, args.use_cache
+            )
+        buckets, preferred_files, rankings = extracted
+        
+        # 可选：按白名单/黑名单前缀过滤
+        allow, deny = load_ip_filters(ALLOWLIST_FILE, DENYLIST_FILE)
+        buckets = filter_buckets(buckets, allow, deny)
+
+        # 可选：导入历史观测库，区域文件中长期稳定出现的IP排在前面（启用排名时只用于评分相同的IP之间）
+        history = None
+        if HISTORY_DIR:
+            try:
+                history = await asyncio.to_thread(record_history, csv_files, HISTORY_DIR)
+            except (OSError, ValueError) as e:
+                logger.error(f"更新历史观测库失败，区域文件不按稳定性排序: {e}")
+        for name, ips in buckets.items():
+            METRICS.set('bucket_ips', len(ips), bucket=name)
+        all_ip_list = buckets['all']
+        preferred_count = sum(len(files) for files in preferred_files.values())
+        
+        # 可选：发布前重新探测TLS握手，去掉不可达的IP
+        latencies = None
+        if args.probe and all_ip_list:
+            latencies = await probe_extracted_ips(all_ip_list)
+            if PROBE_MODE == 'drop':
+                all_ip_list = IPSet(ip for ip in all_ip_list if latencies.get(ip) is not None)
+        
+        # 保存所有443端口IP
+        if all_ip_list:
+            downloader.save_ips_to_file(all_ip_list, IP_FILE)
+            logger.info(f"成功提取 {len(all_ip_list)} 个所有443端口IP地址")
+        else:
+            logger.info("未找到任何443端口的IP地址")
+        
+        # 保存各区域443端口IP。顺序的优先级：探测后按实测握手延迟 > 启用排名时按评分（只写前N个）
+        # > 启用历史观测库时按稳定性；排名和稳定性同时启用时，稳定性只决定评分相同的IP的先后
+        region_outputs = {}
+        for region, rule in REGION_RULES.items():
+            prefer_stable = history is not None and HISTORY_PREFER_STABLE
+            if rankings.get(region):
+                ranked = [(ip, score) for ip, score in rankings[region].ranked() if ip in buckets[region]]
+                scores = dict(ranked)
+                ordered = [ip for ip, _ in ranked]
+                if prefer_stable:
+                    ordered = sorted(history.order_by_stability(ordered, days=HISTORY_WINDOW_DAYS), key=lambda ip: -scores[ip])
+            elif prefer_stable:
+                ordered = history.order_by_stability(list(buckets[region]), days=HISTORY_WINDOW_DAYS)
+            else:
+                ordered = list(buckets[region])
+            if latencies is not None:
+                ordered = order_by_latency(ordered, latencies, PROBE_MODE == 'drop')
+            region_outputs[region] = ordered
+            if rankings.get(region) or latencies is not None or prefer_stable:
+                if buckets[region]:
+                    downloader.save_ordered_ips_to_file(ordered, rule['output'])
+            elif buckets[region]:
+                downloader.save_ips_to_file(buckets[region], rule['output'])
+            if buckets[region]:
+                logger.info(f"成功提取 {len(ordered)} 个{region}区域443端口IP地址")
+        
+        # 扫描了多个端口时，每个端口单独输出一个文件
+        port_buckets = {int(name.split(':', 1)[1]): ips for name, ips in buckets.items() if name.startswith('port:')}
+        for port, ips in port_buckets.items():
+            if not ips:
+                continue
+            downloader.save_ips_to_file(ips, port_output_path(port))
+            if args.cidr:
+                downloader.save_cidrs_to_file(ips, cidr_output_path(port_output_path(port)))
+        
+        # 可选：同时输出聚合后的CIDR前缀列表
+        if args.cidr:
+            if all_ip_list:
+                downloader.save_cidrs_to_file(all_ip_list, cidr_output_path(IP_FILE))
+            for region, rule in REGION_RULES.items():
+                if region_outputs[region]:
+                    downloader.save_cidrs_to_file(region_outputs[region], cidr_output_path(rule['output']))
+        
+        # 可选：写出结果快照，查询服务检测到文件更新后自动重新加载
+        if args.results:
+            published = {443: all_ip_list, **{port: ips for port, ips in port_buckets.items() if port != 443}}
+            with METRICS.stage('snapshot'):
+                snapshot = await asyncio.to_thread(build_results_snapshot, csv_files, published, region_outputs, latencies)
+            write_results_snapshot(args.results, snapshot)
+        
+        # 输出结果汇总
+        print("## 提取结果")
+        print(f"- {source_label}")
+        print(f"- 处理文件数: {len(csv_files)}")
+        for region in REGION_RULES:
+            print(f"- {region}优选文件数: {len(preferred_files[region])}")
+        print(f"- 其他文件数: {len(csv_files) - preferred_count}")
+        # 探测丢弃或排名截断后，写入文件的数量少于提取到的数量
+        print(f"- 总443端口IP: {len(buckets['all'])} 个" + published_note(len(buckets['all']), len(all_ip_list)))
+        for region in REGION_RULES:
+            print(f"- {region}区域443端口IP: {len(buckets[region])} 个" + published_note(len(buckets[region]), len(region_outputs[region])))
+        for port, ips in port_buckets.items():
+            print(f"- {port}端口IP: {len(ips)} 个（{port_output_path(port)}）")
+        if latencies is not None:
+            reachable = sum(1 for latency in latencies.values() if latency is not None)
+            print(f"- TLS探测可达: {reachable}/{len(latencies)} 个")
+        for region, rule in REGION_RULES.items():
+            print(f"- {region} IP文件: {rule['output']}")
+        
+        # 显示前几个IP作为示例（启用排名或探测时为排在最前的几个）
+        for region in REGION_RULES:
+            region_ip_list = [int_to_ip(ip) for ip in region_outputs[region][:4]]
+            if not region_ip_list:
+                continue
+            if len(region_outputs[region]) > 3:
+                print(f"- 示例{region} IP: {', '.join(region_ip_list[:3])}...")
+            else:
+                print(f"- {region} IP列表: {', '.join(region_ip_list)}")
+                
+    else:
+        logger.info("未找到CSV文件")
+        print("## 提取结果: 未找到CSV文件")
+
+
+async def run_offline(folder, args):
+    """离线模式：直接处理本地目录（可用逗号分隔多个）中的CSV文件，不导入telethon、不连接Telegram"""
+    logger.info(f"离线模式，处理本地目录: {folder}")
+    print(f"## 离线模式: {folder}")
+    downloader = TelegramDownloader(API_ID, API_HASH, PHONE_NUMBER, CHANNEL_USERNAME)
+    try:
+        sources = [LocalDirectorySource(path.strip()) for path in folder.split(',') if path.strip()]
+        csv_files = await fetch_sources(sources)
+        logger.info(f"使用 {args.backend} 提取后端")
+        await report_results(downloader, csv_files, None, args, f"本地目录: {folder}")
+    except Exception as e:
+        logger.error(f"发生错误: {e}")
+        print(f"## 错误: {e}")
+    finally:
+        await downloader.close()
+        write_metrics_report(args.metrics)
+
+
+async def main(args=None):
+    args = args or parse_args([])
+    log_startup_time()
+    if args.offline:
+        await run_offline(args.offline, args)
+        return
+    
     # 检查必要的环境变量
     if not all([API_ID, API_HASH, PHONE_NUMBER]):
         logger.error("缺少必要的环境变量: TELEGRAM_API_ID, TELEGRAM_API_HASH, TELEGRAM_PHONE")
@@ -533,16 +2427,22 @@ async def main():
         return
     
     # 检查频道用户名
-    if not CHANNEL_USERNAME:
+    if not CHANNEL_USERNAMES:
         logger.error("缺少TELEGRAM_CHANNEL环境变量")
         print("## 错误: 缺少TELEGRAM_CHANNEL环境变量")
         return
     
-    logger.info(f"目标频道: {CHANNEL_USERNAME}")
-    print(f"## 目标频道: {CHANNEL_USERNAME}")
+    source_label = f"目标频道: {', '.join(CHANNEL_USERNAMES)}"
+    logger.info(source_label)
+    print(f"## {source_label}")
     
-    # 初始化下载器
-    downloader = TelegramDownloader(API_ID, API_HASH, PHONE_NUMBER, CHANNEL_USERNAME)
+    # 初始化下载器；多个频道共用一个客户端和下载并发限制，第二个起的频道下载到各自的子目录
+    downloader = TelegramDownloader(API_ID, API_HASH, PHONE_NUMBER, CHANNEL_USERNAMES[0])
+    sources = [
+        TelegramSource(downloader, channel, channel_download_folder(channel, index))
+        for index, channel in enumerate(CHANNEL_USERNAMES)
+    ]
+    sources.extend(LocalDirectorySource(folder) for folder in LOCAL_SOURCE_DIRS)
     
     try:
         # 启动客户端
@@ -554,111 +2454,40 @@ async def main():
             print("## 错误: 无法启动Telegram客户端，请在本地重新运行setup_telegram.py")
             return
         
-        # 下载CSV文件（放宽到最近3天）
-        csv_files = await downloader.download_todays_csv_files(DOWNLOAD_FOLDER)
+        # 下载CSV文件（放宽到最近3天）；流水线模式下同时完成提取
+        logger.info(f"使用 {args.backend} 提取后端")
+        extracted = None
+        if args.pipeline:
+            csv_files, extracted = await fetch_and_extract(
+                sources, None, args.backend, args.workers, args.top_n, args.use_cache
+            )
+        else:
+            csv_files = await fetch_sources(sources)
         
-        if csv_files:
-            logger.info(f"成功获取 {len(csv_files)} 个CSV文件")
-            
-            # 分离区域优选文件和其他文件
-            hk_preferred_files, sg_preferred_files, other_files = downloader.find_region_preferred_files(csv_files)
-            
-            # 处理所有443端口IP（从所有文件）
-            all_files = hk_preferred_files + sg_preferred_files + other_files
-            all_ip_list = []
-            
-            for file_path in all_files:
-                logger.info(f"处理文件提取所有443端口IP: {os.path.basename(file_path)}")
-                ips = downloader.extract_443_ips_from_csv(file_path)
-                all_ip_list.extend(ips)
-            
-            # 去重
-            all_ip_list = list(set(all_ip_list))
-            
-            # 提取HK IP（优先从HK优选文件）
-            hk_ip_list = []
-            if hk_preferred_files:
-                logger.info("从HK优选文件中提取443端口IP...")
-                hk_ip_list = downloader.extract_ips_from_preferred_files(hk_preferred_files)
-                logger.info(f"从HK优选文件提取到 {len(hk_ip_list)} 个443端口IP")
-            else:
-                logger.info("未找到HK优选文件，从其他文件按区域规则提取...")
-                # 如果没有HK优选文件，从其他文件按区域规则提取
-                for file_path in other_files:
-                    hk_ips = downloader.extract_region_ips_from_other_files(file_path, 'HK')
-                    hk_ip_list.extend(hk_ips)
-                # 去重
-                hk_ip_list = list(set(hk_ip_list))
-                logger.info(f"从其他文件按区域规则提取到 {len(hk_ip_list)} 个HK区域443端口IP")
-            
-            # 提取SG IP（优先从SG优选文件）
-            sg_ip_list = []
-            if sg_preferred_files:
-                logger.info("从SG优选文件中提取443端口IP...")
-                sg_ip_list = downloader.extract_ips_from_preferred_files(sg_preferred_files)
-                logger.info(f"从SG优选文件提取到 {len(sg_ip_list)} 个443端口IP")
-            else:
-                logger.info("未找到SG优选文件，从其他文件按区域规则提取...")
-                # 如果没有SG优选文件，从其他文件按区域规则提取
-                for file_path in other_files:
-                    sg_ips = downloader.extract_region_ips_from_other_files(file_path, 'SG')
-                    sg_ip_list.extend(sg_ips)
-                # 去重
-                sg_ip_list = list(set(sg_ip_list))
-                logger.info(f"从其他文件按区域规则提取到 {len(sg_ip_list)} 个SG区域443端口IP")
-            
-            # 保存所有443端口IP
-            if all_ip_list:
-                downloader.save_ips_to_file(all_ip_list, IP_FILE)
-                logger.info(f"成功提取 {len(all_ip_list)} 个所有443端口IP地址")
-            else:
-                logger.info("未找到任何443端口的IP地址")
-            
-            # 保存HK区域443端口IP
-            if hk_ip_list:
-                downloader.save_ips_to_file(hk_ip_list, HK_IP_FILE)
-                logger.info(f"成功提取 {len(hk_ip_list)} 个HK区域443端口IP地址")
-            
-            # 保存SG区域443端口IP
-            if sg_ip_list:
-                downloader.save_ips_to_file(sg_ip_list, SG_IP_FILE)
-                logger.info(f"成功提取 {len(sg_ip_list)} 个SG区域443端口IP地址")
-            
-            # 输出结果汇总
-            print(f"## 提取结果")
-            print(f"- 目标频道: {CHANNEL_USERNAME}")
-            print(f"- 处理文件数: {len(csv_files)}")
-            print(f"- HK优选文件数: {len(hk_preferred_files)}")
-            print(f"- SG优选文件数: {len(sg_preferred_files)}")
-            print(f"- 其他文件数: {len(other_files)}")
-            print(f"- 总443端口IP: {len(all_ip_list)} 个")
-            print(f"- HK区域443端口IP: {len(hk_ip_list)} 个")
-            print(f"- SG区域443端口IP: {len(sg_ip_list)} 个")
-            print(f"- HK IP文件: {HK_IP_FILE}")
-            print(f"- SG IP文件: {SG_IP_FILE}")
+        await report_results(downloader, csv_files, extracted, args, source_label)
+        
+        # 保留策略：较旧的下载文件压缩归档（在写完IP文件之后进行，不影响本次提取）
+        for source in sources:
+            if isinstance(source, TelegramSource):
+                await asyncio.to_thread(archive_old_downloads, source.download_folder, args.top_n, backend=args.backend)
+        
+        if args.watch:
+            write_metrics_report(args.metrics)
             
-            # 显示前几个IP作为示例
-            if hk_ip_list:
-                if len(hk_ip_list) > 3:
-                    print(f"- 示例HK IP: {', '.join(hk_ip_list[:3])}...")
-                else:
-                    print(f"- HK IP列表: {', '.join(hk_ip_list)}")
+            async def on_change(files):
+                # 每轮单独统计；未变化的文件直接使用提取结果缓存，内容未变的输出文件不会重写
+                METRICS.reset()
+                await report_results(downloader, files, None, args, source_label)
+                write_metrics_report(args.metrics)
             
-            if sg_ip_list:
-                if len(sg_ip_list) > 3:
-                    print(f"- 示例SG IP: {', '.join(sg_ip_list[:3])}...")
-                else:
-                    print(f"- SG IP列表: {', '.join(sg_ip_list)}")
-                    
-        else:
-            logger.info("未找到CSV文件")
-            print("## 提取结果: 未找到CSV文件")
+            await downloader.watch_sources(sources, on_change)
         
     except Exception as e:
         logger.error(f"发生错误: {e}")
         print(f"## 错误: {e}")
     finally:
         await downloader.close()
+        write_metrics_report(args.metrics)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(main(parse_args()))
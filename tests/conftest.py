@@ -0,0 +1,43 @@
+import os
+import sys
+
+import pytest
+
+# 模块都在仓库根目录，测试直接导入
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+# 频道CSV的表头
+HEADER_FIELDS = ['IP地址', '端口', 'TLS', '数据中心', '源IP位置', '地区', '城市', '地区(中文)', '国家', '城市(中文)', '国旗', '网络延迟', '下载速度']
+HEADER = ','.join(HEADER_FIELDS) + '\n'
+
+
+def channel_row(ip, port=443, colo='HKG', location='HK', country='香港', latency='50 ms', speed='1000 kB/s'):
+    """频道CSV的一行数据（字段列表），未给出的列取固定值"""
+    return [ip, str(port), 'true', colo, location, 'Asia', 'City', '亚洲', country, '城市', 'x', latency, speed]
+
+
+def write_csv(path, rows, header=HEADER_FIELDS, delimiter=','):
+    """写出CSV并返回路径字符串；每行为字段列表或拼好的字符串，header为None时不写表头"""
+    lines = [] if header is None else [delimiter.join(header)]
+    lines += [row if isinstance(row, str) else delimiter.join(row) for row in rows]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(''.join(line + '\n' for line in lines), encoding='utf-8')
+    return str(path)
+
+
+def read_lines(path):
+    """按空白拆分的文件内容，用于比较输出的IP文件"""
+    with open(path, encoding='utf-8') as f:
+        return f.read().split()
+
+
+@pytest.fixture
+def csv_file(tmp_path):
+    """CSV文件工厂：csv_file(tmp_path下的相对路径, rows, header=..., delimiter=...)，返回路径字符串"""
+    def make(name, rows, **kwargs):
+        return write_csv(tmp_path / name, rows, **kwargs)
+    return make
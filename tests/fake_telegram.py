@@ -0,0 +1,94 @@
+"""测试用的假Telegram客户端：只实现 TelegramDownloader 用到的 get_entity、iter_messages、download_media，
+以及监听模式用到的 add_event_handler、run_until_disconnected（事件由测试调用 emit 触发）"""
+import asyncio
+import os
+import shutil
+import types
+from datetime import datetime, timezone
+
+_sleep = asyncio.sleep  # 测试中可能替换 asyncio.sleep，假客户端的模拟耗时始终真实等待
+
+
+class FloodWaitError(Exception):
+    """与telethon同名的限流错误，下载器按类名识别并等待seconds秒"""
+
+    def __init__(self, seconds):
+        super().__init__(f"A wait of {seconds} seconds is required")
+        self.seconds = seconds
+
+
+def make_message(message_id, filename, source_path, date=None):
+    """带CSV文档的消息，文档内容取自source_path"""
+    size = os.path.getsize(source_path)
+    document = types.SimpleNamespace(
+        id=1000 + message_id, size=size, attributes=[types.SimpleNamespace(file_name=filename)],
+    )
+    return types.SimpleNamespace(
+        id=message_id, date=date or datetime.now(timezone.utc),
+        media=types.SimpleNamespace(document=document), file=types.SimpleNamespace(size=size, name=filename),
+        source_path=source_path,
+    )
+
+
+def fake_telethon():
+    """代替telethon模块，只提供监听模式用到的 events.NewMessage"""
+    module = types.ModuleType('telethon')
+    module.events = types.SimpleNamespace(NewMessage=lambda chats=None: types.SimpleNamespace(chats=chats))
+    return module
+
+
+class FakeClient:
+    """按消息ID从新到旧返回消息；download_media 复制源文件，可按消息设置耗时和失败"""
+
+    def __init__(self, messages, delays=None, failures=None):
+        self.messages = messages
+        self.delays = delays or {}
+        # 消息ID -> 依次抛出的异常列表，用完后正常下载
+        self.failures = {message_id: list(errors) for message_id, errors in (failures or {}).items()}
+        self.active = 0
+        self.peak = 0
+        self.download_calls = []
+        self.iter_kwargs = []
+        self.handlers = []
+        self._disconnected = None
+
+    async def get_entity(self, name):
+        return types.SimpleNamespace(title=name, id=1)
+
+    async def iter_messages(self, channel, limit=None, min_id=0, **kwargs):
+        self.iter_kwargs.append(dict(limit=limit, min_id=min_id, **kwargs))
+        # 与telethon一致：先按min_id过滤，limit为返回的条数上限，None为不限
+        newer = [message for message in self.messages if message.id > (min_id or 0)]
+        for message in sorted(newer, key=lambda message: -message.id)[:limit]:
+            yield message
+
+    async def download_media(self, message, file=None, **kwargs):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        self.download_calls.append(message.id)
+        try:
+            await _sleep(self.delays.get(message.id, 0))
+            errors = self.failures.get(message.id)
+            if errors:
+                raise errors.pop(0)
+            shutil.copyfile(message.source_path, file)
+            return file
+        finally:
+            self.active -= 1
+
+    def add_event_handler(self, handler, event):
+        self.handlers.append((handler, event))
+
+    async def emit(self, message):
+        """模拟频道收到新消息：加入消息列表并依次调用事件处理函数"""
+        self.messages.append(message)
+        for handler, _ in self.handlers:
+            await handler(types.SimpleNamespace(message=message))
+
+    async def run_until_disconnected(self):
+        self._disconnected = self._disconnected or asyncio.Event()
+        await self._disconnected.wait()
+
+    async def disconnect(self):
+        if self._disconnected is not None:
+            self._disconnected.set()
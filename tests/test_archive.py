@@ -0,0 +1,93 @@
+"""下载目录归档的测试：归档后的文件仍能被提取、合并和离线模式读取"""
+import asyncio
+import os
+import shutil
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row, read_lines, write_csv
+
+ROWS = [
+    channel_row('1.0.0.1'),
+    channel_row('1.0.0.2', colo='SIN', location='SG', country='新加坡', latency='60 ms', speed='900 kB/s'),
+    channel_row('1.0.0.3', port=8443, latency='70 ms', speed='800 kB/s'),
+]
+
+
+@pytest.fixture
+def archived_folder(tmp_path):
+    """一个已归档的旧文件、一个较新的原始文件，以及同内容的未归档副本（对照用）"""
+    folder = tmp_path / 'downloads'
+    folder.mkdir()
+    write_csv(folder / 'AsnALL-20200101-IP.csv', ROWS)
+    write_csv(folder / 'AsnALL-29991231-IP.csv', [channel_row('2.0.0.1', colo='FRA', location='DE', country='德国', latency='90 ms', speed='500 kB/s')])
+    reference = tmp_path / 'reference'
+    reference.mkdir()
+    write_csv(reference / 'AsnALL-20200101-IP.csv', ROWS)
+    shutil.copyfile(folder / 'AsnALL-29991231-IP.csv', reference / 'AsnALL-29991231-IP.csv')
+    archived, deleted = td.archive_old_downloads(str(folder), top_n=0, archive_after_days=7, archive_format='gzip')
+    assert (archived, deleted) == (1, 0)
+    return str(folder), str(reference)
+
+
+def test_archive_replaces_old_file_only(archived_folder):
+    folder, _ = archived_folder
+    assert sorted(os.listdir(folder)) == ['AsnALL-20200101-IP.csv.gz', 'AsnALL-29991231-IP.csv']
+
+
+def test_archive_is_off_by_default(tmp_path, csv_file):
+    csv_file('AsnALL-20200101-IP.csv', ROWS)
+    assert td.ARCHIVE_AFTER_DAYS == 0
+    assert td.archive_old_downloads(str(tmp_path), top_n=0) == (0, 0)
+    assert os.listdir(tmp_path) == ['AsnALL-20200101-IP.csv']
+
+
+def test_invalid_date_in_filename_is_skipped(tmp_path, csv_file):
+    csv_file('AsnALL-20251399-IP.csv', ROWS)
+    csv_file('AsnALL-20200101-IP.csv', ROWS)
+    assert td.archive_old_downloads(str(tmp_path), top_n=0, archive_after_days=7) == (1, 0)
+    assert sorted(os.listdir(tmp_path)) == ['AsnALL-20200101-IP.csv.gz', 'AsnALL-20251399-IP.csv']
+
+
+def test_scan_reads_archive(archived_folder):
+    folder, reference = archived_folder
+    archived = td.scan_csv_file(os.path.join(folder, 'AsnALL-20200101-IP.csv.gz'), top_n=5, ports=(443, 8443))
+    original = td.scan_csv_file(os.path.join(reference, 'AsnALL-20200101-IP.csv'), top_n=5, ports=(443, 8443))
+    assert archived.ips_443.to_strings() == ['1.0.0.1', '1.0.0.2']
+    assert archived.ips_443 == original.ips_443
+    assert archived.index == original.index
+    assert archived.ranking_all.ranked() == original.ranking_all.ranked()
+    assert archived.port_bitmap.ips_with(8443).to_strings() == ['1.0.0.3']
+
+
+def test_merge_reads_archive(archived_folder):
+    folder, reference = archived_folder
+    downloader = td.TelegramDownloader(None, None, None, None)
+    merged = downloader.merge_csv_files(td.list_local_csv_files(folder))
+    expected = downloader.merge_csv_files(td.list_local_csv_files(reference))
+    with open(merged, encoding='utf-8') as f, open(expected, encoding='utf-8') as g:
+        content = f.read()
+        assert content == g.read()
+    assert '1.0.0.3' in content and '2.0.0.1' in content
+
+
+def test_offline_mode_reads_archive(archived_folder, tmp_path, monkeypatch):
+    folder, _ = archived_folder
+    monkeypatch.chdir(tmp_path)
+    args = td.parse_args(['--offline', folder, '--workers', '1', '--no-cache', '--top-n', '0'])
+    asyncio.run(td.run_offline(args.offline, args))
+    assert read_lines(tmp_path / td.IP_FILE) == ['1.0.0.1', '1.0.0.2', '2.0.0.1']
+    assert read_lines(tmp_path / td.HK_IP_FILE) == ['1.0.0.1']
+
+
+@pytest.mark.parametrize('delete_after_days', [1, 2, td.RECENT_DAYS])
+def test_delete_keeps_recent_days(tmp_path, csv_file, delete_after_days):
+    today = td.datetime.now(td.timezone.utc).date()
+    names = [f"AsnALL-{(today - td.timedelta(days=age)).strftime('%Y%m%d')}-IP.csv" for age in range(td.RECENT_DAYS + 2)]
+    for name in names:
+        csv_file(name, ROWS)
+    archived, deleted = td.archive_old_downloads(str(tmp_path), top_n=0, delete_after_days=delete_after_days)
+    # 最近RECENT_DAYS天（含第RECENT_DAYS天）的文件不删除，仍可被提取
+    assert (archived, deleted) == (0, 1)
+    assert sorted(os.listdir(tmp_path)) == sorted(names[:td.RECENT_DAYS + 1])
@@ -0,0 +1,27 @@
+"""atomic_write 的测试：成功时整体替换，出错时保留旧文件且不留下临时文件"""
+import pytest
+
+from atomic_file import atomic_write
+
+
+def test_replaces_file_on_success(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('旧内容\n', encoding='utf-8')
+    with atomic_write(str(path)) as f:
+        f.write('新内容\n')
+    assert path.read_text(encoding='utf-8') == '新内容\n'
+    with atomic_write(str(path), 'wb') as f:
+        f.write(b'\x00\x01')
+    assert path.read_bytes() == b'\x00\x01'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a.txt']
+
+
+def test_keeps_old_file_on_error(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('旧内容\n', encoding='utf-8')
+    with pytest.raises(RuntimeError):
+        with atomic_write(str(path)) as f:
+            f.write('写了一半')
+            raise RuntimeError('中断')
+    assert path.read_text(encoding='utf-8') == '旧内容\n'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a.txt']
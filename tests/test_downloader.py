@@ -0,0 +1,192 @@
+"""TelegramDownloader 下载流程的测试，使用 fake_telegram 中的假客户端，不连接Telegram"""
+import asyncio
+import os
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row
+from fake_telegram import FakeClient, FloodWaitError, make_message
+
+
+@pytest.fixture
+def channel_files(csv_file):
+    """频道中的源文件：每个文件几行不同的IP"""
+    return [
+        csv_file(f'channel/AsnALL-2025101{index}-IP.csv', [channel_row(f'10.0.{index}.{host}') for host in range(1, 4 + index)])
+        for index in range(6)
+    ]
+
+
+@pytest.fixture
+def download_folder(tmp_path):
+    folder = tmp_path / 'downloads'
+    folder.mkdir()
+    return str(folder)
+
+
+@pytest.fixture
+def recorded_sleeps(monkeypatch):
+    """把重试等待替换为立即返回，记录等待的秒数"""
+    waits = []
+    real_sleep = asyncio.sleep
+
+    async def fake_sleep(seconds, *args, **kwargs):
+        waits.append(seconds)
+        return await real_sleep(0)
+
+    monkeypatch.setattr(td.asyncio, 'sleep', fake_sleep)
+    return waits
+
+
+def messages_for(paths):
+    """每个文件一条消息，消息ID和发布时间按文件顺序递增"""
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    return [make_message(index + 1, os.path.basename(path), path, start + timedelta(minutes=index))
+            for index, path in enumerate(paths)]
+
+
+def make_downloader(client, max_concurrent_downloads=2):
+    return td.TelegramDownloader(1, 'hash', '+10000000000', 'test_channel', client=client,
+                                 max_concurrent_downloads=max_concurrent_downloads)
+
+
+def test_downloads_respect_concurrency_limit(channel_files, download_folder):
+    client = FakeClient(messages_for(channel_files), delays={message_id: 0.05 for message_id in range(1, 7)})
+    downloader = make_downloader(client, max_concurrent_downloads=2)
+
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+
+    assert len(files) == 6
+    assert client.peak == 2
+    assert sorted(client.download_calls) == [1, 2, 3, 4, 5, 6]
+    for path in files:
+        with open(path, 'rb') as f, open(os.path.join(os.path.dirname(channel_files[0]), os.path.basename(path)), 'rb') as source:
+            assert f.read() == source.read()
+
+
+def test_output_order_is_message_order_not_completion_order(channel_files, download_folder):
+    # 越新的消息下载越慢，完成顺序与消息顺序相反
+    delays = {message_id: 0.01 * message_id for message_id in range(1, 7)}
+    client = FakeClient(messages_for(channel_files), delays=delays)
+    downloader = make_downloader(client, max_concurrent_downloads=6)
+
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+
+    expected = [os.path.join(download_folder, os.path.basename(path)) for path in reversed(channel_files)]
+    assert files == expected
+    # 第二次运行时没有新消息，复用之前的文件，顺序不变
+    assert asyncio.run(downloader.download_todays_csv_files(download_folder)) == expected
+    assert client.iter_kwargs[-1]['min_id'] == 6
+
+
+def test_retry_waits_for_flood_wait_and_backoff(channel_files, download_folder, recorded_sleeps):
+    td.METRICS.reset()
+    failures = {2: [FloodWaitError(7)], 3: [ConnectionError('reset'), ConnectionError('reset')]}
+    client = FakeClient(messages_for(channel_files[:3]), failures=failures)
+    downloader = make_downloader(client)
+
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+
+    assert len(files) == 3
+    assert client.download_calls.count(2) == 2 and client.download_calls.count(3) == 3
+    # 限流按服务器要求的秒数等待；普通错误按 1、2 秒指数退避
+    assert sorted(recorded_sleeps) == [1, 2, 7]
+    counters = {name: value for (name, labels), value in td.METRICS.counters.items() if not labels}
+    assert counters['flood_waits'] == 1
+    assert counters['download_retries'] == 3
+
+
+def text_messages(first_id, count, date):
+    """不带文档的普通消息"""
+    return [types.SimpleNamespace(id=message_id, date=date, media=None, file=None)
+            for message_id in range(first_id, first_id + count)]
+
+
+def test_more_new_messages_than_one_page_are_all_scanned(channel_files, download_folder):
+    now = datetime.now(timezone.utc)
+    # 早于最近RECENT_DAYS天的消息之后停止获取，其中的CSV不下载
+    old = make_message(1, os.path.basename(channel_files[0]), channel_files[0], now - timedelta(days=td.RECENT_DAYS + 1))
+    first = make_message(2, os.path.basename(channel_files[1]), channel_files[1], now - timedelta(hours=2))
+    client = FakeClient([old, first] + text_messages(3, 250, now - timedelta(hours=2)))
+    downloader = make_downloader(client)
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+    assert [os.path.basename(path) for path in files] == [os.path.basename(channel_files[1])]
+    assert client.iter_kwargs[-1]['limit'] is None
+
+    # 游标之后有300多条新消息，最早的一条新消息也要下载
+    client.messages += [make_message(253, os.path.basename(channel_files[2]), channel_files[2], now - timedelta(hours=1))]
+    client.messages += text_messages(254, 300, now - timedelta(hours=1))
+    client.messages += [make_message(554, os.path.basename(channel_files[3]), channel_files[3], now)]
+    client.download_calls.clear()
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+    assert client.iter_kwargs[-1]['min_id'] == 252
+    assert sorted(client.download_calls) == [253, 554]
+    assert [os.path.basename(path) for path in files] == [os.path.basename(path) for path in (channel_files[3], channel_files[2], channel_files[1])]
+    state = downloader.load_channel_state(os.path.join(download_folder, td.CHANNEL_STATE_FILENAME))
+    assert state['channels']['test_channel']['max_id'] == 554
+
+
+def test_failed_download_is_retried_next_run(channel_files, download_folder, recorded_sleeps):
+    failures = {2: [ConnectionError('reset')] * 3}
+    client = FakeClient(messages_for(channel_files[:3]), failures=failures)
+    downloader = make_downloader(client)
+
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+
+    assert [os.path.basename(path) for path in files] == [os.path.basename(channel_files[2]), os.path.basename(channel_files[0])]
+    assert not any(name.endswith('.part') for name in os.listdir(download_folder))
+    # 失败的消息不越过游标，下次运行重新获取并下载
+    client.download_calls.clear()
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+    assert client.iter_kwargs[-1]['min_id'] == 1
+    assert client.download_calls == [2]
+    assert len(files) == 3
+
+
+@pytest.mark.parametrize('verify_hash', [False, True])
+def test_damaged_file_behind_cursor_is_downloaded_again(channel_files, download_folder, monkeypatch, verify_hash):
+    monkeypatch.setattr(td, 'VERIFY_CACHED_HASH', verify_hash)
+    client = FakeClient(messages_for(channel_files[:3]))
+    downloader = make_downloader(client)
+    asyncio.run(downloader.download_todays_csv_files(download_folder))
+    victim = os.path.join(download_folder, os.path.basename(channel_files[1]))
+    with open(victim, 'r+b') as f:
+        if verify_hash:
+            # 大小不变、内容被改动，只有校验SHA256时才能发现
+            f.seek(-3, os.SEEK_END)
+            f.write(b'XXX')
+        else:
+            f.truncate(50)
+
+    client.download_calls.clear()
+    files = asyncio.run(downloader.download_todays_csv_files(download_folder))
+
+    # 游标归零重新扫描，只重新下载被改动的文件
+    assert client.iter_kwargs[-1]['min_id'] == 0
+    assert client.download_calls == [2]
+    assert len(files) == 3
+    with open(victim, 'rb') as f, open(channel_files[1], 'rb') as source:
+        assert f.read() == source.read()
+    client.download_calls.clear()
+    asyncio.run(downloader.download_todays_csv_files(download_folder))
+    assert client.iter_kwargs[-1]['min_id'] == 3 and client.download_calls == []
+
+
+def test_current_files_skips_damaged_file(channel_files, download_folder):
+    client = FakeClient(messages_for(channel_files[:3]))
+    downloader = make_downloader(client)
+    asyncio.run(downloader.download_todays_csv_files(download_folder))
+    victim = os.path.join(download_folder, os.path.basename(channel_files[0]))
+    with open(victim, 'r+b') as f:
+        f.truncate(10)
+
+    source = td.TelegramSource(downloader, 'test_channel', download_folder)
+    assert victim not in source.current_files()
+    assert len(source.current_files()) == 2
+    # 下次运行从头扫描，重新下载
+    client.download_calls.clear()
+    asyncio.run(downloader.download_todays_csv_files(download_folder))
+    assert client.iter_kwargs[-1]['min_id'] == 0 and client.download_calls == [1]
@@ -0,0 +1,79 @@
+"""CSV中443端口IP提取的测试"""
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row
+
+
+def test_advanced_keeps_443_rows_whose_speed_contains_other_ports(csv_file):
+    # 旧的逐行实现会因为 1443/8443 字样排除整行
+    path = csv_file('a.csv', [
+        channel_row('1.1.1.1', speed='1443 kB/s'),
+        channel_row('2.2.2.2', latency='8443 ms'),
+        channel_row('3.3.3.3', port=8443, latency='443 ms'),
+        channel_row('4.4.4.4', port=1443, speed='443 kB/s'),
+        '5.5.5.5:443',
+    ])
+    downloader = td.TelegramDownloader(None, None, None, None)
+    assert downloader.extract_443_ips_advanced(path) == ['1.1.1.1', '2.2.2.2', '5.5.5.5']
+    assert td.scan_csv_file(path, ports=(443,)).ips_443.to_strings() == ['1.1.1.1', '2.2.2.2']
+
+
+@pytest.fixture
+def channel_files(csv_file):
+    """一个HK优选文件和两个普通文件"""
+    return [
+        csv_file('IataHK.csv-20251016-IP.csv', [
+            channel_row('1.0.0.1', colo='HKG', location='XX', country='香港'),
+            channel_row('1.0.0.2', colo='NRT', location='XX', country='日本'),
+            channel_row('1.0.0.3', port=8443, colo='HKG', location='XX', country='香港'),
+        ]),
+        csv_file('AsnALL-20251016-IP.csv', [
+            channel_row('2.0.0.1', colo='SIN', location='XX', country='新加坡'),
+            channel_row('2.0.0.2', colo='HKG', location='XX', country='香港'),
+            channel_row('2.0.0.3', port=80, colo='SIN', location='XX', country='新加坡'),
+        ]),
+        csv_file('AsnALL-20251015-IP.csv', [
+            channel_row('3.0.0.1', colo='FRA', location='XX', country='新加坡'),
+            channel_row('2.0.0.1', colo='SIN', location='XX', country='新加坡'),
+        ]),
+    ]
+
+
+def test_each_file_is_parsed_once_for_all_buckets(channel_files, monkeypatch):
+    paths = channel_files
+    opened = []
+    open_text = td.open_text
+
+    def counting_open(path, *args, **kwargs):
+        opened.append(path)
+        return open_text(path, *args, **kwargs)
+
+    monkeypatch.setattr(td, 'open_text', counting_open)
+    buckets, preferred_files, _ = td.extract_buckets_from_files(
+        paths, region_rules=td.build_region_rules(['HK', 'SG']), backend='csv', workers=1, top_n=0, use_cache=False)
+
+    assert sorted(opened) == sorted(paths)
+    assert preferred_files == {'HK': [paths[0]], 'SG': []}
+    assert buckets['all'].to_strings() == ['1.0.0.1', '1.0.0.2', '2.0.0.1', '2.0.0.2', '3.0.0.1']
+    # 有优选文件时区域IP只取优选文件，否则按其他文件的区域索引查找
+    assert buckets['HK'].to_strings() == ['1.0.0.1', '1.0.0.2']
+    assert buckets['SG'].to_strings() == ['2.0.0.1', '3.0.0.1']
+
+
+def test_single_pass_matches_per_bucket_extractors(channel_files, monkeypatch):
+    paths = channel_files
+    monkeypatch.setattr(td, 'REGION_RULES', td.build_region_rules(['HK', 'SG']))
+    downloader = td.TelegramDownloader(None, None, None, None)
+    buckets, _, _ = downloader.extract_all_buckets(paths, backend='csv', workers=1, top_n=0, use_cache=False)
+
+    all_ips = set()
+    for path in paths:
+        all_ips.update(downloader.extract_443_ips_from_csv(path))
+    assert buckets['all'].to_strings() == td.IPSet(all_ips).to_strings()
+    preferred, others = downloader.find_region_preferred_files(paths)
+    assert buckets['HK'].to_strings() == downloader.extract_ips_from_preferred_files(preferred['HK'])
+    sg_ips = set()
+    for path in others:
+        sg_ips.update(downloader.extract_region_ips_from_other_files(path, 'SG'))
+    assert buckets['SG'].to_strings() == td.IPSet(sg_ips).to_strings()
@@ -0,0 +1,185 @@
+"""IP历史观测库的测试：提交与回滚、重复导入、窗口统计，以及区域文件中的排序优先级"""
+import asyncio
+import os
+import subprocess
+import sys
+from datetime import date
+
+import pytest
+
+import history_store
+import telegram_downloader as td
+from conftest import ROOT, channel_row, write_csv
+from history_store import HistoryStore, IPStats
+from ip_set import ip_to_int
+
+DAY = date(2025, 10, 1).toordinal()
+
+
+def observations(*ips, colo='HKG', latency=50.0, speed=1000.0, port=443):
+    return [(ip_to_int(ip), port, colo, latency, speed) for ip in ips]
+
+
+def write_scored_csv(path, rows):
+    return write_csv(path, [channel_row(ip, latency=f'{latency} ms', speed=f'{speed} kB/s')
+                            for ip, latency, speed in rows])
+
+
+def test_uncommitted_import_is_rolled_back(tmp_path):
+    folder = str(tmp_path)
+    store = HistoryStore(folder)
+    store.ingest('a.csv', DAY, observations('1.1.1.1', '1.1.1.2'))
+    store.commit()
+    committed_size = os.path.getsize(store.log_path)
+
+    # 第二个文件已写入日志，但进程在提交前退出
+    store.ingest('b.csv', DAY + 1, observations('1.1.1.1', '1.1.1.3'))
+    assert os.path.getsize(store.log_path) > committed_size
+    # 模拟写完新一代累计指标、还没替换meta.json时中断
+    with open(store._stats_path(store.meta['generation'] + 1), 'wb') as f:
+        f.write(b'partial')
+
+    reopened = HistoryStore(folder)
+    assert os.path.getsize(reopened.log_path) == committed_size
+    assert reopened.record_count() == 2
+    assert not reopened.is_ingested('b.csv')
+    assert (ip_to_int('1.1.1.3'), 443) not in reopened.stats
+    assert reopened.stats[(ip_to_int('1.1.1.1'), 443)].days_seen == 1
+    assert sorted(os.listdir(folder)) == ['ip_stats.1.bin', 'meta.json', 'observations.bin']
+    assert len(reopened.read_observations()) == 2
+
+    # 回滚后重新导入得到与一次性导入相同的结果
+    reopened.ingest('b.csv', DAY + 1, observations('1.1.1.1', '1.1.1.3'))
+    reopened.commit()
+    final = HistoryStore(folder)
+    assert final.record_count() == 4
+    assert final.stats[(ip_to_int('1.1.1.1'), 443)].days_seen == 2
+
+
+def test_failed_read_leaves_stats_untouched(tmp_path):
+    store = HistoryStore(str(tmp_path))
+
+    def broken():
+        yield from observations('1.1.1.1')
+        raise ValueError('文件读取中断')
+
+    with pytest.raises(ValueError):
+        store.ingest('a.csv', DAY, broken())
+    assert store.stats == {}
+    assert store.record_count() == 0
+    assert not store.is_ingested('a.csv')
+
+
+def test_same_file_is_not_imported_twice(tmp_path):
+    csv_path = write_scored_csv(tmp_path / 'AsnALL-20251001-IP.csv', [('1.1.1.1', 50, 1000), ('1.1.1.2', 60, 900)])
+    folder = str(tmp_path / 'history')
+
+    store = td.record_history([csv_path], folder)
+    assert store.record_count() == 2
+
+    again = td.record_history([csv_path], folder)
+    assert again.record_count() == 2
+    record = again.stats[(ip_to_int('1.1.1.1'), 443)]
+    assert (record.observations, record.days_seen) == (1, 1)
+
+
+def test_same_file_after_archiving_is_not_imported_again(tmp_path):
+    csv_path = write_scored_csv(tmp_path / 'AsnALL-20251001-IP.csv', [('1.1.1.1', 50, 1000)])
+    folder = str(tmp_path / 'history')
+    td.record_history([csv_path], folder)
+    archive_path = td.compress_file(csv_path)
+    assert td.record_history([archive_path], folder).record_count() == 1
+
+
+def test_invalid_date_in_filename_is_skipped(tmp_path):
+    good = write_scored_csv(tmp_path / 'AsnALL-20251001-IP.csv', [('1.1.1.1', 50, 1000)])
+    bad = write_scored_csv(tmp_path / 'AsnALL-20251399-IP.csv', [('1.1.1.2', 50, 1000)])
+    store = td.record_history([bad, good], str(tmp_path / 'history'))
+    assert store.record_count() == 1
+
+
+def test_window_and_decayed_stats():
+    record = IPStats(1, 443)
+    record.observe(DAY, 0, 100.0, 1000.0, decay=0.5)
+    record.observe(DAY + 2, 0, 50.0, 3000.0, decay=0.5)
+    # 同一天的第二条观测不增加天数
+    record.observe(DAY + 2, 0, float('nan'), float('nan'), decay=0.5)
+    # 乱序补录更早的一天
+    record.observe(DAY - 1, 0, float('nan'), float('nan'), decay=0.5)
+
+    assert (record.first_seen, record.last_seen) == (DAY - 1, DAY + 2)
+    assert (record.days_seen, record.observations) == (3, 4)
+    assert record.day_mask == 0b1101
+    assert record.days_in_window(DAY + 2, 1) == 1
+    assert record.days_in_window(DAY + 2, 3) == 2
+    assert record.days_in_window(DAY + 2, 30) == 3
+    assert record.days_in_window(DAY + 4, 3) == 1
+    assert record.days_in_window(DAY + 40, 30) == 0
+    # 两天前的观测权重为 0.5**2
+    assert record.avg_speed == pytest.approx((3000 + 1000 * 0.25) / 1.25)
+    assert record.avg_latency == pytest.approx((50 + 100 * 0.25) / 1.25)
+
+
+def test_window_bitmap_drops_days_older_than_64():
+    record = IPStats(1, 443)
+    record.observe(DAY, 0, 50.0, 1000.0)
+    record.observe(DAY + 70, 0, 50.0, 1000.0)
+    assert record.days_seen == 2
+    assert record.day_mask == 1
+    assert record.days_in_window(DAY + 70, 64) == 1
+
+
+def test_top_ips_and_order_by_stability(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    for offset in range(5):
+        store.ingest(f'day{offset}.csv', DAY + offset, observations('1.1.1.1', speed=500.0))
+    store.ingest('day3b.csv', DAY + 3, observations('2.2.2.2', speed=5000.0))
+    store.ingest('day4b.csv', DAY + 4, observations('3.3.3.3', colo='SIN', speed=100.0) + observations('2.2.2.2', speed=5000.0))
+    store.commit()
+
+    reopened = HistoryStore(str(tmp_path))
+    top = reopened.top_ips(colo='HKG', days=30)
+    assert [(item['ip'], item['days_in_window']) for item in top] == [('1.1.1.1', 5), ('2.2.2.2', 2)]
+    assert top[0]['first_seen'] == '2025-10-01' and top[0]['last_seen'] == '2025-10-05'
+    assert [item['ip'] for item in reopened.top_ips(days=2)] == ['2.2.2.2', '1.1.1.1', '3.3.3.3']
+    assert reopened.top_ips(colo='LAX') == []
+    unknown = ip_to_int('4.4.4.4')
+    ordered = reopened.order_by_stability([unknown, ip_to_int('3.3.3.3'), ip_to_int('1.1.1.1')], days=30)
+    assert ordered == [ip_to_int('1.1.1.1'), ip_to_int('3.3.3.3'), unknown]
+
+
+def test_history_cli(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.ingest('a.csv', DAY, observations('1.1.1.1', '1.1.1.2'))
+    store.commit()
+    completed = subprocess.run(
+        [sys.executable, history_store.__file__, str(tmp_path), '--colo', 'hkg', '--limit', '1'],
+        capture_output=True, text=True, cwd=ROOT,
+    )
+    assert completed.returncode == 0, completed.stderr
+    assert completed.stdout.count('\n') == 1 and '"ip": "1.1.1.1"' in completed.stdout
+
+
+def test_ranking_takes_precedence_over_stability(tmp_path, monkeypatch):
+    """RANK_TOP_N的评分顺序不被稳定性打乱，稳定性只决定评分相同的IP的先后"""
+    downloads = tmp_path / 'downloads'
+    downloads.mkdir()
+    # 1.1.1.1 连续多天出现但评分低；1.1.1.2 只出现一天、评分最高；1.1.1.3 与 1.1.1.4 评分相同
+    for day in range(1, 6):
+        write_scored_csv(downloads / f'AsnALL-2025100{day}-IP.csv', [('1.1.1.1', 100, 1000), ('1.1.1.4', 50, 2000)])
+    write_scored_csv(downloads / 'AsnALL-20251006-IP.csv', [
+        ('1.1.1.1', 100, 1000), ('1.1.1.2', 10, 9000), ('1.1.1.3', 50, 2000), ('1.1.1.4', 50, 2000),
+    ])
+    monkeypatch.setattr(td, 'HISTORY_DIR', str(tmp_path / 'history'))
+    monkeypatch.chdir(tmp_path)
+
+    args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--no-cache', '--top-n', '4'])
+    asyncio.run(td.run_offline(args.offline, args))
+    with open(tmp_path / td.HK_IP_FILE, encoding='utf-8') as f:
+        assert f.read().split() == ['1.1.1.2', '1.1.1.4', '1.1.1.3', '1.1.1.1']
+
+    # 不启用排名时按稳定性排序
+    args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--no-cache', '--top-n', '0'])
+    asyncio.run(td.run_offline(args.offline, args))
+    with open(tmp_path / td.HK_IP_FILE, encoding='utf-8') as f:
+        assert f.read().split()[:2] == ['1.1.1.4', '1.1.1.1']
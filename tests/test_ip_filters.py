@@ -0,0 +1,50 @@
+"""白名单/黑名单过滤和CIDR输出的测试"""
+import asyncio
+
+import telegram_downloader as td
+from conftest import channel_row, read_lines
+from ip_set import IPSet, PrefixIndex
+
+
+def test_denylisted_prefix_removes_ips():
+    buckets = {'all': IPSet(['1.1.1.1', '1.1.2.5', '2.2.2.2']), 'HK': IPSet(['1.1.2.5'])}
+    filtered = td.filter_buckets(buckets, deny=PrefixIndex(['1.1.2.0/24']))
+    assert filtered['all'].to_strings() == ['1.1.1.1', '2.2.2.2']
+    assert filtered['HK'].to_strings() == []
+
+
+def test_allowlist_keeps_only_covered_ips():
+    buckets = {'all': IPSet(['1.1.1.1', '1.1.2.5', '2.2.2.2', '3.3.3.3'])}
+    filtered = td.filter_buckets(buckets, allow=PrefixIndex(['1.1.0.0/16', '3.3.3.3']))
+    assert filtered['all'].to_strings() == ['1.1.1.1', '1.1.2.5', '3.3.3.3']
+    # 同时配置时先取白名单，再去掉黑名单
+    filtered = td.filter_buckets(buckets, allow=PrefixIndex(['1.1.0.0/16']), deny=PrefixIndex(['1.1.1.0/24']))
+    assert filtered['all'].to_strings() == ['1.1.2.5']
+    assert td.filter_buckets(buckets) is buckets
+
+
+def test_prefix_files_ignore_comments_and_bad_lines(csv_file):
+    allow_path = csv_file('allow.txt', ['# 注释', '1.1.0.0/16  # 行尾注释', '', 'not-a-prefix', '9.9.9.9'], header=None)
+    allow, deny = td.load_ip_filters(allow_path, None)
+    assert deny is None
+    assert len(allow) == 2 and allow.address_count() == 65537
+    assert '1.1.200.1' in allow and '9.9.9.9' in allow and '9.9.9.8' not in allow
+
+
+def test_filters_and_cidr_output_end_to_end(tmp_path, csv_file, monkeypatch):
+    downloads = tmp_path / 'downloads'
+    rows = [channel_row(f'1.1.1.{host}') for host in range(0, 8)]
+    rows += [channel_row('1.1.9.9'), channel_row('5.5.5.5', colo='SIN', location='SG', country='新加坡')]
+    csv_file('downloads/AsnALL-20251016-IP.csv', rows)
+    monkeypatch.setattr(td, 'ALLOWLIST_FILE', csv_file('allow.txt', ['1.1.0.0/16'], header=None))
+    monkeypatch.setattr(td, 'DENYLIST_FILE', csv_file('deny.txt', ['1.1.9.0/24'], header=None))
+    monkeypatch.chdir(tmp_path)
+
+    args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--no-cache', '--top-n', '0', '--cidr'])
+    asyncio.run(td.run_offline(args.offline, args))
+
+    assert read_lines(tmp_path / 'ip.txt') == [f'1.1.1.{host}' for host in range(8)]
+    assert read_lines(tmp_path / 'ip-cidr.txt') == ['1.1.1.0/29']
+    assert read_lines(tmp_path / 'hkip-cidr.txt') == ['1.1.1.0/29']
+    # SG的IP全部被白名单过滤掉，不写出文件
+    assert not (tmp_path / 'sgip.txt').exists()
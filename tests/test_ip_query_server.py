@@ -0,0 +1,173 @@
+"""ip_query_server 的本机测试：用临时结果快照启动服务（端口由系统分配），通过HTTP查询"""
+import asyncio
+import json
+import os
+
+from ip_query_server import QueryServer, ResultIndex
+
+
+def record(ip, colo, latency, speed=1000.0, port=443, regions=(), probe=None):
+    return {'ip': ip, 'port': port, 'colo': colo, 'regions': list(regions), 'latency_ms': latency,
+            'speed_kbps': speed, 'probe_ms': probe, 'last_seen': '2025-10-16'}
+
+
+SNAPSHOT = {
+    'version': 1,
+    'generated_at': 1760000000.0,
+    'probed': False,
+    'records': [
+        record('1.0.0.1', 'HKG', 120.0, regions=['HK']),
+        record('1.0.0.2', 'HKG', 50.0, speed=500.0, regions=['HK']),
+        record('1.0.0.3', 'HKG', 50.0, speed=900.0, regions=['HK']),
+        record('1.0.0.4', 'HKG', None),
+        record('1.0.0.5', 'SIN', 30.0, regions=['SG']),
+        record('1.0.0.6', 'HKG', 200.0, probe=20.0, regions=['HK']),
+        record('1.0.0.7', 'HKG', 10.0, port=8443),
+    ],
+}
+
+
+def write_snapshot(path, snapshot):
+    temp_path = str(path) + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(temp_path, path)
+
+
+async def request(reader, writer, target, headers=None):
+    """在keep-alive连接上发送一个GET请求，返回 (状态码, 响应头, 响应体)"""
+    lines = [f"GET {target} HTTP/1.1", "Host: localhost"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    head = (await reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+    response_headers = {}
+    for line in head[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            response_headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(response_headers.get('content-length', 0)))
+    return int(head[0].split(' ')[1]), response_headers, body
+
+
+def run_with_server(path, scenario, reload_interval=0.05):
+    """启动服务，建立一个连接后执行 scenario(reader, writer, server)"""
+    async def run():
+        server = QueryServer(str(path), reload_interval)
+        port = await server.start('127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            return await scenario(reader, writer, server)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+            await server.close()
+
+    return asyncio.run(run())
+
+
+def test_query_filters_and_order(tmp_path):
+    path = tmp_path / 'results.json'
+    write_snapshot(path, SNAPSHOT)
+
+    async def scenario(reader, writer, server):
+        return {
+            target: await request(reader, writer, target)
+            for target in [
+                '/ips?colo=HKG',
+                '/ips?colo=hkg&max_latency=80',
+                '/ips?colo=HKG&max_latency=80&limit=2',
+                '/ips?region=SG',
+                '/ips?port=8443',
+                '/ips?colo=SIN&region=HK',
+                '/ips?colo=HKG&limit=1&format=json',
+            ]
+        }
+
+    responses = run_with_server(path, scenario)
+    text = {target: body.decode().split() for target, (_, _, body) in responses.items()}
+    # 按延迟从低到高（有探测结果时取探测延迟），延迟相同按速度从高到低，无延迟的排在最后
+    assert text['/ips?colo=HKG'] == ['1.0.0.6', '1.0.0.3', '1.0.0.2', '1.0.0.1', '1.0.0.4']
+    assert text['/ips?colo=hkg&max_latency=80'] == ['1.0.0.6', '1.0.0.3', '1.0.0.2']
+    assert text['/ips?colo=HKG&max_latency=80&limit=2'] == ['1.0.0.6', '1.0.0.3']
+    assert text['/ips?region=SG'] == ['1.0.0.5']
+    assert text['/ips?port=8443'] == ['1.0.0.7']
+    assert text['/ips?colo=SIN&region=HK'] == []
+    status, headers, body = responses['/ips?colo=HKG&limit=1&format=json']
+    assert status == 200 and headers['content-type'].startswith('application/json')
+    assert json.loads(body) == [SNAPSHOT['records'][5]]
+
+
+def test_etag_and_not_modified(tmp_path):
+    path = tmp_path / 'results.json'
+    write_snapshot(path, SNAPSHOT)
+
+    async def scenario(reader, writer, server):
+        first = await request(reader, writer, '/ips?colo=HKG')
+        etag = first[1]['etag']
+        return (first,
+                await request(reader, writer, '/ips?colo=HKG', {'If-None-Match': etag}),
+                await request(reader, writer, '/ips?colo=HKG', {'If-None-Match': f'"other", W/{etag}'}),
+                await request(reader, writer, '/ips?colo=HKG', {'If-None-Match': '"other"'}))
+
+    first, cached, weak, other = run_with_server(path, scenario)
+    assert first[0] == 200 and first[1]['etag'].startswith('"')
+    assert cached[0] == 304 and cached[2] == b'' and cached[1]['etag'] == first[1]['etag']
+    assert weak[0] == 304
+    assert other[0] == 200 and other[2] == first[2]
+
+
+def test_bad_parameters_return_400(tmp_path):
+    path = tmp_path / 'results.json'
+    write_snapshot(path, SNAPSHOT)
+    targets = ['/ips?limit=x', '/ips?limit=-1', '/ips?port=0', '/ips?max_latency=abc',
+               '/ips?max_latency=nan', '/ips?format=xml']
+
+    async def scenario(reader, writer, server):
+        return [(await request(reader, writer, target))[0] for target in targets] + \
+               [(await request(reader, writer, '/missing'))[0]]
+
+    assert run_with_server(path, scenario) == [400] * len(targets) + [404]
+
+
+def test_hot_reload_when_results_change(tmp_path):
+    path = tmp_path / 'results.json'
+    write_snapshot(path, SNAPSHOT)
+    updated = dict(SNAPSHOT, generated_at=SNAPSHOT['generated_at'] + 86400,
+                   records=[record('2.0.0.1', 'HKG', 40.0)])
+
+    async def scenario(reader, writer, server):
+        before = await request(reader, writer, '/ips?colo=HKG')
+        write_snapshot(path, updated)
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            if server.index.generated_at == updated['generated_at']:
+                break
+        after = await request(reader, writer, '/ips?colo=HKG', {'If-None-Match': before[1]['etag']})
+        # 无法解析的快照不替换已加载的数据
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"version": 1, "records": [')
+        await server.reload_if_changed()
+        broken = await request(reader, writer, '/ips?colo=HKG')
+        status = json.loads((await request(reader, writer, '/status'))[2])
+        return before, after, broken, status
+
+    before, after, broken, status = run_with_server(path, scenario)
+    assert before[2].decode().split()[0] == '1.0.0.6'
+    assert after[0] == 200 and after[2] == b'2.0.0.1\n' and after[1]['etag'] != before[1]['etag']
+    assert broken[2] == b'2.0.0.1\n'
+    assert status['records'] == 1 and status['generated_at'] == updated['generated_at']
+
+
+def test_missing_snapshot_returns_503(tmp_path):
+    async def scenario(reader, writer, server):
+        return await request(reader, writer, '/ips')
+
+    assert run_with_server(tmp_path / 'missing.json', scenario)[0] == 503
+
+
+def test_result_index_intersection_and_limit():
+    index = ResultIndex(SNAPSHOT)
+    assert [item['ip'] for item in index.query(colo='HKG', region='HK', limit=2)] == ['1.0.0.6', '1.0.0.3']
+    assert index.query(colo='NRT') == []
+    assert index.status()['colos'] == ['HKG', 'SIN']
@@ -0,0 +1,130 @@
+"""ip_set 的测试：NumPy路径与纯Python路径结果一致，CIDR聚合与 ipaddress 一致"""
+import ipaddress
+import random
+
+import pytest
+
+import ip_set
+import telegram_downloader as td
+from ip_set import IPSet, PortBitmap, PrefixIndex, int_to_ip, ip_to_int, normalize_ip, parse_cidr
+
+BACKENDS = ['numpy', 'python']
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request, monkeypatch):
+    """在NumPy（已安装时）和纯Python两条路径下各运行一次"""
+    if request.param == 'numpy':
+        if ip_set.np is None:
+            pytest.skip('未安装numpy')
+    else:
+        monkeypatch.setattr(ip_set, 'np', None)
+    return request.param
+
+
+def random_ips(seed, count, network='10.0.0.0', spread=4096):
+    rng = random.Random(seed)
+    base = ip_to_int(network)
+    return [int_to_ip(base + rng.randrange(spread)) for _ in range(count)]
+
+
+def run_operations():
+    """一组覆盖各种集合运算的操作，返回可比较的结果"""
+    a = IPSet.from_strings(random_ips(1, 500) + ['bad', '1.2.3', '256.1.1.1'])
+    b = IPSet(random_ips(2, 500) + [ip_to_int('10.0.0.1')])
+    c = IPSet.union_all([a, b, IPSet(), ['192.168.0.1', '2.0.0.1']])
+    bitmap = PortBitmap.from_port_sets([443, 8443, 2053], {443: a, 8443: b, 2053: IPSet(['2.0.0.1'])})
+    merged = PortBitmap.union_all([bitmap, PortBitmap.from_port_sets([443, 8443, 2053], {2053: a})])
+    index = PrefixIndex(['10.0.0.0/22', '10.0.8.0/24', '10.0.8.128/25', 'garbage', '192.168.0.1'])
+    probes = ['10.0.0.1', '10.0.15.255', '2.0.0.1', '192.168.0.1', 'nope', ip_to_int('10.0.3.3')]
+    return {
+        'a': list(a), 'b': list(b), 'union': list(c), 'or': list(a | b),
+        'and': list(a & b), 'sub': list(a - b), 'ranges': c.ranges(), 'cidrs': c.to_cidrs(),
+        'contains': [ip in c for ip in probes],
+        'bitmap_ips': list(bitmap.ips), 'bitmap_bits': bitmap.bits_to_bytes(),
+        'ips_with': [list(merged.ips_with(port)) for port in merged.ports],
+        'ports_of': [merged.ports_of(ip) for ip in probes],
+        'allow': list(index.select(c, inside=True)), 'deny': list(index.select(c, inside=False)),
+        'index_contains': [ip in index for ip in probes],
+    }
+
+
+def test_numpy_and_python_paths_agree(monkeypatch):
+    if ip_set.np is None:
+        pytest.skip('未安装numpy')
+    with_numpy = run_operations()
+    monkeypatch.setattr(ip_set, 'np', None)
+    assert run_operations() == with_numpy
+
+
+def test_set_semantics(backend):
+    a = IPSet(['103.21.244.1', '2.0.0.1', '103.21.244.1', ip_to_int('9.9.9.9')])
+    b = IPSet(['2.0.0.1', '8.8.8.8'])
+    # 按数值而不是字符串排序
+    assert a.to_strings() == ['2.0.0.1', '9.9.9.9', '103.21.244.1']
+    assert (a | b).to_strings() == ['2.0.0.1', '8.8.8.8', '9.9.9.9', '103.21.244.1']
+    assert (a & b).to_strings() == ['2.0.0.1']
+    assert (a - b).to_strings() == ['9.9.9.9', '103.21.244.1']
+    assert '9.9.9.9' in a and ip_to_int('9.9.9.9') in a and '8.8.8.8' not in a and 'bad' not in a
+    assert len(IPSet()) == 0 and not IPSet()
+    assert IPSet.from_bytes(a.to_bytes()) == a
+
+
+def test_port_bitmap(backend):
+    bitmap = PortBitmap.from_port_sets([443, 8443], {443: IPSet(['1.1.1.1', '2.2.2.2']), 8443: IPSet(['2.2.2.2', '3.3.3.3']), 80: IPSet(['4.4.4.4'])})
+    assert bitmap.ips.to_strings() == ['1.1.1.1', '2.2.2.2', '3.3.3.3']
+    assert bitmap.ports_of('2.2.2.2') == [443, 8443]
+    assert bitmap.ports_of('4.4.4.4') == []
+    assert bitmap.ips_with(8443).to_strings() == ['2.2.2.2', '3.3.3.3']
+    restored = PortBitmap.from_bytes(bitmap.ports, bitmap.ips.to_bytes(), bitmap.bits_to_bytes())
+    assert restored.ips_with(443) == bitmap.ips_with(443)
+    with pytest.raises(ValueError):
+        PortBitmap.union_all([bitmap, PortBitmap.from_port_sets([443], {})])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_to_cidrs_matches_ipaddress(backend, seed):
+    rng = random.Random(seed)
+    base = rng.choice([0, ip_to_int('10.0.0.0'), ip_to_int('255.255.255.0') - 4096])
+    values = []
+    for _ in range(rng.randint(1, 6)):
+        start = base + rng.randrange(4096)
+        values.extend(range(start, min(start + rng.randint(1, 600), 2 ** 32)))
+    ips = IPSet(values)
+    expected = []
+    for start, end in ips.ranges():
+        expected.extend(str(network) for network in ipaddress.summarize_address_range(
+            ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)))
+    assert ips.to_cidrs() == expected
+    covered = set()
+    for cidr in expected:
+        covered.update(int(address) for address in ipaddress.ip_network(cidr))
+    assert covered == set(values)
+
+
+def test_to_cidrs_whole_space():
+    assert IPSet(['0.0.0.0']).to_cidrs() == ['0.0.0.0/32']
+    assert IPSet(['255.255.255.255']).to_cidrs() == ['255.255.255.255/32']
+    assert ip_set.range_to_cidrs(0, 2 ** 32 - 1) == [(0, 0)]
+
+
+def test_parse_cidr():
+    assert parse_cidr('1.2.3.4/24') == (ip_to_int('1.2.3.0'), ip_to_int('1.2.3.255'))
+    assert parse_cidr(' 1.2.3.4 ') == (ip_to_int('1.2.3.4'),) * 2
+    assert parse_cidr('1.2.3.4/33') is None and parse_cidr('1.2.3/8') is None
+
+
+def test_leading_zero_octets_are_normalized():
+    assert normalize_ip('010.001.002.003') == '10.1.2.3'
+    assert normalize_ip('1.2.3.4') == '1.2.3.4'
+    assert normalize_ip('256.1.1.1') is None and normalize_ip('1.2.3') is None
+    # 按十进制理解，不是inet_aton的八进制
+    assert ip_to_int('010.0.0.1') == ip_to_int('10.0.0.1')
+    assert IPSet.from_strings(['001.002.003.004', '1.2.3.4', '09.9.9.9']).to_strings() == ['1.2.3.4', '9.9.9.9']
+
+
+def test_leading_zero_ips_are_extracted_from_csv(tmp_path):
+    path = tmp_path / 'a.csv'
+    path.write_text('IP地址,端口\n001.002.003.004,443\n1.2.3.4,443\n010.000.000.001,443\n', encoding='utf-8')
+    assert td.scan_csv_file(str(path), ports=(443,)).ips_443.to_strings() == ['1.2.3.4', '10.0.0.1']
+    assert td.TelegramDownloader(None, None, None, None).extract_443_ips_advanced(str(path)) == ['1.2.3.4', '10.0.0.1']
@@ -0,0 +1,34 @@
+"""本地目录来源的测试"""
+import asyncio
+import os
+
+import telegram_downloader as td
+
+
+def touch(path, content='IP地址,端口\n'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(content)
+
+
+def test_lists_channel_subfolders(tmp_path):
+    folder = str(tmp_path)
+    touch(os.path.join(folder, 'b.csv'))
+    touch(os.path.join(folder, 'a.csv'))
+    touch(os.path.join(folder, 'merged.csv'))
+    touch(os.path.join(folder, 'notes.txt'))
+    touch(os.path.join(folder, 'other_channel', 'c.csv'))
+    touch(os.path.join(folder, '.scan_cache', 'a.csv'))
+    names = [os.path.relpath(path, folder) for path in td.list_local_csv_files(folder)]
+    assert names == ['a.csv', 'b.csv', os.path.join('other_channel', 'c.csv')]
+    assert [os.path.basename(path) for path in td.list_local_csv_files(folder, include_subfolders=False)] == ['a.csv', 'b.csv']
+
+
+def test_offline_source_includes_channel_subfolders(tmp_path):
+    folder = str(tmp_path)
+    touch(os.path.join(folder, 'a.csv'), 'IP地址,端口\n1.1.1.1,443\n')
+    touch(os.path.join(folder, 'other_channel', 'c.csv'), 'IP地址,端口\n2.2.2.2,443\n')
+    # 与第一个频道内容相同的转发文件只处理一次
+    touch(os.path.join(folder, 'other_channel', 'copy.csv'), 'IP地址,端口\n1.1.1.1,443\n')
+    files = asyncio.run(td.fetch_sources([td.LocalDirectorySource(folder)]))
+    assert [os.path.relpath(path, folder) for path in files] == ['a.csv', os.path.join('other_channel', 'c.csv')]
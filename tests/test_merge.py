@@ -0,0 +1,130 @@
+"""merge_csv_streaming 的测试：表头不同的文件按列对齐，外部排序与内存中一次排序的结果一致"""
+import csv
+import itertools
+import random
+
+import pytest
+
+import telegram_downloader as td
+from conftest import HEADER_FIELDS as FULL_HEADER
+
+SHORT_HEADER = ['IP地址', '端口', 'TLS', '数据中心', '地区', '城市', '网络延迟', '下载速度']
+
+
+def write_rows(path, header, rows, delimiter=','):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter=delimiter)
+        writer.writerow(header)
+        writer.writerows(rows)
+    return str(path)
+
+
+def read_rows(path):
+    with open(path, encoding='utf-8', newline='') as f:
+        return list(csv.reader(f))
+
+
+def test_rows_from_different_headers_stay_aligned(tmp_path):
+    # 旧频道格式：8列，表头带BOM
+    old = write_rows(tmp_path / 'AsnALL-20251014-IP.csv', ['\ufeffIP地址'] + SHORT_HEADER[1:], [
+        ['1.1.1.1', '443', 'true', 'FRA', 'Europe', 'Frankfurt', '177 ms', '11207 kB/s'],
+    ])
+    new = write_rows(tmp_path / 'AsnALL-20251015-IP.csv', FULL_HEADER, [
+        ['2.2.2.2', '443', 'true', 'HKG', 'HK', 'Asia Pacific', 'Hong Kong', '亚洲', '香港', '香港', 'x', '65 ms', '14761 kB/s'],
+    ])
+    # 列顺序不同、IP列名不同的文件
+    other = write_rows(tmp_path / 'other-20251016.csv', ['speed', 'ip', 'port', 'colo'], [
+        ['900 kB/s', '3.3.3.3', '8443', 'SIN'],
+    ])
+    merged_path = str(tmp_path / 'merged.csv')
+
+    assert td.merge_csv_streaming([old, new, other], merged_path) == 4
+
+    header, *rows = read_rows(merged_path)
+    assert header == SHORT_HEADER + ['源IP位置', '地区(中文)', '国家', '城市(中文)', '国旗']
+    records = {row[0]: dict(zip(header, row)) for row in rows}
+    assert all(len(row) == len(header) for row in rows)
+    assert records['1.1.1.1']['网络延迟'] == '177 ms' and records['1.1.1.1']['国家'] == ''
+    assert records['2.2.2.2']['网络延迟'] == '65 ms'
+    assert records['2.2.2.2']['下载速度'] == '14761 kB/s'
+    assert records['2.2.2.2']['国家'] == '香港'
+    assert records['3.3.3.3']['端口'] == '8443'
+    assert records['3.3.3.3']['数据中心'] == 'SIN'
+    assert records['3.3.3.3']['下载速度'] == '900 kB/s'
+
+
+def test_uses_first_delimiter(tmp_path):
+    first = write_rows(tmp_path / 'a-20251001.csv', SHORT_HEADER, [['1.1.1.1', '443', 'true', 'FRA', 'EU', 'F', '1 ms', '1 kB/s']], ';')
+    second = write_rows(tmp_path / 'b-20251002.csv', SHORT_HEADER, [['2.2.2.2', '443', 'true', 'FRA', 'EU', 'F', '1 ms', '1 kB/s']])
+    merged_path = str(tmp_path / 'merged.csv')
+    td.merge_csv_streaming([first, second], merged_path)
+    with open(merged_path, encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert lines == [';'.join(SHORT_HEADER), '1.1.1.1;443;true;FRA;EU;F;1 ms;1 kB/s', '2.2.2.2;443;true;FRA;EU;F;1 ms;1 kB/s']
+
+
+def test_header_only_files(tmp_path):
+    empty = write_rows(tmp_path / 'a-20251001.csv', SHORT_HEADER, [])
+    merged_path = str(tmp_path / 'merged.csv')
+    assert td.merge_csv_streaming([empty], merged_path) == 1
+    assert read_rows(merged_path) == [SHORT_HEADER]
+
+
+@pytest.fixture
+def overlapping_files(tmp_path):
+    """三天的文件，IP和端口有大量重复，测速值随机；部分行测速值无法解析"""
+    rng = random.Random(7)
+    paths = []
+    for day in range(3):
+        rows = []
+        for _ in range(120):
+            ip = f'10.0.{rng.randint(0, 2)}.{rng.randint(1, 12)}'
+            port = rng.choice(['443', '8443'])
+            latency = f'{rng.randint(10, 60)} ms' if rng.random() > 0.1 else 'n/a'
+            speed = f'{rng.randint(100, 400)} kB/s' if rng.random() > 0.1 else ''
+            rows.append([ip, port, 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', latency, speed])
+        paths.append(write_rows(tmp_path / f'AsnALL-2025100{day + 1}-IP.csv', FULL_HEADER, rows))
+    return paths
+
+
+@pytest.mark.parametrize('keep, sort_by', list(itertools.product(['best', 'newest'], [None, 'speed', 'latency'])))
+def test_external_sort_matches_in_memory_sort(overlapping_files, tmp_path, keep, sort_by):
+    small = str(tmp_path / 'small.csv')
+    unbounded = str(tmp_path / 'unbounded.csv')
+    # chunk_rows=7：几十个分段的k路归并；10**9：只有一个分段
+    td.merge_csv_streaming(overlapping_files, small, keep=keep, sort_by=sort_by, chunk_rows=7)
+    td.merge_csv_streaming(overlapping_files, unbounded, keep=keep, sort_by=sort_by, chunk_rows=10 ** 9)
+    small_rows = read_rows(small)
+    assert small_rows == read_rows(unbounded)
+
+    rows = small_rows[1:]
+    keys = [(td.ip_to_int(row[0]), int(row[1])) for row in rows]
+    assert len(keys) == len(set(keys))
+    all_keys = {(td.ip_to_int(row[0]), int(row[1])) for path in overlapping_files for row in read_rows(path)[1:]}
+    assert set(keys) == all_keys
+    if sort_by is None:
+        assert keys == sorted(keys)
+    elif sort_by == 'speed':
+        speeds = [td.parse_speed_kbps(row[12]) or -1.0 for row in rows]
+        assert speeds == sorted(speeds, reverse=True)
+    else:
+        latencies = [td.parse_latency_ms(row[11]) or float('inf') for row in rows]
+        assert latencies == sorted(latencies)
+
+
+@pytest.mark.parametrize('keep', ['best', 'newest'])
+def test_deduplication_keeps_expected_row(tmp_path, keep):
+    base = ['true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x']
+    older = write_rows(tmp_path / 'AsnALL-20251001-IP.csv', FULL_HEADER, [
+        ['1.1.1.1', '443', *base, '10 ms', '9000 kB/s'],
+        ['1.1.1.1', '8443', *base, '10 ms', '9000 kB/s'],
+    ])
+    newer = write_rows(tmp_path / 'AsnALL-20251002-IP.csv', FULL_HEADER, [
+        ['1.1.1.1', '443', *base, '90 ms', '100 kB/s'],
+    ])
+    merged_path = str(tmp_path / 'merged.csv')
+    # 较新的文件在前面，保留哪一行不取决于文件顺序
+    assert td.merge_csv_streaming([newer, older], merged_path, keep=keep, chunk_rows=1) == 3
+    rows = read_rows(merged_path)[1:]
+    assert [(row[0], row[1]) for row in rows] == [('1.1.1.1', '443'), ('1.1.1.1', '8443')]
+    assert rows[0][12] == ('9000 kB/s' if keep == 'best' else '100 kB/s')
@@ -0,0 +1,76 @@
+"""RunMetrics 报告格式的测试"""
+import json
+import re
+
+from metrics import METRIC_PREFIX, RunMetrics
+
+SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+
+def parse_prometheus(text):
+    """解析textfile：返回 ({序列: 值}, {指标名: 类型})，序列重复或格式不对时断言失败"""
+    samples = {}
+    types = {}
+    for line in text.splitlines():
+        if line.startswith('# TYPE '):
+            _, _, name, metric_type = line.split(' ')
+            assert name not in types, f"重复的TYPE: {name}"
+            types[name] = metric_type
+            continue
+        match = SAMPLE_LINE.match(line)
+        assert match, f"无法解析的行: {line!r}"
+        name, labels, value = match.groups()
+        assert name in types, f"{name} 缺少TYPE行"
+        series = name + (labels or '')
+        assert series not in samples, f"重复的序列: {series}"
+        samples[series] = float(value)
+    return samples, types
+
+
+def test_repeated_stages_produce_unique_series(tmp_path):
+    metrics = RunMetrics()
+    metrics.record_stage('connect', 0.5)
+    metrics.record_stage('connect', 0.25)
+    metrics.record_stage('download', 1.0, file='a.csv')
+    metrics.record_stage('download', 2.0, file='a.csv')
+    metrics.record_stage('download', 3.0, file='b.csv')
+    metrics.record_stage('scan_messages', 0.1, channel='first')
+    metrics.record_stage('scan_messages', 0.2, channel='second')
+    metrics.add('downloads', result='ok')
+    metrics.add('downloads', 2, result='ok')
+    metrics.set('bucket_ips', 7, bucket='all')
+    path = str(tmp_path / 'run.prom')
+    metrics.write(path)
+
+    with open(path, encoding='utf-8') as f:
+        samples, types = parse_prometheus(f.read())
+
+    last = f'{METRIC_PREFIX}_stage_last_duration_seconds'
+    assert samples[f'{last}{{stage="connect"}}'] == 0.25
+    assert samples[f'{last}{{file="a.csv",stage="download"}}'] == 2.0
+    assert samples[f'{last}{{file="b.csv",stage="download"}}'] == 3.0
+    assert samples[f'{last}{{channel="second",stage="scan_messages"}}'] == 0.2
+    assert samples[f'{METRIC_PREFIX}_stage_duration_seconds_sum{{stage="download"}}'] == 6.0
+    assert samples[f'{METRIC_PREFIX}_stage_duration_seconds_count{{stage="connect"}}'] == 2
+    assert samples[f'{METRIC_PREFIX}_downloads_total{{result="ok"}}'] == 3
+    assert samples[f'{METRIC_PREFIX}_bucket_ips{{bucket="all"}}'] == 7
+    assert types[f'{METRIC_PREFIX}_downloads_total'] == 'counter'
+
+
+def test_label_values_are_escaped():
+    metrics = RunMetrics()
+    metrics.record_stage('write', 0.1, output='a "quoted"\\name\n.txt')
+    samples, _ = parse_prometheus(metrics.to_prometheus())
+    assert f'{METRIC_PREFIX}_stage_last_duration_seconds{{output="a \\"quoted\\"\\\\name\\n.txt",stage="write"}}' in samples
+
+
+def test_json_report_keeps_every_stage(tmp_path):
+    metrics = RunMetrics()
+    metrics.record_stage('connect', 0.5)
+    metrics.record_stage('connect', 0.25)
+    path = str(tmp_path / 'run.json')
+    metrics.write(path)
+    with open(path, encoding='utf-8') as f:
+        report = json.load(f)
+    assert [item['seconds'] for item in report['stages']] == [0.5, 0.25]
+    assert report['stage_totals']['connect'] == {'seconds': 0.75, 'count': 2}
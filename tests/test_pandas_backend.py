@@ -0,0 +1,83 @@
+"""pandas后端与csv后端的一致性测试"""
+import pytest
+
+import telegram_downloader as td
+
+pytest.importorskip('pandas')
+
+ROWS = [
+    ['1.0.0.1', '443', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    ['1.0.0.2', ' 443 ', 'true', 'hkg', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '0.05 s', '1.5 MB/s'],
+    ['1.0.0.3', '443', 'true', 'SIN', 'SG', 'Asia', 'Singapore', '亚洲', '新加坡', '新加坡', 'x', '60 ms', '1000 kB/s'],
+    # 评分与 1.0.0.3 相同，按IP数值决定先后
+    ['1.0.0.4', '443', 'true', 'SIN', 'SG', 'Asia', 'Singapore', '亚洲', '新加坡', '新加坡', 'x', '60 ms', '1000 kB/s'],
+    # 同一IP出现多次，取最高分
+    ['1.0.0.1', '443', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '10 ms', '9000 kB/s'],
+    ['1.0.0.5', '8443', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    ['1.0.0.1', '2053', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    ['1.0.0.6', '80', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    # 不合法的IP、无法解析的测速值、空索引值
+    ['999.1.1.1', '443', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    ['not-an-ip', '443', 'true', 'HKG', 'HK', 'Asia', 'Hong Kong', '亚洲', '香港', '香港', 'x', '50 ms', '1000 kB/s'],
+    ['1.0.0.7', '443', 'true', '', '', 'Asia', '', '', '', '', 'x', 'timeout', '1000 kB/s'],
+    ['1.0.0.8', '443', 'true', 'NRT', 'JP', 'Asia', 'Tokyo', '亚洲', '日本', '东京', 'x', '80 ms', ''],
+]
+# 列数不足的行：缺少测速列，但IP和端口完整
+SHORT_ROWS = [['1.0.0.9', '443', 'true', 'ICN', 'KR']]
+
+
+def assert_same_result(path, top_n=3, ports=(443, 8443, 2053)):
+    expected = td.scan_csv_file(path, top_n=top_n, ports=ports)
+    actual = td.scan_csv_file_pandas(path, top_n=top_n, ports=ports)
+    assert actual.scan_error is None and expected.scan_error is None
+    assert actual.schema_error == expected.schema_error
+    assert actual.rows_processed == expected.rows_processed
+    assert actual.rows_with_443 == expected.rows_with_443
+    assert actual.ips_443 == expected.ips_443
+    assert actual.index == expected.index
+    if top_n:
+        assert actual.ranking_all.ranked() == expected.ranking_all.ranked()
+        assert {key: ranking.ranked() for key, ranking in actual.index_rankings.items()} == \
+            {key: ranking.ranked() for key, ranking in expected.index_rankings.items()}
+    else:
+        assert actual.ranking_all is None and expected.ranking_all is None
+    if expected.port_bitmap is None:
+        assert actual.port_bitmap is None
+    else:
+        assert actual.port_bitmap.ports == expected.port_bitmap.ports
+        assert actual.port_bitmap.ips == expected.port_bitmap.ips
+        assert actual.port_bitmap.bits_to_bytes() == expected.port_bitmap.bits_to_bytes()
+    return expected
+
+
+@pytest.mark.parametrize('delimiter', [',', ';', '\t'])
+def test_same_output_as_csv_backend(csv_file, delimiter):
+    path = csv_file('AsnALL-20251016-IP.csv', ROWS, delimiter=delimiter)
+    result = assert_same_result(path)
+    assert result.ips_443.to_strings() == ['1.0.0.1', '1.0.0.2', '1.0.0.3', '1.0.0.4', '1.0.0.7', '1.0.0.8']
+    assert result.port_bitmap.ports_of('1.0.0.1') == [443, 2053]
+    assert ('colo', 'HKG') in result.index
+
+
+@pytest.mark.parametrize('top_n', [0, 1, 10])
+def test_same_output_for_each_top_n(csv_file, top_n):
+    path = csv_file('AsnALL-20251016-IP.csv', ROWS)
+    assert_same_result(path, top_n=top_n)
+
+
+def test_same_output_with_short_rows(csv_file):
+    path = csv_file('AsnALL-20251016-IP.csv', ROWS + SHORT_ROWS)
+    result = assert_same_result(path)
+    assert '1.0.0.9' in result.ips_443
+
+
+def test_same_output_for_header_only_file(csv_file):
+    path = csv_file('AsnALL-20251016-IP.csv', [])
+    result = assert_same_result(path)
+    assert not result.ips_443 and result.rows_processed == 1
+
+
+def test_same_output_for_unknown_header(csv_file):
+    path = csv_file('AsnALL-20251016-IP.csv', [['1', '2']], header=['foo', 'bar'])
+    result = assert_same_result(path)
+    assert result.schema_error is not None
@@ -0,0 +1,62 @@
+"""scan_files 进程池的测试：小文件不启动进程池，进程池以spawn方式启动且结果与串行一致"""
+import multiprocessing
+
+import telegram_downloader as td
+from conftest import channel_row, write_csv
+
+
+def write_csvs(tmp_path, count=3):
+    return [
+        write_csv(tmp_path / f'AsnALL-2025101{index}-IP.csv', [
+            channel_row(f'{index + 1}.1.1.{host}', latency=f'{10 + host} ms', speed=f'{1000 + host} kB/s')
+            for host in range(1, 30)
+        ])
+        for index in range(count)
+    ]
+
+
+def summarize(scanned):
+    return [(path, region, result.ips_443.to_strings(), result.rows_processed, result.ranking_all.ranked())
+            for path, region, result in scanned]
+
+
+def test_small_files_skip_pool(tmp_path, monkeypatch):
+    def no_pool(workers):
+        raise AssertionError('小文件不应启动进程池')
+
+    monkeypatch.setattr(td, 'make_parse_pool', no_pool)
+    scanned = td.scan_files(write_csvs(tmp_path), region_rules={}, backend='csv', workers=4, top_n=3, use_cache=False)
+    assert [result.ips_443.to_strings()[0] for _, _, result in scanned] == ['1.1.1.1', '2.1.1.1', '3.1.1.1']
+
+
+def test_pool_uses_spawn_and_matches_serial(tmp_path, monkeypatch, caplog):
+    paths = write_csvs(tmp_path)
+    serial = td.scan_files(paths, region_rules={}, backend='csv', workers=1, top_n=3, use_cache=False)
+
+    contexts = []
+    make_parse_pool = td.make_parse_pool
+
+    def recording_pool(workers):
+        pool = make_parse_pool(workers)
+        contexts.append(pool._mp_context)
+        return pool
+
+    monkeypatch.setattr(td, 'make_parse_pool', recording_pool)
+    monkeypatch.setattr(td, 'PARSE_POOL_MIN_BYTES', 0)
+    parallel = td.scan_files(paths, region_rules={}, backend='csv', workers=2, top_n=3, use_cache=False)
+    assert [context.get_start_method() for context in contexts] == ['spawn']
+    assert contexts[0] is multiprocessing.get_context('spawn')
+    assert summarize(parallel) == summarize(serial)
+    assert '改为串行解析' not in caplog.text
+
+
+def test_pool_workers_use_parent_config(tmp_path, monkeypatch):
+    # spawn启动的子进程不继承运行时修改的模块变量，由初始化函数传入
+    paths = write_csvs(tmp_path, count=2)
+    monkeypatch.setattr(td, 'SCAN_PORTS', (443, 8443))
+    monkeypatch.setattr(td, 'RANK_LATENCY_WEIGHT', 1000)
+    monkeypatch.setattr(td, 'PARSE_POOL_MIN_BYTES', 0)
+    serial = td.scan_files(paths, region_rules={}, backend='csv', workers=1, top_n=3, use_cache=False)
+    parallel = td.scan_files(paths, region_rules={}, backend='csv', workers=2, top_n=3, use_cache=False)
+    assert summarize(parallel) == summarize(serial)
+    assert [result.port_bitmap.ports for _, _, result in parallel] == [(443, 8443)] * 2
@@ -0,0 +1,119 @@
+"""流水线模式（边下载边解析）的测试：与先下载后解析的结果和输出文件一致"""
+import asyncio
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row, write_csv
+from fake_telegram import FakeClient, make_message
+
+COLOS = [('HKG', 'HK', '香港'), ('SIN', 'SG', '新加坡'), ('NRT', 'JP', '日本')]
+OUTPUTS = ['ip.txt', 'hkip.txt', 'sgip.txt', 'ip-8443.txt']
+
+
+@pytest.fixture
+def channel(tmp_path):
+    """频道中的文件（含一个HK优选文件）和一个本地目录，本地目录中有一份与频道文件内容相同的副本"""
+    names = [f'AsnALL-2025101{index}-IP.csv' for index in range(4)] + ['IataHK.csv-20251016-IP.csv']
+    paths = []
+    for index, name in enumerate(names):
+        rows = []
+        for host in range(1, 40):
+            colo, location, country = COLOS[(index + host) % 3]
+            rows.append(channel_row(f'10.{index}.0.{host}', port=8443 if host % 5 == 0 else 443,
+                                    colo=colo, location=location, country=country,
+                                    latency=f'{host % 7 * 10 + 5} ms', speed=f'{(host * 37) % 900 + 100} kB/s'))
+        paths.append(write_csv(tmp_path / 'channel' / name, rows))
+    local_dir = tmp_path / 'local'
+    write_csv(local_dir / 'AsnALL-20251009-IP.csv', [channel_row('10.9.0.1', latency='5 ms', speed='9000 kB/s')])
+    shutil.copyfile(paths[0], local_dir / 'copy-of-first.csv')
+    start = datetime.now(timezone.utc) - timedelta(hours=1)
+    messages = [make_message(index + 1, os.path.basename(path), path, start + timedelta(minutes=index))
+                for index, path in enumerate(paths)]
+    return messages, str(local_dir)
+
+
+def make_sources(messages, local_dir, download_folder):
+    client = FakeClient(messages, delays={message.id: 0.01 * (6 - message.id) for message in messages})
+    downloader = td.TelegramDownloader(1, 'hash', '+10000000000', 'test_channel', client=client)
+    return downloader, [td.TelegramSource(downloader, 'test_channel', download_folder), td.LocalDirectorySource(local_dir)]
+
+
+def summarize(csv_files, extracted):
+    buckets, preferred_files, rankings = extracted
+    return (
+        [os.path.basename(path) for path in csv_files],
+        {name: ips.to_strings() for name, ips in buckets.items()},
+        {region: [os.path.basename(path) for path in files] for region, files in preferred_files.items()},
+        {name: ranking.ranked() for name, ranking in rankings.items()},
+    )
+
+
+def run_mode(tmp_path, channel, pipeline, workers):
+    messages, local_dir = channel
+    work_dir = tmp_path / f"{'pipeline' if pipeline else 'sequential'}-{workers}"
+    work_dir.mkdir()
+    downloader, sources = make_sources(messages, local_dir, str(work_dir / 'downloads'))
+    args = td.parse_args(['--workers', str(workers), '--top-n', '3', '--no-cache'])
+
+    async def run():
+        if pipeline:
+            csv_files, extracted = await td.fetch_and_extract(sources, None, 'csv', workers, 3, False)
+        else:
+            csv_files = await td.fetch_sources(sources)
+            extracted = td.extract_buckets_from_files(csv_files, None, 'csv', workers, 3, False)
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            await td.report_results(downloader, csv_files, extracted, args, 'test')
+        finally:
+            os.chdir(cwd)
+        return summarize(csv_files, extracted)
+
+    summary = asyncio.run(run())
+    outputs = {}
+    for name in OUTPUTS:
+        with open(work_dir / name, encoding='utf-8') as f:
+            outputs[name] = f.read()
+    return summary, outputs
+
+
+@pytest.mark.parametrize('workers, pool_min_bytes, expected_pools', [(1, 0, 0), (2, 0, 2), (2, 10 ** 9, 0)])
+def test_pipeline_matches_sequential(tmp_path, channel, monkeypatch, workers, pool_min_bytes, expected_pools):
+    monkeypatch.setattr(td, 'SCAN_PORTS', (443, 8443))
+    monkeypatch.setattr(td, 'REGION_RULES', td.build_region_rules(['HK', 'SG']))
+    monkeypatch.setattr(td, 'PARSE_POOL_MIN_BYTES', pool_min_bytes)
+    pools = []
+    make_parse_pool = td.make_parse_pool
+
+    def recording_pool(pool_workers):
+        pools.append(pool_workers)
+        return make_parse_pool(pool_workers)
+
+    monkeypatch.setattr(td, 'make_parse_pool', recording_pool)
+    sequential = run_mode(tmp_path, channel, False, workers)
+    pipelined = run_mode(tmp_path, channel, True, workers)
+
+    assert pipelined == sequential
+    # 两种模式按同样的大小规则决定是否启动进程池，每种模式最多启动一次
+    assert pools == [workers] * expected_pools
+    csv_files, buckets, preferred_files, rankings = pipelined[0]
+    # 内容重复的本地副本只参与一次
+    assert 'copy-of-first.csv' not in csv_files and len(csv_files) == 6
+    assert preferred_files == {'HK': ['IataHK.csv-20251016-IP.csv'], 'SG': []}
+    assert buckets['port:8443'] and rankings['all']
+
+
+def test_consumer_error_stops_download(tmp_path, channel, monkeypatch):
+    messages, local_dir = channel
+    _, sources = make_sources(messages, local_dir, str(tmp_path / 'downloads'))
+
+    def broken_scan(task):
+        raise ValueError('解析失败')
+
+    monkeypatch.setattr(td, '_scan_task_cached', broken_scan)
+    with pytest.raises(ValueError, match='解析失败'):
+        asyncio.run(td.fetch_and_extract(sources, None, 'csv', 1, 0, False))
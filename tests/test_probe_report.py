@@ -0,0 +1,59 @@
+"""发布前TLS探测（PROBE_MODE）对输出文件和结果汇总的影响"""
+import asyncio
+import logging
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row, read_lines
+from ip_set import ip_to_int
+
+LATENCIES = {'1.1.1.1': 30.0, '1.1.1.2': None, '1.1.1.3': 10.0, '2.2.2.1': None, '2.2.2.2': None}
+
+
+@pytest.fixture
+def probed_run(tmp_path, csv_file, monkeypatch):
+    downloads = tmp_path / 'downloads'
+    csv_file('downloads/AsnALL-20251016-IP.csv', [
+        channel_row(ip, colo='HKG' if ip.startswith('1.') else 'SIN', location='XX', country='国家') for ip in LATENCIES
+    ])
+
+    async def fake_probe(ip_set):
+        return {ip_to_int(ip): LATENCIES[ip] for ip in ip_set.to_strings()}
+
+    monkeypatch.setattr(td, 'probe_extracted_ips', fake_probe)
+    monkeypatch.chdir(tmp_path)
+
+    def run(mode):
+        monkeypatch.setattr(td, 'PROBE_MODE', mode)
+        args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--no-cache', '--top-n', '0', '--probe'])
+        asyncio.run(td.run_offline(args.offline, args))
+
+    return run
+
+
+def test_drop_mode_reports_published_counts(probed_run, tmp_path, caplog, capsys):
+    with caplog.at_level(logging.INFO):
+        probed_run('drop')
+
+    assert read_lines(tmp_path / 'ip.txt') == ['1.1.1.1', '1.1.1.3']
+    assert read_lines(tmp_path / 'hkip.txt') == ['1.1.1.3', '1.1.1.1']
+    assert read_lines(tmp_path / 'sgip.txt') == []
+    assert '成功提取 2 个所有443端口IP地址' in caplog.text
+    assert '成功提取 2 个HK区域443端口IP地址' in caplog.text
+    assert '成功提取 0 个SG区域443端口IP地址' in caplog.text
+    assert '成功提取 3 个HK区域' not in caplog.text
+    summary = capsys.readouterr().out
+    assert '- 总443端口IP: 5 个（写入 2 个）' in summary
+    assert '- HK区域443端口IP: 3 个（写入 2 个）' in summary
+    assert '- SG区域443端口IP: 2 个（写入 0 个）' in summary
+
+
+def test_demote_mode_keeps_all_ips(probed_run, tmp_path, caplog, capsys):
+    with caplog.at_level(logging.INFO):
+        probed_run('demote')
+
+    assert read_lines(tmp_path / 'ip.txt') == list(LATENCIES)
+    assert read_lines(tmp_path / 'hkip.txt') == ['1.1.1.3', '1.1.1.1', '1.1.1.2']
+    assert '成功提取 3 个HK区域443端口IP地址' in caplog.text
+    assert '- HK区域443端口IP: 3 个\n' in capsys.readouterr().out
@@ -0,0 +1,73 @@
+"""TopN排名和评分公式的测试"""
+import itertools
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row
+from ip_set import int_to_ip, ip_to_int
+
+
+def ranked_strings(ranking):
+    return [(int_to_ip(ip), score) for ip, score in ranking.ranked()]
+
+
+def push_all(size, items):
+    ranking = td.TopN(size)
+    for ip, score in items:
+        ranking.push(ip_to_int(ip), score)
+    return ranking
+
+
+def test_ties_prefer_smaller_ip_regardless_of_order():
+    items = [('10.0.0.3', 5.0), ('10.0.0.1', 5.0), ('9.0.0.9', 1.0), ('10.0.0.2', 5.0), ('10.0.0.10', 5.0)]
+    expected = [('10.0.0.1', 5.0), ('10.0.0.2', 5.0), ('10.0.0.3', 5.0)]
+    for order in itertools.permutations(items):
+        assert ranked_strings(push_all(3, order)) == expected
+
+
+def test_size_larger_than_candidates_keeps_all():
+    ranking = push_all(10, [('1.1.1.1', 1.0), ('2.2.2.2', 3.0), ('3.3.3.3', -2.0)])
+    assert len(ranking) == 3
+    assert ranked_strings(ranking) == [('2.2.2.2', 3.0), ('1.1.1.1', 1.0), ('3.3.3.3', -2.0)]
+    assert td.TopN(10).ranked() == []
+
+
+def test_duplicate_ip_keeps_highest_score():
+    ranking = push_all(2, [('1.1.1.1', 1.0), ('2.2.2.2', 2.0), ('1.1.1.1', 5.0), ('1.1.1.1', 3.0)])
+    assert ranked_strings(ranking) == [('1.1.1.1', 5.0), ('2.2.2.2', 2.0)]
+    # 被挤出后再次出现且分数足够高时重新进入
+    ranking = push_all(1, [('1.1.1.1', 1.0), ('2.2.2.2', 2.0), ('1.1.1.1', 4.0)])
+    assert ranked_strings(ranking) == [('1.1.1.1', 4.0)]
+
+
+def test_merge_rankings_matches_single_ranking():
+    items = [(f'10.0.0.{host}', float(host % 7)) for host in range(1, 40)]
+    parts = [push_all(5, items[start::3]) for start in range(3)]
+    assert td.merge_rankings(parts, 5).ranked() == push_all(5, items).ranked()
+
+
+def test_score_formula_uses_configured_weights(monkeypatch):
+    assert td.score_measurement(50, 1000) == 1000 - 50 * 10
+    assert td.score_measurement(None, 1000) is None and td.score_measurement(50, None) is None
+    monkeypatch.setattr(td, 'RANK_SPEED_WEIGHT', 0.5)
+    monkeypatch.setattr(td, 'RANK_LATENCY_WEIGHT', 100)
+    assert td.score_measurement(50, 1000) == 500 - 5000
+
+
+@pytest.mark.parametrize('backend', ['csv', 'pandas'])
+def test_weights_change_ranking(csv_file, monkeypatch, backend):
+    if backend == 'pandas':
+        pytest.importorskip('pandas')
+    path = csv_file('a.csv', [
+        channel_row('1.1.1.1', latency='200 ms', speed='5 MB/s'),   # 快但延迟高
+        channel_row('2.2.2.2', latency='20 ms', speed='1000 kB/s'),  # 延迟低但慢
+    ])
+
+    def top(speed_weight, latency_weight):
+        monkeypatch.setattr(td, 'RANK_SPEED_WEIGHT', speed_weight)
+        monkeypatch.setattr(td, 'RANK_LATENCY_WEIGHT', latency_weight)
+        return ranked_strings(td.SCAN_BACKENDS[backend](path, 2).ranking_all)
+
+    assert top(1, 10) == [('1.1.1.1', 5120 - 2000), ('2.2.2.2', 1000 - 200)]
+    assert top(1, 100) == [('2.2.2.2', 1000 - 2000), ('1.1.1.1', 5120 - 20000)]
@@ -0,0 +1,64 @@
+"""区域索引（数据中心/源IP位置/国家）和 IP_REGIONS 配置的测试"""
+import asyncio
+
+import telegram_downloader as td
+from conftest import channel_row, read_lines, write_csv
+
+
+def write_region_csv(path, rows):
+    return write_csv(path, [channel_row(ip, colo=colo, location=location, country=country)
+                            for ip, colo, location, country in rows])
+
+
+def test_region_rules_for_builtin_and_custom_codes():
+    rules = td.build_region_rules(['HK', 'JP', 'US'])
+    assert rules['HK']['output'] == 'hkip.txt' and rules['JP']['output'] == 'jpip.txt'
+    # 没有内置规则的代码按源IP位置精确匹配
+    assert rules['US'] == {'locations': ['US'], 'output': 'usip.txt'}
+    assert td.region_index_keys(rules['US']) == [('location', 'US')]
+    assert td.region_index_keys(rules['HK']) == [('colo', 'HKG'), ('country', '香港')]
+    assert td.match_preferred_region('IataJP.csv-20251016-IP.csv', rules) == 'JP'
+    assert td.match_preferred_region('IataKR.csv-20251016-IP.csv', rules) is None
+    assert td.match_preferred_region('IataJP.csv-20251016-IP.csv.gz', rules) == 'JP'
+
+
+def test_index_matches_exact_keys_only(tmp_path):
+    path = write_region_csv(tmp_path / 'a.csv', [
+        ('1.1.1.1', 'hkg', 'hk', '香港'),
+        ('1.1.1.2', 'HKGX', 'HK', '中国香港'),
+        ('1.1.1.3', 'LAX', 'us', '美国'),
+        ('1.1.1.4', 'LAX', 'USA', '美国'),
+        ('1.1.1.5', '', '', ''),
+    ])
+    result = td.scan_csv_file(path, ports=(443,))
+    rules = td.build_region_rules(['HK', 'US'])
+    assert result.lookup(td.region_index_keys(rules['HK'])).to_strings() == ['1.1.1.1']
+    assert result.lookup(td.region_index_keys(rules['US'])).to_strings() == ['1.1.1.3']
+    assert result.index[('location', 'HK')].to_strings() == ['1.1.1.1', '1.1.1.2']
+    # 空值不建索引键
+    assert all(value for _, value in result.index)
+
+
+def test_configured_regions_end_to_end(tmp_path, monkeypatch):
+    downloads = tmp_path / 'downloads'
+    write_region_csv(downloads / 'AsnALL-20251016-IP.csv', [
+        ('1.0.0.1', 'HKG', 'HK', '香港'),
+        ('1.0.0.2', 'NRT', 'JP', '日本'),
+        ('1.0.0.3', 'LAX', 'US', '美国'),
+        ('1.0.0.4', 'SJC', 'US', '美国'),
+    ])
+    # JP有优选文件，只取优选文件中的IP
+    write_region_csv(downloads / 'IataJP.csv-20251016-IP.csv', [('2.0.0.1', 'KIX', 'JP', '日本')])
+    # KR未配置，它的优选文件按普通文件处理
+    write_region_csv(downloads / 'IataKR.csv-20251016-IP.csv', [('3.0.0.1', 'ICN', 'KR', '韩国'), ('3.0.0.2', 'LAX', 'US', '美国')])
+    monkeypatch.setattr(td, 'REGION_RULES', td.build_region_rules(['HK', 'JP', 'US']))
+    monkeypatch.chdir(tmp_path)
+
+    args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--no-cache', '--top-n', '0'])
+    asyncio.run(td.run_offline(args.offline, args))
+
+    assert read_lines(tmp_path / 'ip.txt') == ['1.0.0.1', '1.0.0.2', '1.0.0.3', '1.0.0.4', '2.0.0.1', '3.0.0.1', '3.0.0.2']
+    assert read_lines(tmp_path / 'hkip.txt') == ['1.0.0.1']
+    assert read_lines(tmp_path / 'jpip.txt') == ['2.0.0.1']
+    assert read_lines(tmp_path / 'usip.txt') == ['1.0.0.3', '1.0.0.4', '3.0.0.2']
+    assert not (tmp_path / 'sgip.txt').exists() and not (tmp_path / 'krip.txt').exists()
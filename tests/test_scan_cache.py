@@ -0,0 +1,134 @@
+"""提取结果缓存（.scan_cache）的测试"""
+import os
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row
+
+
+@pytest.fixture
+def csv_path(csv_file):
+    return csv_file('AsnALL-20251016-IP.csv', [
+        channel_row(f'1.1.1.{host}', port=443 if host % 3 else 8443, colo='HKG' if host % 2 else 'SIN', location='XX',
+                    country='国家', latency=f'{10 + host} ms', speed=f'{1000 + host} kB/s')
+        for host in range(1, 20)
+    ])
+
+
+def scan(path, top_n=3):
+    return td.scan_files([path], region_rules={}, backend='csv', workers=1, top_n=top_n, use_cache=True)[0][2]
+
+
+def cache_state(path):
+    cache_path = td.scan_cache_path(path)
+    with open(cache_path, 'rb') as f:
+        return f.read(), os.stat(cache_path).st_mtime_ns
+
+
+def assert_same_result(actual, expected):
+    assert actual.ips_443 == expected.ips_443
+    assert actual.index == expected.index
+    assert (actual.rows_processed, actual.rows_with_443) == (expected.rows_processed, expected.rows_with_443)
+    assert actual.ranking_all.ranked() == expected.ranking_all.ranked()
+    assert {key: ranking.ranked() for key, ranking in actual.index_rankings.items()} == \
+        {key: ranking.ranked() for key, ranking in expected.index_rankings.items()}
+    assert actual.port_bitmap.ports == expected.port_bitmap.ports
+    assert actual.port_bitmap.ips == expected.port_bitmap.ips
+    assert actual.port_bitmap.bits_to_bytes() == expected.port_bitmap.bits_to_bytes()
+
+
+def test_round_trip(csv_path, monkeypatch):
+    monkeypatch.setattr(td, 'SCAN_PORTS', (443, 8443))
+    first = scan(csv_path)
+    assert first.parse_seconds is not None
+    assert os.path.exists(td.scan_cache_path(csv_path))
+
+    cached = td.load_scan_cache(csv_path, 3)
+    assert cached is not None and cached.parse_seconds is None
+    assert_same_result(cached, first)
+    assert cached.port_bitmap.ips_with(8443).to_strings() == ['1.1.1.3', '1.1.1.6', '1.1.1.9', '1.1.1.12', '1.1.1.15', '1.1.1.18']
+    # 影响结果的参数变化时不使用缓存
+    assert td.load_scan_cache(csv_path, 5) is None
+
+
+def test_content_change_at_same_size_invalidates(csv_path):
+    first = scan(csv_path)
+    stat = os.stat(csv_path)
+    with open(csv_path, 'r+b') as f:
+        content = f.read()
+        f.seek(0)
+        f.write(content.replace(b'1.1.1.1,', b'1.1.1.9,', 1))
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert os.path.getsize(csv_path) == stat.st_size
+
+    assert td.load_scan_cache(csv_path, 3) is None
+    second = scan(csv_path)
+    assert second.parse_seconds is not None
+    assert '1.1.1.1' in first.ips_443 and '1.1.1.1' not in second.ips_443
+    assert_same_result(td.load_scan_cache(csv_path, 3), second)
+
+
+def test_touch_only_does_not_rewrite_cache(csv_path):
+    first = scan(csv_path)
+    before = cache_state(csv_path)
+    stat = os.stat(csv_path)
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    again = scan(csv_path)
+    assert again.parse_seconds is None
+    assert_same_result(again, first)
+    assert cache_state(csv_path) == before
+
+
+@pytest.mark.parametrize('field, value', [('magic', b'XXXX'), ('version', td.SCAN_CACHE_VERSION + 1)])
+def test_magic_or_version_mismatch_is_ignored(csv_path, field, value):
+    scan(csv_path)
+    cache_path = td.scan_cache_path(csv_path)
+    with open(cache_path, 'rb') as f:
+        data = f.read()
+    magic, version, meta_length = td._SCAN_CACHE_HEADER.unpack_from(data)
+    if field == 'magic':
+        magic = value
+    else:
+        version = value
+    with open(cache_path, 'wb') as f:
+        f.write(td._SCAN_CACHE_HEADER.pack(magic, version, meta_length) + data[td._SCAN_CACHE_HEADER.size:])
+
+    assert td.load_scan_cache(csv_path, 3) is None
+    # 重新解析后写出当前版本的缓存
+    assert scan(csv_path).parse_seconds is not None
+    assert td.load_scan_cache(csv_path, 3) is not None
+
+
+def test_corrupt_cache_is_ignored(csv_path):
+    scan(csv_path)
+    with open(td.scan_cache_path(csv_path), 'r+b') as f:
+        f.truncate(td._SCAN_CACHE_HEADER.size + 5)
+    assert td.load_scan_cache(csv_path, 3) is None
+
+
+def test_failed_scan_is_not_cached(csv_path, monkeypatch):
+    def broken_open(*args, **kwargs):
+        raise OSError('读取失败')
+
+    monkeypatch.setattr(td, 'open_text', broken_open)
+    assert scan(csv_path).scan_error is not None
+    assert not os.path.exists(td.scan_cache_path(csv_path))
+
+
+def test_cache_is_per_backend(csv_path, monkeypatch):
+    calls = []
+
+    def other_backend(path, top_n=0, ports=None):
+        calls.append(path)
+        return td.scan_csv_file(path, top_n, ports)
+
+    monkeypatch.setitem(td.SCAN_BACKENDS, 'other', other_backend)
+    first = scan(csv_path)
+    # 换后端时不使用另一个后端的缓存结果
+    scanned = td.scan_files([csv_path], region_rules={}, backend='other', workers=1, top_n=3, use_cache=True)[0][2]
+    assert calls == [csv_path] and scanned.parse_seconds is not None
+    assert_same_result(scanned, first)
+    assert td.load_scan_cache(csv_path, 3, 'other') is not None
+    assert td.load_scan_cache(csv_path, 3, 'csv') is None
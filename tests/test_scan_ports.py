@@ -0,0 +1,63 @@
+"""多端口扫描（SCAN_PORTS）的测试：一次扫描得到每个端口的IP，ip.txt 仍然只有443端口"""
+import asyncio
+
+import telegram_downloader as td
+from conftest import channel_row, read_lines, write_csv
+
+ROWS = [
+    ('1.1.1.1', '443', 'HKG'),
+    ('1.1.1.1', '8443', 'HKG'),
+    ('2.2.2.2', '8443', 'HKG'),
+    ('3.3.3.3', '2053', 'SIN'),
+    ('4.4.4.4', '80', 'HKG'),
+    ('5.5.5.5', '443', 'SIN'),
+]
+
+
+def write_port_csv(path, rows=ROWS):
+    return write_csv(path, [channel_row(ip, port=port, colo=colo, location='XX', country='国家') for ip, port, colo in rows])
+
+
+def test_scan_records_port_bitmap(tmp_path):
+    result = td.scan_csv_file(write_port_csv(tmp_path / 'a.csv'), ports=(443, 8443, 2053))
+    assert result.ips_443.to_strings() == ['1.1.1.1', '5.5.5.5']
+    assert result.port_bitmap.ports_of('1.1.1.1') == [443, 8443]
+    assert result.port_bitmap.ips_with(8443).to_strings() == ['1.1.1.1', '2.2.2.2']
+    assert result.port_bitmap.ips_with(2053).to_strings() == ['3.3.3.3']
+    assert '4.4.4.4' not in result.port_bitmap.ips
+    # 索引只包含443端口的IP
+    assert result.index[('colo', 'HKG')].to_strings() == ['1.1.1.1']
+
+
+def test_advanced_scan_matches_csv_scan(tmp_path):
+    path = write_port_csv(tmp_path / 'a.csv')
+    bitmap = td.TelegramDownloader(None, None, None, None).extract_port_ips_advanced(path, ports=(443, 8443, 2053))
+    expected = td.scan_csv_file(path, ports=(443, 8443, 2053)).port_bitmap
+    for port in (443, 8443, 2053):
+        assert bitmap.ips_with(port) == expected.ips_with(port)
+
+
+def test_port_files_written_and_ip_txt_stays_443(tmp_path, monkeypatch):
+    downloads = tmp_path / 'downloads'
+    write_port_csv(downloads / 'AsnALL-20251016-IP.csv')
+    write_port_csv(downloads / 'AsnALL-20251015-IP.csv', [('6.6.6.6', '8443', 'HKG'), ('5.5.5.5', '2053', 'SIN')])
+    monkeypatch.setattr(td, 'SCAN_PORTS', (443, 8443, 2053))
+    monkeypatch.chdir(tmp_path)
+
+    args = td.parse_args(['--offline', str(downloads), '--workers', '1', '--top-n', '0'])
+    asyncio.run(td.run_offline(args.offline, args))
+
+    assert read_lines(tmp_path / 'ip.txt') == ['1.1.1.1', '5.5.5.5']
+    assert read_lines(tmp_path / 'hkip.txt') == ['1.1.1.1']
+    assert read_lines(tmp_path / 'ip-443.txt') == ['1.1.1.1', '5.5.5.5']
+    assert read_lines(tmp_path / 'ip-8443.txt') == ['1.1.1.1', '2.2.2.2', '6.6.6.6']
+    assert read_lines(tmp_path / 'ip-2053.txt') == ['3.3.3.3', '5.5.5.5']
+    assert not (tmp_path / 'ip-80.txt').exists()
+
+    # 只扫描443时不输出端口文件
+    for name in ('ip-443.txt', 'ip-8443.txt', 'ip-2053.txt'):
+        (tmp_path / name).unlink()
+    monkeypatch.setattr(td, 'SCAN_PORTS', (443,))
+    asyncio.run(td.run_offline(args.offline, args))
+    assert read_lines(tmp_path / 'ip.txt') == ['1.1.1.1', '5.5.5.5']
+    assert not (tmp_path / 'ip-8443.txt').exists()
@@ -0,0 +1,73 @@
+"""表头解析（CsvSchema）按表头签名缓存的测试"""
+import logging
+
+import pytest
+
+import telegram_downloader as td
+from conftest import HEADER_FIELDS, channel_row
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    cache = {}
+    monkeypatch.setattr(td, '_SCHEMA_CACHE', cache)
+    return cache
+
+
+@pytest.fixture
+def constructed(monkeypatch):
+    """记录每次实际构造CsvSchema时的表头"""
+    headers = []
+    schema_class = td.CsvSchema
+
+    def counting_schema(header_list):
+        headers.append(header_list)
+        return schema_class(header_list)
+
+    monkeypatch.setattr(td, 'CsvSchema', counting_schema)
+    return headers
+
+
+def test_same_header_resolved_once(constructed):
+    first = td.resolve_schema(HEADER_FIELDS)
+    # BOM、大小写和首尾空白不影响签名
+    variant = ['\ufeffip地址 '] + [f' {name.upper()}' for name in HEADER_FIELDS[1:]]
+    assert td.resolve_schema(variant) is first
+    assert td.resolve_schema(list(HEADER_FIELDS)) is first
+    assert len(constructed) == 1
+    assert (first.ip_index, first.port_index, first.colo_index, first.country_index) == (0, 1, 3, 8)
+
+
+def test_different_headers_get_their_own_schema(csv_file, constructed):
+    reordered = ['端口', '数据中心', 'IP地址']
+    a = csv_file('a.csv', [channel_row('1.1.1.1')])
+    b = csv_file('b.csv', [['443', 'SIN', '2.2.2.2'], ['80', 'SIN', '3.3.3.3']], header=reordered)
+    c = csv_file('c.csv', [['443', 'HKG', '4.4.4.4']], header=reordered, delimiter=';')
+
+    results = [td.scan_csv_file(path, ports=(443,)) for path in (a, b, c)]
+    assert [result.ips_443.to_strings() for result in results] == [['1.1.1.1'], ['2.2.2.2'], ['4.4.4.4']]
+    assert results[1].index[('colo', 'SIN')].to_strings() == ['2.2.2.2']
+    assert results[2].index[('colo', 'HKG')].to_strings() == ['4.4.4.4']
+    # 分隔符不同但列相同的文件共享表头解析结果
+    assert len(constructed) == 2
+
+
+def test_quoted_header_with_delimiter_keeps_column_positions(tmp_path):
+    path = tmp_path / 'a.csv'
+    path.write_text('"城市, 国家",端口,IP地址,数据中心\n"Hong Kong, 香港",443,1.1.1.1,HKG\n', encoding='utf-8')
+    schema = td.resolve_schema(['城市, 国家', '端口', 'IP地址', '数据中心'])
+    assert (schema.port_index, schema.ip_index, schema.colo_index) == (1, 2, 3)
+    result = td.scan_csv_file(str(path), ports=(443,))
+    assert result.ips_443.to_strings() == ['1.1.1.1']
+    assert result.index[('colo', 'HKG')].to_strings() == ['1.1.1.1']
+
+
+def test_unknown_header_error_is_cached(csv_file, constructed, caplog):
+    paths = [csv_file(f'{name}.csv', [['1', '2']], header=['foo', 'bar']) for name in 'ab']
+    with caplog.at_level(logging.INFO):
+        results = [td.scan_csv_file(path) for path in paths]
+    assert all(result.schema_error is not None and not result.ips_443 for result in results)
+    assert len(constructed) == 1
+    with pytest.raises(td.SchemaError):
+        td.resolve_schema([' FOO', 'bar'])
+    assert len(constructed) == 1
@@ -0,0 +1,41 @@
+"""启动路径不加载重依赖的测试：导入模块和离线运行都不应导入telethon和pandas"""
+import json
+import os
+import subprocess
+import sys
+
+from conftest import ROOT, channel_row, write_csv
+
+HEAVY_MODULES = ('telethon', 'pandas', 'pyarrow')
+
+SCRIPT = """
+import asyncio, json, sys
+import telegram_downloader as td
+after_import = sorted(name for name in {heavy!r} if name in sys.modules)
+args = td.parse_args(['--offline', {downloads!r}, '--workers', '1', '--no-cache', '--top-n', '0'])
+asyncio.run(td.run_offline(args.offline, args))
+after_run = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps([after_import, after_run]))
+"""
+
+
+def blocked_modules(path):
+    """同名的假包，被导入时直接报错，已安装真实依赖时也能发现提前导入"""
+    for name in HEAVY_MODULES:
+        os.makedirs(path / name)
+        (path / name / '__init__.py').write_text(f"raise ImportError('{name} 不应在启动时导入')\n", encoding='utf-8')
+    return str(path)
+
+
+def test_import_and_offline_run_do_not_load_heavy_modules(tmp_path):
+    downloads = tmp_path / 'downloads'
+    write_csv(downloads / 'AsnALL-20251016-IP.csv', [channel_row('1.1.1.1')])
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([blocked_modules(tmp_path / 'blocked'), ROOT]),
+               EXTRACT_BACKEND='csv')
+    completed = subprocess.run(
+        [sys.executable, '-c', SCRIPT.format(heavy=HEAVY_MODULES, downloads=str(downloads))],
+        cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+
+    assert completed.returncode == 0, completed.stderr
+    assert json.loads(completed.stdout.strip().splitlines()[-1]) == [[], []]
+    assert (tmp_path / 'ip.txt').read_text(encoding='utf-8').split() == ['1.1.1.1']
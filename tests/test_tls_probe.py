@@ -0,0 +1,116 @@
+"""tls_probe 在回环地址上的测试：127.0.0.x 上分别启动正常握手、只接受TCP不握手的服务，
+另一个地址不监听（连接被拒绝）。证书为 tests/data 中的自签名证书，探测不校验证书。"""
+import asyncio
+import os
+import ssl
+import time
+
+import pytest
+
+import tls_probe
+from conftest import DATA_DIR
+
+LIVE_IP = '127.0.0.2'
+REFUSED_IP = '127.0.0.3'
+HANGING_IP = '127.0.0.4'
+
+
+def server_context():
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(os.path.join(DATA_DIR, 'test_cert.pem'), os.path.join(DATA_DIR, 'test_key.pem'))
+    return context
+
+
+async def start_servers(extra_live_ips=()):
+    """在同一端口上启动正常的TLS服务和不握手的服务，返回 (端口, 服务列表)"""
+    async def close_after_handshake(reader, writer):
+        writer.close()
+
+    async def never_handshake(reader, writer):
+        await asyncio.sleep(30)
+
+    context = server_context()
+    try:
+        live = await asyncio.start_server(close_after_handshake, LIVE_IP, 0, ssl=context)
+        port = live.sockets[0].getsockname()[1]
+        servers = [live, await asyncio.start_server(never_handshake, HANGING_IP, port)]
+        for ip in extra_live_ips:
+            servers.append(await asyncio.start_server(close_after_handshake, ip, port, ssl=context, backlog=512))
+    except OSError as e:
+        pytest.skip(f"无法在127.0.0.x上监听: {e}")
+    return port, servers
+
+
+async def stop_servers(servers):
+    for server in servers:
+        server.close()
+        await server.wait_closed()
+
+
+def test_probe_live_refused_and_hanging():
+    async def run():
+        port, servers = await start_servers()
+        try:
+            start = time.perf_counter()
+            results = await tls_probe.probe_ips([LIVE_IP, REFUSED_IP, HANGING_IP], port=port, timeout=0.5, attempts=2)
+            return results, time.perf_counter() - start
+        finally:
+            await stop_servers(servers)
+
+    results, elapsed = asyncio.run(run())
+    assert set(results) == {LIVE_IP, REFUSED_IP, HANGING_IP}
+    assert results[LIVE_IP] is not None and 0 < results[LIVE_IP] < 500
+    assert results[REFUSED_IP] is None
+    assert results[HANGING_IP] is None
+    # 不握手的服务每次尝试都在超时后放弃：2次 × 0.5秒
+    assert elapsed < 3
+
+
+def test_probe_ip_times_out_on_hanging_server():
+    async def run():
+        port, servers = await start_servers()
+        try:
+            start = time.perf_counter()
+            latency = await tls_probe.probe_ip(HANGING_IP, port, timeout=0.3)
+            return latency, time.perf_counter() - start
+        finally:
+            await stop_servers(servers)
+
+    latency, elapsed = asyncio.run(run())
+    assert latency is None
+    assert 0.25 <= elapsed < 2
+
+
+def test_probe_ips_respects_concurrency_limit(monkeypatch):
+    ips = [f'127.0.1.{i}' for i in range(1, 41)]
+    active = 0
+    peak = 0
+    real_probe_ip = tls_probe.probe_ip
+
+    async def counting_probe_ip(*args, **kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            return await real_probe_ip(*args, **kwargs)
+        finally:
+            active -= 1
+
+    monkeypatch.setattr(tls_probe, 'probe_ip', counting_probe_ip)
+
+    async def run():
+        port, servers = await start_servers(extra_live_ips=ips)
+        try:
+            return await tls_probe.probe_ips(ips, port=port, concurrency=5, timeout=2)
+        finally:
+            await stop_servers(servers)
+
+    results = asyncio.run(run())
+    assert all(results[ip] is not None for ip in ips)
+    assert peak == 5
+
+
+def test_order_by_latency():
+    latencies = {1: 5.0, 2: None, 3: 1.0, 4: None}
+    assert tls_probe.order_by_latency([4, 3, 2, 1], latencies) == [3, 1]
+    assert tls_probe.order_by_latency([4, 3, 2, 1], latencies, drop_unreachable=False) == [3, 1, 4, 2]
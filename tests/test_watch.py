@@ -0,0 +1,117 @@
+"""监听模式的测试：新文件到达后合并处理（debounce），处理期间到达的文件再触发一轮"""
+import asyncio
+import os
+import sys
+import types
+from datetime import datetime, timezone
+
+import pytest
+
+import telegram_downloader as td
+from conftest import channel_row
+from fake_telegram import FakeClient, fake_telethon, make_message
+
+DEBOUNCE = 0.2
+
+
+@pytest.fixture
+def channel_files(csv_file):
+    return [csv_file(f'channel/AsnALL-2025101{index}-IP.csv', [channel_row(f'10.0.0.{index + 1}')]) for index in range(5)]
+
+
+@pytest.fixture
+def watcher(tmp_path, monkeypatch):
+    """启动watch_sources，返回 (客户端, 每次on_change的 (时间, 文件名列表), 处理耗时设置)"""
+    monkeypatch.setitem(sys.modules, 'telethon', fake_telethon())
+    client = FakeClient([])
+    downloader = td.TelegramDownloader(1, 'hash', '+10000000000', 'test_channel', client=client)
+    source = td.TelegramSource(downloader, 'test_channel', str(tmp_path / 'downloads'))
+    calls = []
+    settings = {'processing_seconds': 0}
+
+    async def on_change(files):
+        calls.append((asyncio.get_running_loop().time(), sorted(os.path.basename(path) for path in files)))
+        await asyncio.sleep(settings['processing_seconds'])
+
+    def start():
+        return asyncio.create_task(downloader.watch_sources([source], on_change, debounce=DEBOUNCE))
+
+    return client, calls, settings, start
+
+
+def new_message(message_id, path):
+    return make_message(message_id, os.path.basename(path), path, datetime.now(timezone.utc))
+
+
+def test_burst_of_files_is_processed_once(channel_files, watcher):
+    client, calls, _, start = watcher
+
+    async def run():
+        task = start()
+        await asyncio.sleep(0)
+        assert len(client.handlers) == 1
+        loop = asyncio.get_running_loop()
+        for message_id, path in enumerate(channel_files[:3], start=1):
+            await client.emit(new_message(message_id, path))
+            await asyncio.sleep(DEBOUNCE / 4)
+        last_event = loop.time()
+        # 不带CSV文档的消息不触发处理
+        await client.emit(types.SimpleNamespace(id=10, date=datetime.now(timezone.utc), media=None, file=None))
+        await asyncio.sleep(DEBOUNCE * 3)
+        await client.disconnect()
+        await task
+        return last_event
+
+    last_event = asyncio.run(run())
+    assert len(calls) == 1
+    called_at, files = calls[0]
+    assert called_at >= last_event + DEBOUNCE - 0.05
+    assert files == [os.path.basename(path) for path in channel_files[:3]]
+
+
+def test_file_during_processing_triggers_one_more_pass(channel_files, watcher, tmp_path):
+    client, calls, settings, start = watcher
+    settings['processing_seconds'] = DEBOUNCE * 2
+
+    async def run():
+        task = start()
+        await asyncio.sleep(0)
+        await client.emit(new_message(1, channel_files[0]))
+        # 等到第一轮开始处理后再到达两个文件
+        while not calls:
+            await asyncio.sleep(0.01)
+        await client.emit(new_message(2, channel_files[1]))
+        await client.emit(new_message(3, channel_files[2]))
+        await asyncio.sleep(DEBOUNCE * 6)
+        await client.disconnect()
+        await task
+
+    asyncio.run(run())
+    assert [files for _, files in calls] == [
+        [os.path.basename(channel_files[0])],
+        [os.path.basename(path) for path in channel_files[:3]],
+    ]
+    state = td.TelegramDownloader(None, None, None, None).load_channel_state(
+        str(tmp_path / 'downloads' / td.CHANNEL_STATE_FILENAME))
+    assert state['channels']['test_channel']['max_id'] == 3
+
+
+def test_files_posted_before_watch_starts_are_caught_up(channel_files, watcher):
+    client, calls, _, start = watcher
+    # 首轮处理之后、注册监听之前频道里出现的文件
+    client.messages.extend(new_message(message_id, path) for message_id, path in enumerate(channel_files[:2], start=1))
+
+    async def run():
+        task = start()
+        await asyncio.sleep(DEBOUNCE * 3)
+        await client.emit(new_message(3, channel_files[2]))
+        await asyncio.sleep(DEBOUNCE * 3)
+        await client.disconnect()
+        await task
+
+    asyncio.run(run())
+    assert [files for _, files in calls] == [
+        [os.path.basename(path) for path in channel_files[:2]],
+        [os.path.basename(path) for path in channel_files[:3]],
+    ]
+    assert sorted(client.download_calls) == [1, 2, 3]
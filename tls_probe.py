@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import ssl
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVER_NAME = 'speed.cloudflare.com'  # 握手时发送的SNI，优选IP都是Cloudflare节点
+DEFAULT_CONCURRENCY = 500
+DEFAULT_TIMEOUT = 3.0
+
+
+def make_probe_context():
+    """探测只关心能否完成TLS握手及耗时，不校验证书（本地测试可使用自签名证书）"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def probe_ip(ip, port=443, server_name=DEFAULT_SERVER_NAME, timeout=DEFAULT_TIMEOUT, ssl_context=None):
+    """对 ip:port 完成一次TCP连接和TLS握手，返回耗时（毫秒）；失败或超时返回None"""
+    ssl_context = ssl_context or make_probe_context()
+    start = time.perf_counter()
+    writer = None
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port, ssl=ssl_context, server_hostname=server_name),
+            timeout,
+        )
+        return (time.perf_counter() - start) * 1000
+    except (OSError, asyncio.TimeoutError, ssl.SSLError) as e:
+        logger.debug(f"探测失败 {ip}:{port}: {e!r}")
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), timeout)
+            except (OSError, asyncio.TimeoutError, ssl.SSLError):
+                pass
+
+
+async def probe_ips(ips, port=443, concurrency=DEFAULT_CONCURRENCY, timeout=DEFAULT_TIMEOUT,
+                    attempts=1, server_name=DEFAULT_SERVER_NAME, ssl_context=None):
+    """并发探测一批IP，返回 {ip: 第一次成功握手的耗时(毫秒)或None}
+
+    同时进行的连接数不超过concurrency；每个IP最多尝试attempts次，有一次成功即停止。
+    """
+    ssl_context = ssl_context or make_probe_context()
+    ips = list(ips)
+    results = {}
+    pending = iter(ips)
+
+    async def worker():
+        # 固定数量的工作协程轮流取IP，IP再多也不会一次创建大量任务
+        for ip in pending:
+            latency = None
+            for _ in range(max(attempts, 1)):
+                latency = await probe_ip(ip, port, server_name, timeout, ssl_context)
+                if latency is not None:
+                    break
+            results[ip] = latency
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(ips))))))
+    return results
+
+
+def order_by_latency(ips, latencies, drop_unreachable=True):
+    """可达的IP按握手耗时从低到高排列；不可达的IP丢弃，或在drop_unreachable为False时保留原顺序放在末尾"""
+    reachable = sorted((ip for ip in ips if latencies.get(ip) is not None), key=lambda ip: latencies[ip])
+    if drop_unreachable:
+        return reachable
+    return reachable + [ip for ip in ips if latencies.get(ip) is None]